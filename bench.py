@@ -0,0 +1,836 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from lib import clusters
+from lib.store import Store
+from typing import Any, Callable, Dict, List
+
+BENCH_FOLDER = "output/bench"
+# Order lookups sleep per round trip, so they run on a smaller dataset.
+MAX_LOOKUP_TRACKINGS = 4000
+# Personal-account emails go through BeautifulSoup, which is slow to run at full size.
+MAX_PARSED_EMAILS = 20000
+
+# A rough model of a Sheets values write: a fixed round trip plus time per row.
+SHEETS_WRITE_SECONDS = 0.2
+SHEETS_ROW_SECONDS = 0.00005
+
+# Seeded random datasets sharded clustering is compared on, and their size.
+SHARDING_SEEDS = 20
+SHARDING_TRACKINGS = 400
+
+BENCHMARKS: Dict[str, Callable[[Any], None]] = {}
+RESULTS: List[Dict[str, Any]] = []
+
+
+def benchmark(name):
+  """Registers a benchmark function (taking the parsed args) under the given name."""
+
+  def decorator(fn):
+    BENCHMARKS[name] = fn
+    return fn
+
+  return decorator
+
+
+def report(name, size, seconds, mem_kb=None) -> None:
+  RESULTS.append({"name": name, "size": size, "seconds": seconds, "mem_kb": mem_kb})
+  memory = f" {mem_kb / 1024:10.1f} MB" if mem_kb is not None else ""
+  print(f"{name:<40} size={size:<8} {seconds * 1000:10.1f} ms{memory}")
+
+
+def reconcile_args(**overrides) -> argparse.Namespace:
+  """The parsed arguments of a plain `reconcile.py` run, with the given overrides."""
+  args = dict(groups=None, print_unknowns=False, incremental=False, processes=1)
+  args.update(overrides)
+  return argparse.Namespace(**args)
+
+
+def make_clusters(num_clusters, trackings_per_cluster=2, group="bench"):
+  result = []
+  for i in range(num_clusters):
+    cluster = clusters.Cluster(group)
+    cluster.orders = {"%03d-%07d-%07d" % (i % 1000, i, i)}
+    cluster.trackings = {f"TRK{i}-{j}" for j in range(trackings_per_cluster)}
+    cluster.expected_cost = 10.0
+    result.append(cluster)
+  return result
+
+
+@contextlib.contextmanager
+def in_temp_dir():
+  """Runs the enclosed code from a scratch directory, so output/ files don't touch the real ones."""
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as folder:
+    os.chdir(folder)
+    try:
+      yield folder
+    finally:
+      os.chdir(cwd)
+
+
+@benchmark("merge_tuples")
+def bench_merge_by_trackings_tuples(args) -> None:
+  import reconcile
+  size = args.size
+  rand = random.Random(0)
+  all_clusters = make_clusters(size)
+  all_trackings = [t for cluster in all_clusters for t in sorted(cluster.trackings)]
+  trackings_to_cost = {}
+  for _ in range(size):
+    trackings_tuple = tuple(rand.sample(all_trackings, rand.randint(1, 4)))
+    trackings_to_cost[trackings_tuple] = ("bench", 10.0)
+  clusters_by_tracking = reconcile.map_clusters_by_tracking(all_clusters)
+
+  start = time.perf_counter()
+  reconcile.merge_by_trackings_tuples(clusters_by_tracking, trackings_to_cost, all_clusters)
+  report("merge_tuples", size, time.perf_counter() - start)
+
+
+@benchmark("store_lookups")
+def bench_store_lookups(args) -> None:
+  size = args.size
+  with tempfile.TemporaryDirectory() as folder:
+    store = Store(os.path.join(folder, "bench.db"))
+    orders = store.table("orders")
+    start = time.perf_counter()
+    orders.update((str(i), (str(i), float(i))) for i in range(size))
+    report("store_bulk_load", size, time.perf_counter() - start)
+
+    rand = random.Random(0)
+    keys = [str(rand.randrange(size)) for _ in range(10000)]
+    start = time.perf_counter()
+    for key in keys:
+      orders.get(key)
+    report("store_point_lookups", len(keys), time.perf_counter() - start)
+    store.conn.close()
+
+
+@benchmark("reconcile")
+def bench_reconcile(args) -> None:
+  """End-to-end reconcile_new over a synthetic dataset, reporting each stage's time and memory."""
+  import reconcile
+  from lib import instrumentation
+  from lib import synthetic
+  from lib.store import get_store, ORDERS_NAMESPACE
+
+  dataset = synthetic.SyntheticDataset(args.size)
+  with in_temp_dir(), synthetic.synthetic_backends(dataset):
+    if not args.cold:
+      get_store().table(ORDERS_NAMESPACE).update(dataset.order_infos())
+    instrumentation.reset()
+    instrumentation.enable(track_memory=args.memory)
+    start = time.perf_counter()
+    reconcile.reconcile_new(dataset.config, reconcile_args(processes=args.processes))
+    total = time.perf_counter() - start
+    instrumentation.disable()
+
+  for event in instrumentation.events():
+    if event["name"].startswith("reconcile."):
+      report(event["name"], args.size, event["dur"] / 1e6,
+             event.get("args", {}).get("mem_delta_kb"))
+  report("reconcile (total)", args.size, total)
+
+
+@benchmark("reconcile_incremental")
+def bench_reconcile_incremental(args) -> None:
+  """A full reconcile of the synthetic dataset, then an incremental one after new trackings arrive."""
+  import reconcile
+  from lib import synthetic
+  from lib.order_info import OrderInfo
+  from lib.store import get_store, ORDERS_NAMESPACE, ORDER_MISSES_NAMESPACE
+
+  before = synthetic.SyntheticDataset(args.size)
+  after = synthetic.SyntheticDataset(args.size + args.new_trackings)
+  order_infos = after.order_infos()
+  # Some orders' emails only arrive between the two runs.
+  late = {order_id: info for i, (order_id, info) in enumerate(order_infos.items()) if i % 10 == 3}
+
+  def run_before():
+    get_store().table(ORDERS_NAMESPACE).update(order_infos)
+    get_store().table(ORDERS_NAMESPACE).update(
+        (order_id, OrderInfo(None, 0.0)) for order_id in late)
+    get_store().table(ORDER_MISSES_NAMESPACE).update(
+        (order_id, (1, time.time())) for order_id in late)
+    with synthetic.synthetic_backends(before) as sheets:
+      reconcile.reconcile_new(before.config, reconcile_args())
+    get_store().table(ORDERS_NAMESPACE).update(late)
+    get_store().table(ORDER_MISSES_NAMESPACE).clear()
+    return sheets
+
+  with in_temp_dir():
+    sheets = run_before()
+    with synthetic.synthetic_backends(after) as new_sheets:
+      new_sheets.tabs = sheets.tabs
+      start = time.perf_counter()
+      reconcile.reconcile_new(after.config, reconcile_args(incremental=True))
+      report(f"reconcile incremental (+{args.new_trackings})", args.size,
+             time.perf_counter() - start)
+    incremental_rows = cluster_rows(clusters.get_existing_clusters(after.config))
+
+  # The same two runs as full rebuilds must end up with the same clusters.
+  with in_temp_dir():
+    sheets = run_before()
+    with synthetic.synthetic_backends(after) as new_sheets:
+      new_sheets.tabs = sheets.tabs
+      reconcile.reconcile_new(after.config, reconcile_args())
+    full_rows = cluster_rows(clusters.get_existing_clusters(after.config))
+  if incremental_rows != full_rows:
+    mismatched = len(set(incremental_rows) ^ set(full_rows))
+    raise Exception(f"Incremental reconcile differs from a full rebuild in {mismatched} rows")
+
+
+def cluster_rows(all_clusters) -> list:
+  return sorted(tuple(str(value) for value in cluster.to_row()) for cluster in all_clusters)
+
+
+@benchmark("reconcile_one_group")
+def bench_reconcile_one_group(args) -> None:
+  """
+  A full reconcile of the synthetic dataset, then a --groups run over just its
+  first group, failing unless the sheet still holds every tracking. The first
+  group's portal checked in one of the second group's trackings with its own,
+  so their clusters merge across groups.
+  """
+  import reconcile
+  from lib import synthetic
+  from lib.store import get_store, ORDERS_NAMESPACE
+
+  dataset = synthetic.SyntheticDataset(args.size)
+  group = dataset.groups[0]
+  first_trackings = {}
+  for tracking in dataset.trackings():
+    first_trackings.setdefault(tracking.group, tracking.tracking_number)
+  portal_maps = dataset.portal_maps
+
+  def joined_portal_maps(portal_group):
+    tracking_to_po, trackings_cost, po_cost = portal_maps(portal_group)
+    if portal_group == group:
+      trackings_cost[(first_trackings[group], first_trackings[dataset.groups[1]])] = 1.0
+    return tracking_to_po, trackings_cost, po_cost
+
+  dataset.portal_maps = joined_portal_maps
+  sheet_key = (dataset.config['reconciliation']['baseSpreadsheetId'], "Reconciliation v2")
+
+  def sheet_trackings(sheets):
+    return set(tracking for cluster in sheets.download_from_sheet(clusters.from_row, *sheet_key)
+               for tracking in cluster.trackings)
+
+  with in_temp_dir():
+    get_store().table(ORDERS_NAMESPACE).update(dataset.order_infos())
+    with synthetic.synthetic_backends(dataset) as sheets:
+      start = time.perf_counter()
+      reconcile.reconcile_new(dataset.config, reconcile_args())
+      report("reconcile all groups", args.size, time.perf_counter() - start)
+      expected = sheet_trackings(sheets)
+      start = time.perf_counter()
+      reconcile.reconcile_new(dataset.config, reconcile_args(groups=[group]))
+      report(f"reconcile --groups {group}", args.size, time.perf_counter() - start)
+      if sheet_trackings(sheets) != expected:
+        raise Exception(f"The --groups {group} run dropped trackings from the sheet")
+
+
+def cluster_signature(all_clusters) -> list:
+  return [(sorted(c.orders), sorted(c.trackings), c.group, sorted(c.email_ids),
+           sorted(c.purchase_orders), c.last_ship_date, c.last_delivery_date, c.to_email,
+           c.expected_cost) for c in all_clusters]
+
+
+def random_trackings(rand, count) -> list:
+  """Trackings whose orders, groups and dates are drawn at random, often shared between them."""
+  groups = ["alpha", "beta", "gamma"]
+  orders = ["O%d" % i for i in range(max(1, count // 2))]
+  return [
+      clusters.ShardTracking("RT%06d" % i, rand.choice(groups),
+                             rand.sample(orders, rand.choice([0, 1, 1, 1, 2, 3])),
+                             "2020-01-%02d" % rand.randint(1, 28),
+                             "2020-02-%02d" % rand.randint(1, 28), "buyer%d" % rand.randrange(4))
+      for i in range(count)
+  ]
+
+
+def fill_random_attrs(rand, all_clusters) -> None:
+  """Gives the clusters email IDs and POs from small pools, so many clusters share them."""
+  for cluster in all_clusters:
+    cluster.email_ids = set("E%d" % (sum(map(ord, order)) % (len(all_clusters) // 3 + 1))
+                            for order in cluster.orders)
+    cluster.purchase_orders = set(
+        "PO%d" % rand.randrange(len(all_clusters) // 2 + 1) for _ in range(rand.randint(0, 2)))
+
+
+@benchmark("sharded_clustering")
+def bench_sharded_clustering(args) -> None:
+  """
+  update_clusters and merge_orders in one process and sharded over --processes
+  workers, failing unless both produce identical clusters.
+  """
+  from lib import synthetic
+
+  dataset = synthetic.SyntheticDataset(args.size)
+  trackings = dataset.trackings()
+  # Some trackings filed under another group than their order's, so that
+  # shards have to follow order IDs across groups.
+  for tracking in trackings[5::97]:
+    tracking.group = dataset.groups[(dataset.groups.index(tracking.group) + 1) %
+                                    len(dataset.groups)]
+
+  def fill_email_ids(all_clusters):
+    for cluster in all_clusters:
+      cluster.email_ids = set(
+          str(dataset.email_uid(synthetic.order_index(order))) for order in cluster.orders)
+
+  start = time.perf_counter()
+  single = []
+  clusters.update_clusters(single, trackings)
+  fill_email_ids(single)
+  single = clusters.merge_orders(single)
+  report("clustering (1 process)", args.size, time.perf_counter() - start)
+
+  start = time.perf_counter()
+  sharded = clusters.update_clusters_sharded(trackings, args.processes)
+  fill_email_ids(sharded)
+  sharded = clusters.merge_orders_sharded(sharded, args.processes)
+  report(f"clustering ({args.processes} processes)", args.size, time.perf_counter() - start)
+
+  if cluster_signature(single) != cluster_signature(sharded):
+    raise Exception("Sharded clustering differs from single-process clustering")
+
+  # The same comparison over seeded random trackings, with orders, email IDs and
+  # POs shared in ways the synthetic dataset doesn't produce.
+  start = time.perf_counter()
+  merge_log = sys.stdout if args.verbose else io.StringIO()
+  for seed in range(SHARDING_SEEDS):
+    trackings = random_trackings(random.Random(seed), SHARDING_TRACKINGS)
+    single = []
+    clusters.update_clusters(single, trackings)
+    sharded = clusters.update_clusters_sharded(trackings, args.processes)
+    if cluster_signature(single) != cluster_signature(sharded):
+      raise Exception(f"Sharded update_clusters differs from single-process for seed {seed}")
+    fill_random_attrs(random.Random(seed), single)
+    fill_random_attrs(random.Random(seed), sharded)
+    with contextlib.redirect_stdout(merge_log):
+      single = clusters.merge_orders(single)
+      sharded = clusters.merge_orders_sharded(sharded, args.processes)
+    if cluster_signature(single) != cluster_signature(sharded):
+      raise Exception(f"Sharded merge_orders differs from single-process for seed {seed}")
+  report(f"clustering comparisons ({SHARDING_SEEDS} seeds)", SHARDING_TRACKINGS,
+         time.perf_counter() - start)
+
+
+@benchmark("cluster_table")
+def bench_cluster_table(args) -> None:
+  """Total diffs, sheet order and summary totals over a ClusterTable, against the per-object loops."""
+  from lib import reconciliation_uploader
+  from lib.cluster_table import ClusterTable
+
+  rand = random.Random(0)
+  all_clusters = make_clusters(args.size)
+  for cluster in all_clusters:
+    cluster.tracked_cost = rand.choice([0.0, 10.0, 9.5])
+    cluster.verified = rand.random() < 0.2
+    cluster.below_cost = rand.random() < 0.1
+
+  start = time.perf_counter()
+  diffs = [reconciliation_uploader.total_diff(cluster) for cluster in all_clusters]
+  sum(diffs)
+  sorted(range(len(all_clusters)),
+         key=lambda i: (all_clusters[i].verified, all_clusters[i].below_cost, -diffs[i]))
+  report("cluster objects: diff+sort+sum", args.size, time.perf_counter() - start)
+
+  start = time.perf_counter()
+  table = ClusterTable.from_clusters(all_clusters)
+  report("cluster_table: from_clusters", args.size, time.perf_counter() - start)
+  start = time.perf_counter()
+  table.total_diff().sum()
+  order = table.sort_order()
+  table.summary()
+  report("cluster_table: diff+sort+summary", args.size, time.perf_counter() - start)
+
+  if table.total_diff().tolist() != diffs:
+    raise Exception("ClusterTable.total_diff differs from reconciliation_uploader.total_diff")
+  # compare isn't a total order (two verified clusters each come before the
+  # other), so only its 1s, "the first belongs after the second", are checked:
+  # the table's order mustn't put any cluster before one compare puts it after.
+  ordered = [all_clusters[i] for i in order]
+  pairs = [(i, i + 1) for i in range(len(ordered) - 1)]
+  pairs.extend(sorted(rand.sample(range(len(ordered)), 2)) for _ in range(10000))
+  if any(reconciliation_uploader.compare(ordered[i], ordered[j]) > 0 for i, j in pairs):
+    raise Exception("ClusterTable.sort_order disagrees with reconciliation_uploader.compare")
+
+
+@benchmark("portal_api")
+def bench_portal_api(args) -> None:
+  """Loads one group's Melul receipts from a local stand-in of the portal's JSON endpoint."""
+  from lib import synthetic
+  from lib.group_site_manager import GroupSiteManager
+  from lib.tracking_keys import canonical_cost_maps
+
+  dataset = synthetic.SyntheticDataset(args.size)
+  group = dataset.groups[0]
+  browser = synthetic.SyntheticBrowser({"session": "synthetic"})
+  manager = GroupSiteManager(dataset.config, None)
+  with synthetic.portal_api_server(dataset.melul_receipts(group),
+                                   session_cookie="session=synthetic") as server:
+    start = time.perf_counter()
+    tracking_to_po, _, trackings_cost = manager._melul_fetch_tracking_pos_costs_maps(
+        group, browser, {"url": server.url})
+    report(f"portal_api receipts ({server.requests} pages)", len(trackings_cost),
+           time.perf_counter() - start)
+  expected_tracking_to_po, expected_trackings_cost, _ = canonical_cost_maps(
+      group, *dataset.portal_maps(group))
+  if tracking_to_po != expected_tracking_to_po or set(trackings_cost) != set(
+      expected_trackings_cost):
+    raise Exception("portal_api receipts don't match the synthetic portal")
+
+
+@benchmark("mail_search")
+def bench_mail_search(args) -> None:
+  """
+  MailSearch against the synthetic mailbox as Gmail and as a plain IMAP
+  server, failing unless the SEARCH criteria sent and the IDs fetched are
+  exactly the expected ones.
+  """
+  from lib import synthetic
+  from lib.mail_search import MailSearch
+
+  dataset = synthetic.SyntheticDataset(min(args.size, MAX_LOOKUP_TRACKINGS))
+  order_ids = [synthetic.order_id(order) for order in range(dataset.num_orders)]
+  terms = {
+      "phrases": order_ids[:3],
+      "subject": "Your Amazon.com order",
+      "sender": "auto-confirm@amazon.com",
+      "since": "01-Aug-2019"
+  }
+  expected_searches = {
+      True: [
+          ("X-GM-RAW", '"\\"112-0000000-0000005\\""'),
+          ("X-GM-RAW", '"{\\"112-0000000-0000000\\" \\"112-0000000-0000001\\" '
+           '\\"112-0000000-0000002\\"} subject:\\"Your Amazon.com order\\" '
+           'from:auto-confirm@amazon.com after:2019/08/01"'),
+      ],
+      False: [
+          ('BODY "112-0000000-0000005"',),
+          ('OR BODY "112-0000000-0000000" OR BODY "112-0000000-0000001" '
+           'BODY "112-0000000-0000002"', 'SUBJECT "Your Amazon.com order"',
+           'FROM "auto-confirm@amazon.com"', 'SINCE "01-Aug-2019"'),
+      ],
+  }
+  expected_uids = sorted(
+      set(uid for uid in map(dataset.email_uid, range(3)) if uid is not None))
+
+  for gmail, name in ((True, "gmail"), (False, "imap")):
+    mailbox = synthetic.SyntheticMailbox(dataset, gmail=gmail)
+    mail = MailSearch(mailbox)
+    single = mail.search(phrase=order_ids[5])
+    several = mail.search(**terms)
+    if mailbox.searches != expected_searches[gmail]:
+      raise Exception(f"MailSearch sent {mailbox.searches} to {name}, "
+                      f"not {expected_searches[gmail]}")
+    if single != [str(dataset.email_uid(5))] or several != [str(uid) for uid in expected_uids]:
+      raise Exception(f"MailSearch found {single} and {several} on {name}")
+
+    uids = sorted(set(str(uid) for uid in map(dataset.email_uid, range(dataset.num_orders))
+                      if uid is not None), key=int)
+    start = time.perf_counter()
+    fetched = mail.fetch_many(uids)
+    report(f"mail_search fetch_many ({name})", len(uids), time.perf_counter() - start)
+    # Gmail messages are known by their X-GM-MSGID, other servers' by UID.
+    expected_ids = {
+        uid: str(synthetic.gmail_message_id(int(uid))) if gmail else uid for uid in uids
+    }
+    if {uid: stable_id for uid, (stable_id, _) in fetched.items()} != expected_ids:
+      raise Exception(f"MailSearch.fetch_many returned the wrong message IDs on {name}")
+    if any(data[0][1] != dataset.render_email(int(uid)) for uid, (_, data) in fetched.items()):
+      raise Exception(f"MailSearch.fetch_many returned the wrong messages on {name}")
+
+
+@benchmark("order_lookups")
+def bench_order_lookups(args) -> None:
+  """
+  Cold-cache order lookups over IMAP and over the Gmail API, each taking
+  --mail-latency seconds per round trip. Capped at MAX_LOOKUP_TRACKINGS.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  from lib import synthetic
+  from lib.order_info import OrderInfoRetriever
+
+  dataset = synthetic.SyntheticDataset(min(args.size, MAX_LOOKUP_TRACKINGS))
+  order_ids = [synthetic.order_id(order) for order in range(dataset.num_orders)]
+  expected = {
+      order_id: round(order_info.cost, 2)
+      for order_id, order_info in dataset.order_infos().items()
+  }
+  token = "synthetic-token"
+  with synthetic.gmail_api_server(dataset, token, args.mail_latency) as server:
+    backends = {
+        "imap": {},
+        "gmail_api": {
+            "mailBackend": "gmail_api",
+            "gmailApi": {
+                "accessToken": token,
+                "baseUrl": server.url
+            }
+        },
+    }
+    with in_temp_dir(), synthetic.synthetic_backends(
+        dataset, gmail=True, mail_latency=args.mail_latency):
+      # What lookups cost before they were batched: a search and a fetch per order.
+      retriever = OrderInfoRetriever(dataset.config)
+      start = time.perf_counter()
+      with ThreadPoolExecutor(max_workers=retriever.workers) as executor:
+        list(executor.map(retriever.fetch_order_info, order_ids))
+      report("order_lookups (imap, per order)", len(order_ids), time.perf_counter() - start)
+      retriever.close()
+
+    for name, backend_config in backends.items():
+      with in_temp_dir(), synthetic.synthetic_backends(
+          dataset, gmail=True, mail_latency=args.mail_latency):
+        retriever = OrderInfoRetriever(dict(dataset.config, **backend_config))
+        start = time.perf_counter()
+        order_infos, errors = retriever.get_order_infos(order_ids)
+        report(f"order_lookups ({name})", len(order_ids), time.perf_counter() - start)
+        retriever.close()
+      costs = {order_id: round(order_info.cost, 2) for order_id, order_info in order_infos.items()}
+      if errors or costs != expected:
+        raise Exception(f"{name} order lookups don't match the synthetic mailbox")
+
+
+@benchmark("email_parsing")
+def bench_email_parsing(args) -> None:
+  """Parses a synthetic corpus of Amazon order emails (capped at MAX_PARSED_EMAILS)."""
+  from lib import synthetic
+  from lib.order_info import OrderInfoRetriever
+
+  corpus = synthetic.email_corpus(min(args.size, MAX_PARSED_EMAILS))
+  with in_temp_dir(), synthetic.synthetic_backends(synthetic.SyntheticDataset(0)):
+    retriever = OrderInfoRetriever({})
+    start = time.perf_counter()
+    parsed = [
+        retriever.parse_order_email(order_id, str(index), data)
+        for index, (order_id, data, _) in enumerate(corpus)
+    ]
+    report("email_parsing", len(corpus), time.perf_counter() - start)
+    retriever.close()
+  for order_infos, (order_id, _, expected) in zip(parsed, corpus):
+    costs = {order: round(order_info.cost, 2) for order, order_info in order_infos.items()}
+    if costs != expected:
+      raise Exception(f"Parsed {costs} from the email of {order_id}, expected {expected}")
+
+
+@benchmark("drive_backup")
+def bench_drive_backup(args) -> None:
+  """
+  Backs up a store holding the dataset's order infos (changed, unchanged, and
+  after a restart), then restores it on a second machine.
+  """
+  from lib import synthetic
+  from lib.order_info import OrderInfo
+  from lib.store import get_store, Store, ORDERS_NAMESPACE, BACKUP_SUFFIX, DB_FILENAME
+
+  dataset = synthetic.SyntheticDataset(args.size)
+  with in_temp_dir(), synthetic.synthetic_backends(dataset):
+    store = get_store()
+    store.table(ORDERS_NAMESPACE).update(dataset.order_infos())
+    for name in ("changed", "unchanged"):
+      start = time.perf_counter()
+      uploaded = store.backup_to_drive(dataset.config)
+      report(f"drive_backup ({name}, uploaded={uploaded})", args.size,
+             time.perf_counter() - start)
+    # A new process only knows the digest of the last upload.
+    start = time.perf_counter()
+    uploaded = Store(store.path).backup_to_drive(dataset.config)
+    report(f"drive_backup (restarted, uploaded={uploaded})", args.size,
+           time.perf_counter() - start)
+    if args.verbose:
+      print(f"  database {os.path.getsize(store.path)} bytes, "
+            f"backup {os.path.getsize(store.path + BACKUP_SUFFIX)} bytes")
+
+    other = Store(os.path.join("other", DB_FILENAME))
+    start = time.perf_counter()
+    restored = other.restore_from_drive(dataset.config)
+    report(f"drive_restore (empty, restored={restored})", args.size, time.perf_counter() - start)
+    if not restored or other.table(ORDERS_NAMESPACE).load_all().keys() != dataset.order_infos().keys():
+      raise Exception("An empty store wasn't restored from the Drive backup")
+
+    def restore_again():
+      other.restore_checked = False
+      return other.restore_from_drive(dataset.config)
+
+    if restore_again():
+      raise Exception("A store restored from the current backup was restored again")
+    # The first machine moves on; the second, unchanged since, picks that up.
+    store.table(ORDERS_NAMESPACE)["newer"] = OrderInfo("1", 1.0)
+    store.backup_to_drive(dataset.config)
+    if not restore_again() or "newer" not in other.table(ORDERS_NAMESPACE):
+      raise Exception("A store older than the Drive backup wasn't restored")
+    # Both change: the second machine keeps its own.
+    store.table(ORDERS_NAMESPACE)["first"] = OrderInfo("2", 2.0)
+    store.backup_to_drive(dataset.config)
+    other.table(ORDERS_NAMESPACE)["second"] = OrderInfo("3", 3.0)
+    if restore_again() or "second" not in other.table(ORDERS_NAMESPACE):
+      raise Exception("A store changed since its last sync was overwritten by the Drive backup")
+    other.conn.close()
+
+
+@benchmark("archives")
+def bench_archives(args) -> None:
+  """
+  Costs --size reconciled trackings against an archive of --size entries: by
+  unpickling it into the working dicts (as ArchiveManager archives were), and
+  by lookups in its compact memory-mapped form. Memory is the Python heap kept.
+  """
+  import pickle
+  import tracemalloc
+  from lib import synthetic
+  from lib.compact_archive import CompactArchive
+
+  trackings_cost = {}
+  po_cost = {}
+  for index in range(args.size):
+    # Every twentieth entry covers two trackings; half of the entries are old enough to miss.
+    trackings = (synthetic.tracking_number(2 * index),)
+    if index % 20 == 0:
+      trackings += (synthetic.tracking_number(2 * index + 1),)
+    trackings_cost[trackings] = 10 + index % 500
+    po_cost["PO%d" % index] = 10 + index % 500
+  reconciled = [synthetic.tracking_number(index) for index in range(args.size, 2 * args.size)]
+
+  with in_temp_dir() as folder:
+    pickle_path = os.path.join(folder, "archive.pickle")
+    with open(pickle_path, 'wb') as stream:
+      pickle.dump((po_cost, trackings_cost), stream)
+    compact_path = os.path.join(folder, "archive.compact")
+    CompactArchive.write(compact_path, trackings_cost, po_cost)
+
+    def load_pickle():
+      working_po_cost, working_trackings_cost = {}, {}
+      with open(pickle_path, 'rb') as stream:
+        archive_po_cost, archive_trackings_cost = pickle.load(stream)
+      working_po_cost.update(archive_po_cost)
+      working_trackings_cost.update(archive_trackings_cost)
+      # Reconcile then scans every entry for trackings it knows.
+      known = set(reconciled)
+      hits = sum(1 for trackings in working_trackings_cost if not known.isdisjoint(trackings))
+      return hits, (working_po_cost, working_trackings_cost)
+
+    def query_compact():
+      archive = CompactArchive(compact_path)
+      hits = {}
+      for tracking in reconciled:
+        for trackings, cost in archive.trackings_entries(tracking):
+          hits[trackings] = (archive_group, cost)
+      archive.close()
+      return len(hits), hits
+
+    archive_group = "archived"
+    for name, fn in (("pickle", load_pickle), ("compact", query_compact)):
+      start = time.perf_counter()
+      hits, _ = fn()
+      seconds = time.perf_counter() - start
+      # Memory is measured on a second, traced run, since tracing slows everything down.
+      tracemalloc.start()
+      _, kept = fn()
+      kept_kb = tracemalloc.get_traced_memory()[0] / 1024
+      tracemalloc.stop()
+      del kept
+      report(f"archives ({name}, {hits} hits)", args.size, seconds, kept_kb)
+    if args.verbose:
+      print(f"  pickle {os.path.getsize(pickle_path)} bytes, "
+            f"compact {os.path.getsize(compact_path)} bytes")
+
+
+@benchmark("sheet_export")
+def bench_sheet_export(args) -> None:
+  """Builds the reconciliation sheet's rows for --size clusters, as they are uploaded."""
+  from lib.reconciliation_uploader import sheet_rows
+
+  all_clusters = make_clusters(args.size)
+  start = time.perf_counter()
+  rows = [row.to_row() for row in sheet_rows(all_clusters)]
+  report("sheet_export", args.size, time.perf_counter() - start)
+  if args.verbose:
+    print(f"  payload {len(json.dumps(rows, default=str))} bytes")
+
+
+@benchmark("sheet_upload")
+def bench_sheet_upload(args) -> None:
+  """
+  Uploads --size cluster rows to an in-memory sheet with modelled write times:
+  as one write, in parallel chunks with a transient failure every seventh
+  write, resuming an upload that failed halfway, and resuming one after a
+  different upload to the tab failed with its writes applied.
+  """
+  from lib import replay
+  from lib import sheet_upload
+  from lib.reconciliation_uploader import sheet_rows
+  from lib.sheet_upload import ChunkedSheetUpload
+
+  rows = sheet_rows(make_clusters(args.size))
+  other_rows = rows[::-1]
+  expected = [[replay._as_displayed(value) for value in row.to_row()] for row in rows]
+  num_chunks = (len(rows) + sheet_upload.DEFAULT_CHUNK_ROWS) // sheet_upload.DEFAULT_CHUNK_ROWS
+  # Retries back off for seconds; scale that down to the modelled write times.
+  real_retry_seconds = sheet_upload.CHUNK_RETRY_BASE_SECONDS
+  sheet_upload.CHUNK_RETRY_BASE_SECONDS = SHEETS_WRITE_SECONDS
+  runs = [
+      ("single write", dict(chunk_rows=len(rows) + 1, workers=1), [{}]),
+      ("chunked", {}, [dict(fail_every=7)]),
+      ("resumed", {}, [dict(max_writes=num_chunks // 2), {}]),
+      ("resumed after another upload", {}, [
+          dict(max_writes=num_chunks // 2),
+          dict(max_writes=0, lost_responses=True, rows=other_rows),
+          {},
+      ]),
+  ]
+  try:
+    for name, upload_args, attempts in runs:
+      progress = sys.stdout if args.verbose else io.StringIO()
+      with in_temp_dir(), contextlib.redirect_stdout(progress):
+        sheets = replay.FakeObjectsToSheet()
+        for service_args in attempts:
+          service_args = dict(service_args)
+          attempt_rows = service_args.pop("rows", rows)
+          service = replay.FakeSheetsService(sheets, SHEETS_WRITE_SECONDS, SHEETS_ROW_SECONDS,
+                                             **service_args)
+          upload = ChunkedSheetUpload(lambda: service, **upload_args)
+          start = time.perf_counter()
+          try:
+            upload.upload_to_sheet(attempt_rows, "bench", "Reconciliation v2")
+          except replay.FakeHttpError:
+            continue
+          seconds = time.perf_counter() - start
+      report(f"sheet_upload ({name}, {service.writes} writes)", args.size, seconds)
+      if sheets.tabs[("bench", "Reconciliation v2")][1] != expected:
+        raise Exception(f"The {name} upload left the sheet with the wrong rows")
+  finally:
+    sheet_upload.CHUNK_RETRY_BASE_SECONDS = real_retry_seconds
+
+
+@benchmark("tracking_keys")
+def bench_tracking_keys(args) -> None:
+  """Canonicalizes --size portal-shaped tracking numbers, cold and then memoized."""
+  from lib import synthetic
+  from lib import tracking_keys
+
+  raw = [synthetic.portal_tracking(index) for index in range(args.size)]
+  for name in ("cold", "memoized"):
+    start = time.perf_counter()
+    keys = [tracking_keys.canonical_tracking(tracking, "bench") for tracking in raw]
+    report(f"tracking_keys ({name})", args.size, time.perf_counter() - start)
+  if keys != [synthetic.tracking_number(index) for index in range(args.size)]:
+    raise Exception("Canonical keys don't match the tracking output's numbers")
+
+  # Portal entries whose trackings only differ in shape are combined, not overwritten.
+  tracking_to_po = {raw[0]: "PO1", raw[0].lower(): "PO2"}
+  trackings_cost = {(raw[0],): 1.5, (raw[0].lower(),): 2.0}
+  with contextlib.redirect_stdout(io.StringIO()):
+    tracking_to_po, trackings_cost, _ = tracking_keys.canonical_cost_maps(
+        "bench", tracking_to_po, trackings_cost, {})
+  if tracking_to_po != {keys[0]: "PO1"} or trackings_cost != {(keys[0],): 3.5}:
+    raise Exception("canonical_cost_maps doesn't combine colliding entries")
+
+
+@benchmark("imports")
+def bench_imports(args) -> None:
+  """Cold-start import cost of reconcile.py, as reported by `python -X importtime`."""
+  for module in ("reconcile", "lib.group_site_manager", "lib.order_info"):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output=True,
+                            text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    # lines look like "import time:       self |  cumulative | package"
+    # with nested imports indented under the package that imported them.
+    top_level = []
+    for line in result.stderr.splitlines():
+      if line.startswith("import time:") and "cumulative" not in line:
+        _, cumulative, package = line.split("|")
+        if not package.startswith("  "):
+          top_level.append((int(cumulative.strip()), package.strip()))
+    report("import " + module, 1, sum(t[0] for t in top_level) / 1e6)
+    if args.verbose:
+      for cumulative, package in sorted(top_level, reverse=True)[:10]:
+        print(f"    {package:<36} {cumulative / 1e3:10.1f} ms")
+
+
+def git_commit() -> str:
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          capture_output=True,
+                          text=True,
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return "unknown"
+
+
+def write_results(path) -> None:
+  folder = os.path.dirname(path)
+  if folder and not os.path.exists(folder):
+    os.makedirs(folder)
+  with open(path, 'w') as stream:
+    json.dump({"commit": git_commit(), "results": RESULTS}, stream, indent=2)
+  print(f"Wrote results to {path}")
+
+
+def compare_results(path) -> None:
+  with open(path) as stream:
+    baseline = json.load(stream)
+  previous = {(r["name"], r["size"]): r for r in baseline["results"]}
+  print(f"\nCompared with {baseline['commit']}:")
+  for result in RESULTS:
+    before = previous.get((result["name"], result["size"]))
+    if before and before["seconds"]:
+      print(f"{result['name']:<40} {before['seconds'] * 1000:10.1f} ms -> "
+            f"{result['seconds'] * 1000:10.1f} ms ({result['seconds'] / before['seconds']:.2f}x)")
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Reconciliation benchmarks')
+  parser.add_argument(
+      "benchmarks", nargs="*", help="benchmarks to run (default: all of %s)" % sorted(BENCHMARKS))
+  parser.add_argument("--size", type=int, default=100000, help="problem size for each benchmark")
+  parser.add_argument(
+      "--cold", action="store_true", help="start reconcile with an empty order cache")
+  parser.add_argument(
+      "--new-trackings",
+      type=int,
+      default=300,
+      help="trackings added between the full and incremental runs of reconcile_incremental")
+  parser.add_argument(
+      "--processes",
+      type=int,
+      default=os.cpu_count() or 1,
+      help="worker processes for sharded clustering (default: one per core)")
+  parser.add_argument(
+      "--mail-latency",
+      type=float,
+      default=0.02,
+      help="simulated seconds per mail round trip in order_lookups")
+  parser.add_argument(
+      "--memory", action="store_true", help="also trace memory growth per stage (slower)")
+  parser.add_argument(
+      "--verbose", "-v", action="store_true", help="print per-module details where available")
+  parser.add_argument("--output", help="where to write the JSON results "
+                      f"(default {BENCH_FOLDER}/<commit>.json)")
+  parser.add_argument("--compare", help="a previous JSON results file to compare against")
+  args = parser.parse_args()
+
+  for name in args.benchmarks or BENCHMARKS.keys():
+    BENCHMARKS[name](args)
+
+  write_results(args.output or os.path.join(BENCH_FOLDER, git_commit() + ".json"))
+  if args.compare:
+    compare_results(args.compare)
+
+
+if __name__ == "__main__":
+  main()
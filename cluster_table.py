@@ -0,0 +1,112 @@
+"""
+A columnar view of clusters for analysis and sorting over many of them at once.
+
+Costs, adjustments and flags live in NumPy arrays with one entry per cluster,
+groups are stored as integer codes and orders/trackings as tuples, so totals,
+sort orders and per-group statistics are single vectorized operations instead
+of Python loops over Cluster objects.
+
+It's a read-only view for analysis: it holds only the columns above, so there's
+no way back to Cluster objects. NumPy (see requirements.txt) is only needed by
+this module; the reconcile pipeline itself doesn't import it.
+"""
+
+import numpy as np
+from typing import Any, Dict, List
+
+
+class ClusterTable:
+
+  def __init__(self, groups: List[str], group_codes, orders, trackings, expected_cost,
+               tracked_cost, adjustment, manual_override, verified, below_cost,
+               last_ship_date) -> None:
+    self.groups = groups
+    self.group_codes = group_codes
+    self.orders = orders
+    self.trackings = trackings
+    self.expected_cost = expected_cost
+    self.tracked_cost = tracked_cost
+    self.adjustment = adjustment
+    self.manual_override = manual_override
+    self.verified = verified
+    self.below_cost = below_cost
+    self.last_ship_date = last_ship_date
+
+  @classmethod
+  def from_clusters(cls, all_clusters) -> "ClusterTable":
+    groups = sorted(set(cluster.group for cluster in all_clusters))
+    group_index = {group: code for code, group in enumerate(groups)}
+    size = len(all_clusters)
+
+    def column(attr, dtype):
+      return np.fromiter((getattr(cluster, attr) for cluster in all_clusters), dtype, size)
+
+    def id_column(attr):
+      result = np.empty(size, dtype=object)
+      result[:] = [tuple(sorted(getattr(cluster, attr))) for cluster in all_clusters]
+      return result
+
+    return cls(groups,
+               np.fromiter((group_index[c.group] for c in all_clusters), np.int32, size),
+               id_column("orders"),
+               id_column("trackings"),
+               column("expected_cost", np.float64),
+               column("tracked_cost", np.float64),
+               column("adjustment", np.float64),
+               column("manual_override", np.bool_),
+               column("verified", np.bool_),
+               column("below_cost", np.bool_),
+               np.array([str(c.last_ship_date) for c in all_clusters], dtype=str))
+
+  def __len__(self) -> int:
+    return len(self.group_codes)
+
+  def group_column(self) -> Any:
+    return np.array(self.groups, dtype=object)[self.group_codes]
+
+  def total_diff(self) -> Any:
+    """reconciliation_uploader.total_diff for every cluster."""
+    return np.where(self.manual_override, 0.0,
+                    self.tracked_cost + self.adjustment - self.expected_cost)
+
+  def sort_order(self) -> Any:
+    """
+    Row order for the reconciliation sheet: unverified before verified, then
+    not-below-cost before below-cost, then by total diff, largest first. This
+    is the order reconciliation_uploader.compare is after, as a stable key.
+    """
+    return np.lexsort((-self.total_diff(), self.below_cost, self.verified))
+
+  def take(self, indices) -> "ClusterTable":
+    return ClusterTable(self.groups, self.group_codes[indices], self.orders[indices],
+                        self.trackings[indices], self.expected_cost[indices],
+                        self.tracked_cost[indices], self.adjustment[indices],
+                        self.manual_override[indices], self.verified[indices],
+                        self.below_cost[indices], self.last_ship_date[indices])
+
+  def add_tracked_costs(self, rows, costs) -> None:
+    """Adds each cost to its row's tracked cost (rows may repeat), like fill_costs_new does."""
+    np.add.at(self.tracked_cost, np.asarray(rows, dtype=np.intp), np.asarray(costs, np.float64))
+
+  def summary(self) -> Dict[str, Any]:
+    """Overall and per-group counts and totals."""
+    diff = self.total_diff()
+    num_groups = len(self.groups)
+
+    def by_group(values=None):
+      sums = np.bincount(self.group_codes, weights=values, minlength=num_groups)
+      return dict(zip(self.groups, sums.tolist()))
+
+    return {
+        "clusters": len(self),
+        "expected_cost": float(self.expected_cost.sum()),
+        "tracked_cost": float(self.tracked_cost.sum()),
+        "adjustment": float(self.adjustment.sum()),
+        "total_diff": float(diff.sum()),
+        "underpaid": int((diff < 0).sum()),
+        "verified": int(self.verified.sum()),
+        "below_cost": int(self.below_cost.sum()),
+        "manual_override": int(self.manual_override.sum()),
+        "clusters_by_group": by_group(),
+        "total_diff_by_group": by_group(diff),
+    }
@@ -1,11 +1,23 @@
+import collections
 import pickle
 import os.path
-from lib.objects_to_drive import ObjectsToDrive
-from typing import Any, List
+from lib import instrumentation
+from lib.store import get_store, CLUSTERS_NAMESPACE
+from lib.tracking_keys import canonical_trackings, SHEET
+from typing import Any, List, Optional, Tuple
 
 OUTPUT_FOLDER = "output"
 CLUSTERS_FILENAME = "clusters.pickle"
 CLUSTERS_FILE = OUTPUT_FOLDER + "/" + CLUSTERS_FILENAME
+# Pickled as sorted lists, so an unchanged cluster pickles to the same bytes
+# whatever the hash seed (the store skips rewriting rows whose bytes match).
+SET_FIELDS = ("orders", "trackings", "purchase_orders", "email_ids", "non_reimbursed_trackings")
+
+# Total Diff (Amount Billed - Amount Reimbursed - Manual Cost Adjustment). Plain
+# cell references, unlike INDIRECT, only recalculate when those cells change.
+TOTAL_DIFF_FORMULA = "=D{row}-E{row}-K{row}"
+# For rows uploaded without their row number; INDEX isn't volatile either.
+TOTAL_DIFF_ANY_ROW_FORMULA = "=INDEX(D:D,ROW())-INDEX(E:E,ROW())-INDEX(K:K,ROW())"
 
 
 class Cluster:
@@ -49,7 +61,17 @@ class Cluster:
     self.below_cost = below_cost  
     self.verified = verified
 
+  def __getstate__(self) -> dict:
+    state = dict(self.__dict__)
+    for name in SET_FIELDS:
+      state[name] = sorted(state[name], key=str)
+    return state
+
   def __setstate__(self, state) -> None:
+    state = dict(state)
+    for name in SET_FIELDS:
+      if name in state:
+        state[name] = set(state[name])
     self._initiate(**state)
 
   def __str__(self) -> str:
@@ -65,14 +87,18 @@ class Cluster:
         "Manual Cost Adjustment", "Manual Override", "Total Diff", "Verified", "Notes", "Cancelled Items", "Below Cost"
     ]
 
-  def to_row(self) -> list:
+  def to_row(self, row_number: Optional[int] = None) -> list:
+    """The sheet row; `row_number` (1-based) lets Total Diff refer to its own cells directly."""
+    if row_number:
+      total_diff = TOTAL_DIFF_FORMULA.format(row=row_number)
+    else:
+      total_diff = TOTAL_DIFF_ANY_ROW_FORMULA
     return [
         ", ".join(self.orders), ", ".join(self.trackings), self.to_email, self.expected_cost,
         self.tracked_cost, ", ".join(self.non_reimbursed_trackings), self.last_ship_date,
         self.last_delivery_date, "'" + ", ".join(self.purchase_orders), self.group, self.adjustment,
-        self.manual_override,
-        '=INDIRECT(CONCAT("D", ROW())) - INDIRECT(CONCAT("E", ROW())) - INDIRECT(CONCAT("K", ROW()))',
-        self.verified, self.notes, ", ".join(self.cancelled_items), self.below_cost
+        self.manual_override, total_diff, self.verified, self.notes,
+        ", ".join(self.cancelled_items), self.below_cost
     ]
 
   def merge_with(self, other) -> None:
@@ -108,12 +134,15 @@ def find_cluster(all_clusters, tracking) -> Any:
   return None
 
 
-def update_clusters(all_clusters, trackings) -> None:
+def update_clusters(all_clusters, trackings) -> list:
+  """ Adds the trackings to their clusters, returning the clusters that were created or changed. """
+  touched = {}
   for tracking in trackings:
     cluster = find_cluster(all_clusters, tracking)
     if cluster is None:
       cluster = Cluster(tracking.group)
       all_clusters.append(cluster)
+    touched[id(cluster)] = cluster
 
     # If we are adding a new tracking or order ID, unset the manual override
     # status of the cluster.
@@ -133,11 +162,16 @@ def update_clusters(all_clusters, trackings) -> None:
     if override_overridden:
       print(f"Cluster {cluster.orders} manual override unset because of newly "
             "added trackings or orders.")
+  return list(touched.values())
 
 
 def merge_orders(clusters) -> list:
   """ Merges together orders that share a common purchase order or email ID. """
   print("Merging clusters by PO or email ID")
+  return _merge_until_stable(clusters)
+
+
+def _merge_until_stable(clusters) -> list:
   while True:
     prev_length = len(clusters)
     clusters = run_merge_iteration(clusters)
@@ -146,6 +180,147 @@ def merge_orders(clusters) -> list:
   return clusters
 
 
+# Sharded clustering: update_clusters and merge_orders split into independent
+# shards that run in worker processes. Both produce exactly what the
+# single-process versions would, in the same order.
+
+ShardTracking = collections.namedtuple(
+    "ShardTracking",
+    ["tracking_number", "group", "order_ids", "ship_date", "delivery_date", "to_email"])
+
+
+def shard_trackings(trackings) -> List[List[Tuple[int, ShardTracking]]]:
+  """
+  Splits the trackings into shards that update_clusters can process
+  independently, as (position, tracking) pairs. Trackings linked through
+  shared order IDs always land in the same shard, even across groups;
+  otherwise each group is a shard.
+  """
+  parent = {}
+
+  def find(order):
+    root = order
+    while parent[root] != root:
+      root = parent[root]
+    while parent[order] != root:
+      parent[order], order = root, parent[order]
+    return root
+
+  for tracking in trackings:
+    roots = []
+    for order in tracking.order_ids:
+      parent.setdefault(order, order)
+      roots.append(find(order))
+    for root in roots[1:]:
+      parent[find(root)] = find(roots[0])
+
+  component_groups = {}
+  shards = collections.OrderedDict()
+  for position, tracking in enumerate(trackings):
+    group = tracking.group
+    if tracking.order_ids:
+      # A component goes with the group of its first tracking.
+      group = component_groups.setdefault(find(tracking.order_ids[0]), group)
+    shard_tracking = ShardTracking(tracking.tracking_number, tracking.group,
+                                   list(tracking.order_ids), tracking.ship_date,
+                                   tracking.delivery_date, tracking.to_email)
+    shards.setdefault(group, []).append((position, shard_tracking))
+  return list(shards.values())
+
+
+def _update_clusters_shard(indexed_trackings) -> List[Tuple[int, Cluster]]:
+  shard_clusters = []
+  created = []
+  for position, tracking in indexed_trackings:
+    update_clusters(shard_clusters, [tracking])
+    if len(shard_clusters) > len(created):
+      created.append(position)
+  return list(zip(created, shard_clusters))
+
+
+def _merge_orders_shard(indexed_clusters) -> List[Tuple[int, Cluster]]:
+  positions = {id(cluster): position for position, cluster in indexed_clusters}
+  merged = _merge_until_stable([cluster for _, cluster in indexed_clusters])
+  return [(positions[id(cluster)], cluster) for cluster in merged]
+
+
+def _run_shards(worker, shards, processes) -> list:
+  """Runs the worker over each shard, returning the clusters of all shards by position."""
+  if processes > 1 and len(shards) > 1:
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(processes, len(shards))) as executor:
+      results = list(executor.map(worker, shards))
+  else:
+    results = [worker(shard) for shard in shards]
+  indexed = [item for result in results for item in result]
+  indexed.sort(key=lambda item: item[0])
+  return [cluster for _, cluster in indexed]
+
+
+def update_clusters_sharded(trackings, processes) -> list:
+  """Builds the clusters of the trackings from scratch, as update_clusters([], trackings) would."""
+  shards = shard_trackings(trackings)
+  instrumentation.count("clusters.shards", len(shards))
+  return _run_shards(_update_clusters_shard, shards, processes)
+
+
+def merge_orders_sharded(clusters, processes) -> list:
+  """
+  merge_orders, one shard per group: clusters only merge with clusters of
+  the same group, so groups never need to see each other.
+  """
+  print("Merging clusters by PO or email ID")
+  shards = collections.OrderedDict()
+  for position, cluster in enumerate(clusters):
+    shards.setdefault(cluster.group, []).append((position, cluster))
+  return _run_shards(_merge_orders_shard, list(shards.values()), processes)
+
+
+def merge_affected_orders(all_clusters, affected) -> Tuple[list, list]:
+  """
+  Like merge_orders, but only merges the affected clusters with clusters that
+  share a PO or email ID with them (transitively), leaving the rest untouched.
+  Returns the new list of all clusters and the affected clusters after merging.
+  """
+  print("Merging affected clusters by PO or email ID")
+  position = {id(cluster): i for i, cluster in enumerate(all_clusters)}
+  by_attr = collections.defaultdict(list)
+  for cluster in all_clusters:
+    for attr_key in _shared_attr_keys(cluster):
+      by_attr[attr_key].append(cluster)
+
+  merged_away = set()
+  result = {}
+  for cluster in affected:
+    if id(cluster) in merged_away or id(cluster) in result:
+      continue
+    component = {id(cluster): cluster}
+    frontier = [cluster]
+    while frontier:
+      for attr_key in _shared_attr_keys(frontier.pop()):
+        for candidate in by_attr[attr_key]:
+          if id(candidate) not in component:
+            component[id(candidate)] = candidate
+            frontier.append(candidate)
+
+    # As in merge_orders, the cluster that comes first absorbs the others.
+    members = sorted(component.values(), key=lambda c: position[id(c)])
+    survivor = members[0]
+    for other in members[1:]:
+      print(f'Merged orders {other.orders} and {survivor.orders} by common POs or emails')
+      survivor.merge_with(other)
+      merged_away.add(id(other))
+    result[id(survivor)] = survivor
+
+  remaining = [cluster for cluster in all_clusters if id(cluster) not in merged_away]
+  return remaining, list(result.values())
+
+
+def _shared_attr_keys(cluster) -> list:
+  return ([(cluster.group, 'po', po) for po in cluster.purchase_orders] +
+          [(cluster.group, 'email', email_id) for email_id in cluster.email_ids])
+
+
 def run_merge_iteration(clusters) -> list:
   result = []
   for cluster in clusters:
@@ -181,7 +356,7 @@ def from_row(header, row) -> Cluster:
     orders = set()
 
   if 'Trackings' in header:
-    trackings = set([t.strip() for t in str(row[header.index('Trackings')]).split(',')])
+    trackings = set(canonical_trackings(str(row[header.index('Trackings')]).split(','), SHEET))
   else:
     trackings = set()
 
@@ -191,8 +366,7 @@ def from_row(header, row) -> Cluster:
   tracked_cost = float(tracked_cost_str) if tracked_cost_str else 0.0
   non_reimbursed_str = str(
       row[header.index("Non-Reimbursed Trackings")]) if "Non-Reimbursed Trackings" in header else ""
-  non_reimbursed_trackings = set([t.strip() for t in non_reimbursed_str.split(',')
-                                 ]) if non_reimbursed_str else set()
+  non_reimbursed_trackings = set(canonical_trackings(non_reimbursed_str.split(','), SHEET))
   last_ship_date = row[header.index('Last Ship Date')] if 'Last Ship Date' in header else '0'
   last_delivery_date = row[header.index(
       'Last Delivery Date (Est.)')] if 'Last Delivery Date (Est.)' in header else ''
@@ -219,3 +393,33 @@ def from_row(header, row) -> Cluster:
                     email_ids, adjustment, to_email, notes, manual_override,
                     non_reimbursed_trackings, cancelled_items, last_delivery_date, below_cost, verified)
   return cluster
+
+
+def cluster_key(cluster) -> str:
+  """A stable key for a cluster's row in the store, derived from its orders and trackings."""
+  return ", ".join(sorted(cluster.orders)) + " | " + ", ".join(sorted(cluster.trackings))
+
+
+def write_clusters(config, clusters) -> None:
+  """Persists the clusters to the local store, writing only rows that were added or changed."""
+  store = get_store()
+  table = store.table(CLUSTERS_NAMESPACE)
+  table.replace_all({cluster_key(cluster): cluster for cluster in clusters})
+  store.mark_imported(table)
+
+
+def get_existing_clusters(config) -> list:
+  store = get_store()
+  table = store.table(CLUSTERS_NAMESPACE)
+  store.import_once(table, lambda: _load_legacy_clusters(config))
+  return list(table.load_all().values())
+
+
+def _load_legacy_clusters(config) -> dict:
+  from lib.objects_to_drive import ObjectsToDrive
+  objects_to_drive = instrumentation.instrument(ObjectsToDrive(), "drive")
+  legacy = objects_to_drive.load(config, CLUSTERS_FILENAME)
+  if not legacy and os.path.exists(CLUSTERS_FILE):
+    with open(CLUSTERS_FILE, 'rb') as stream:
+      legacy = pickle.load(stream)
+  return {cluster_key(cluster): cluster for cluster in legacy or []}
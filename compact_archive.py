@@ -0,0 +1,147 @@
+"""
+A compact, read-only, memory-mapped file format for the cost maps of archived
+(retired) Melul groups.
+
+Archives never change once written, so rather than unpickling them into dicts
+on every run, each is converted once into a file that is mapped into memory and
+queried by key. The file holds an open-addressing hash table for each kind of
+key (single tracking numbers, POs) pointing at the key's record, so a lookup
+reads a slot or two and one record: only the pages lookups touch are read.
+
+Layout (little-endian):
+
+  header   MAGIC, tracking table slots, PO table slots (powers of two)
+  tables   slots of (64-bit key hash, record offset + 1), 0 for an empty slot;
+           collisions probe the following slots
+  records  trackings entry: cost (float64), count (uint16), then each tracking
+           PO entry: cost (float64), the PO
+           (strings are a uint16 byte length followed by UTF-8)
+
+A trackings entry is indexed once under each of its trackings.
+"""
+
+import mmap
+import os
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+MAGIC = b"RCARCH02"
+HEADER = struct.Struct("<8sQQ")
+SLOT = struct.Struct("<QQ")
+COST = struct.Struct("<d")
+COST_AND_COUNT = struct.Struct("<dH")
+LENGTH = struct.Struct("<H")
+
+
+def key_hash(key: str) -> int:
+  data = key.encode("utf-8")
+  # Slots are picked by the low bits, so those come from the better-mixed CRC.
+  return zlib.adler32(data) << 32 | zlib.crc32(data)
+
+
+def _encode_string(value) -> bytes:
+  encoded = str(value).encode("utf-8")
+  return LENGTH.pack(len(encoded)) + encoded
+
+
+def _table(keys) -> bytearray:
+  """A hash table (at most half full) of (key hash, record offset) pairs."""
+  slots = 1
+  while slots < 2 * len(keys):
+    slots *= 2
+  table = bytearray(SLOT.size * slots)
+  for hash_value, offset in keys:
+    i = hash_value & (slots - 1)
+    while SLOT.unpack_from(table, SLOT.size * i)[1]:
+      i = (i + 1) & (slots - 1)
+    SLOT.pack_into(table, SLOT.size * i, hash_value, offset + 1)
+  return table
+
+
+class CompactArchive:
+
+  def __init__(self, path: str) -> None:
+    self.path = path
+    with open(path, 'rb') as stream:
+      self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.tracking_slots, self.po_slots = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC:
+      raise Exception(f"{path} is not a compact archive")
+    self.tracking_table = HEADER.size
+    self.po_table = self.tracking_table + SLOT.size * self.tracking_slots
+    self.records_start = self.po_table + SLOT.size * self.po_slots
+
+  @staticmethod
+  def write(path: str, trackings_cost: Dict[tuple, float], po_cost: Dict[str, float]) -> None:
+    """Writes the maps to `path` in the compact format (atomically)."""
+    records = bytearray()
+    tracking_keys = []
+    for trackings_tuple, cost in trackings_cost.items():
+      offset = len(records)
+      records += COST_AND_COUNT.pack(float(cost), len(trackings_tuple))
+      for tracking in trackings_tuple:
+        records += _encode_string(tracking)
+      tracking_keys.extend((key_hash(str(tracking)), offset) for tracking in set(trackings_tuple))
+    po_keys = []
+    for po, cost in po_cost.items():
+      po_keys.append((key_hash(str(po)), len(records)))
+      records += COST.pack(float(cost)) + _encode_string(po)
+    tracking_table = _table(tracking_keys)
+    po_table = _table(po_keys)
+
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as stream:
+      stream.write(
+          HEADER.pack(MAGIC, len(tracking_table) // SLOT.size, len(po_table) // SLOT.size))
+      stream.write(tracking_table)
+      stream.write(po_table)
+      stream.write(records)
+    os.replace(temp_path, path)
+
+  def _offsets(self, table, slots, key) -> List[int]:
+    """The positions of the records whose key hashes like `key`."""
+    wanted = key_hash(key)
+    result = []
+    i = wanted & (slots - 1)
+    while True:
+      hash_value, offset = SLOT.unpack_from(self.map, table + SLOT.size * i)
+      if not offset:
+        return result
+      if hash_value == wanted:
+        result.append(self.records_start + offset - 1)
+      i = (i + 1) & (slots - 1)
+
+  def _string_at(self, position) -> Tuple[str, int]:
+    (length,) = LENGTH.unpack_from(self.map, position)
+    start = position + LENGTH.size
+    return self.map[start:start + length].decode("utf-8"), start + length
+
+  def trackings_entries(self, tracking: str) -> List[Tuple[tuple, float]]:
+    """The (trackings tuple, cost) entries that include the tracking."""
+    result = []
+    for position in self._offsets(self.tracking_table, self.tracking_slots, tracking):
+      cost, count = COST_AND_COUNT.unpack_from(self.map, position)
+      position += COST_AND_COUNT.size
+      trackings = []
+      for _ in range(count):
+        value, position = self._string_at(position)
+        trackings.append(value)
+      # Different keys can share a hash, so check the tracking is really there.
+      if tracking in trackings:
+        result.append((tuple(trackings), cost))
+    return result
+
+  def po_cost(self, po: str) -> Optional[float]:
+    for position in self._offsets(self.po_table, self.po_slots, po):
+      (cost,) = COST.unpack_from(self.map, position)
+      value, _ = self._string_at(position + COST.size)
+      if value == po:
+        return cost
+    return None
+
+  def close(self) -> None:
+    self.map.close()
@@ -0,0 +1,199 @@
+"""
+A mail backend on the Gmail REST API, as an alternative to IMAP.
+
+It offers the same search/fetch/fetch_many methods as MailSearch, but fetches
+messages through batch requests: up to MAX_BATCH_SIZE `messages.get` calls
+(format=raw) per HTTP round trip, where IMAP needs a FETCH per message.
+Message IDs are returned in decimal, which is what IMAP reports as
+X-GM-MSGID, so email IDs match whichever backend found them.
+
+Configured with:
+
+  mailBackend: gmail_api
+  gmailApi:
+    tokenFile: gmail_token.json   # an authorized-user OAuth token with gmail.readonly
+
+The access token is refreshed whenever the API rejects it, so long runs
+outlive its hour-long lifetime.
+"""
+
+import base64
+import json
+import threading
+import time
+import uuid
+from lib import instrumentation
+from lib.mail_search import gmail_query
+from typing import Any, Callable, Dict, List, Tuple
+
+API_URL = "https://gmail.googleapis.com"
+MESSAGES_PATH = "/gmail/v1/users/me/messages"
+BATCH_PATH = "/batch/gmail/v1"
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+
+MAX_BATCH_SIZE = 100
+MAX_BATCH_ATTEMPTS = 4
+BATCH_RETRY_BASE_SECONDS = 1
+SEARCH_PAGE_SIZE = 500
+
+
+class GmailApiError(Exception):
+  pass
+
+
+def load_credentials(token_file) -> Any:
+  from google.oauth2.credentials import Credentials
+  credentials = Credentials.from_authorized_user_file(token_file, SCOPES)
+  if not credentials.valid:
+    refresh_credentials(credentials)
+  return credentials
+
+
+def refresh_credentials(credentials) -> None:
+  from google.auth.transport.requests import Request
+  credentials.refresh(Request())
+
+
+class GmailApiBackend:
+
+  def __init__(self,
+               access_token: str,
+               base_url: str = API_URL,
+               connections: int = 4,
+               credentials: Any = None) -> None:
+    """`credentials`, if given, are refreshed when the API rejects the access token."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    self.base_url = base_url.rstrip("/")
+    self.credentials = credentials
+    self.refresh_lock = threading.Lock()
+    self.session = requests.Session()
+    self.session.headers["Authorization"] = "Bearer " + access_token
+    adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  @classmethod
+  def from_config(cls, config, connections) -> "GmailApiBackend":
+    api_config = config['gmailApi']
+    base_url = api_config.get('baseUrl', API_URL)
+    if api_config.get('accessToken'):
+      return cls(api_config['accessToken'], base_url, connections)
+    credentials = load_credentials(api_config['tokenFile'])
+    return cls(credentials.token, base_url, connections, credentials)
+
+  def run(self, fn: Callable[["GmailApiBackend"], Any]) -> Any:
+    # HTTP requests are independent, so every thread can share the backend.
+    return fn(self)
+
+  def close(self) -> None:
+    self.session.close()
+
+  def _request(self, method, url, **kwargs) -> Any:
+    """Sends the request, refreshing the credentials and retrying once if the token has expired."""
+    authorization = self.session.headers["Authorization"]
+    response = self.session.request(method, url, **kwargs)
+    if response.status_code != 401 or self.credentials is None:
+      return response
+    with self.refresh_lock:
+      # Another thread may have refreshed the token while this request was out.
+      if self.session.headers["Authorization"] == authorization:
+        print("Gmail API access token expired, refreshing it")
+        instrumentation.count("gmail_api.token_refreshes")
+        refresh_credentials(self.credentials)
+        self.session.headers["Authorization"] = "Bearer " + self.credentials.token
+    return self.session.request(method, url, **kwargs)
+
+  def search(self, **terms) -> List[str]:
+    """The IDs of the messages matching the terms (see MailSearch.criteria), oldest first."""
+    instrumentation.count("mail_search.gmail_api.calls")
+    params = {"q": gmail_query(**terms), "maxResults": SEARCH_PAGE_SIZE}
+    result = []
+    while True:
+      with instrumentation.span("gmail_api.search"):
+        response = self._request("GET", self.base_url + MESSAGES_PATH, params=params)
+      if response.status_code != 200:
+        raise GmailApiError(f"Search failed with HTTP {response.status_code}: {response.text}")
+      body = response.json()
+      result.extend(message['id'] for message in body.get('messages', []))
+      if not body.get('nextPageToken'):
+        break
+      params['pageToken'] = body['nextPageToken']
+    # The API lists newest first; IMAP searches (and their callers) go oldest first.
+    result.reverse()
+    return result
+
+  def fetch(self, message_id) -> Tuple[str, Any]:
+    return self.fetch_many([message_id])[message_id]
+
+  def fetch_many(self, message_ids) -> Dict[str, Tuple[str, Any]]:
+    """
+    The messages by ID, each as (stable ID, IMAP-style FETCH data), fetched
+    MAX_BATCH_SIZE per request. Items the batch rejects (e.g. rate limited)
+    are retried with backoff.
+    """
+    result = {}
+    pending = list(dict.fromkeys(message_ids))
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+      if attempt:
+        time.sleep(BATCH_RETRY_BASE_SECONDS * 2**(attempt - 1))
+      failed = []
+      for start in range(0, len(pending), MAX_BATCH_SIZE):
+        chunk = pending[start:start + MAX_BATCH_SIZE]
+        messages = self._get_batch(chunk)
+        result.update(messages)
+        failed.extend(message_id for message_id in chunk if message_id not in messages)
+      if not failed:
+        return result
+      instrumentation.count("gmail_api.retried", len(failed))
+      pending = failed
+    raise GmailApiError(f"Could not fetch {len(pending)} messages, e.g. {pending[0]}")
+
+  def _get_batch(self, message_ids) -> Dict[str, Tuple[str, Any]]:
+    boundary = "batch_" + uuid.uuid4().hex
+    parts = []
+    for i, message_id in enumerate(message_ids):
+      parts.append(f"--{boundary}\r\n"
+                   "Content-Type: application/http\r\n"
+                   f"Content-ID: <item{i}>\r\n\r\n"
+                   f"GET {MESSAGES_PATH}/{message_id}?format=raw\r\n\r\n")
+    parts.append(f"--{boundary}--\r\n")
+    with instrumentation.span("gmail_api.batch", messages=len(message_ids)):
+      response = self._request(
+          "POST",
+          self.base_url + BATCH_PATH,
+          data="".join(parts).encode("utf-8"),
+          headers={"Content-Type": f"multipart/mixed; boundary={boundary}"})
+    if response.status_code != 200:
+      raise GmailApiError(f"Batch failed with HTTP {response.status_code}: {response.text}")
+    instrumentation.count("gmail_api.bytes", len(response.content))
+
+    result = {}
+    for status, body in parse_batch_response(response.headers["Content-Type"], response.content):
+      if status != 200:
+        continue
+      message = json.loads(body)
+      raw = base64.urlsafe_b64decode(message['raw'] + "=" * (-len(message['raw']) % 4))
+      stable_id = str(int(message['id'], 16))
+      header = b"%s (X-GM-MSGID %s RFC822 {%d}" % (message['id'].encode(), stable_id.encode(),
+                                                   len(raw))
+      result[message['id']] = (stable_id, [(header, raw), b")"])
+    return result
+
+
+def parse_batch_response(content_type, content: bytes) -> List[Tuple[int, bytes]]:
+  """The (HTTP status, body) of each part of a multipart/mixed batch response."""
+  boundary = content_type.split("boundary=", 1)[1].strip().strip('"').encode()
+  result = []
+  for part in content.split(b"--" + boundary):
+    part = part.strip()
+    if not part or part == b"--":
+      continue
+    # Each part holds MIME headers, then an embedded HTTP response with its own headers.
+    sections = part.replace(b"\r\n", b"\n").split(b"\n\n", 2)
+    if len(sections) < 3:
+      continue
+    status_line = sections[1].split(b"\n", 1)[0]
+    status = int(status_line.split()[1])
+    result.append((status, sections[2].strip()))
+  return result
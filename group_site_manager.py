@@ -1,23 +1,26 @@
-import aiohttp
-import asyncio
 import collections
+import copy
 import email
+import os.path
 import quopri
 import re
-import requests
 import sys
+import threading
 import time
 import traceback
-import lib.email_auth as email_auth
+from lib import instrumentation
+from lib import portal_api
 from lib import util
-from bs4 import BeautifulSoup
-from lib.archive_manager import ArchiveManager
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.support.ui import Select
-from tqdm import tqdm
+from lib.compact_archive import CompactArchive
+from lib.mail_backend import open_mail_backend
+from lib.store import get_sessions_store, BROWSER_COOKIES_NAMESPACE
+from lib.tracking_keys import canonical_cost_maps, canonical_tracking, canonical_trackings
+from lib.upload_ledger import UploadLedger, confirm_from_maps
 from typing import Any, Dict
 
+# selenium, requests, aiohttp, asyncio, BeautifulSoup and tqdm are imported inside the
+# portal handlers that use them, so a run only pays for the portals it touches.
+
 LOGIN_EMAIL_FIELD = "fldEmail"
 LOGIN_PASSWORD_FIELD = "fldPassword"
 LOGIN_BUTTON_SELECTOR = "//button[contains(text(), 'Login')]"
@@ -42,6 +45,64 @@ USA_API_TRACKINGS_URL = "https://api.usabuying.group/index.php/buyers/trackings"
 YRCW_URL = "https://app.yrcwtech.com/"
 
 MAX_UPLOAD_ATTEMPTS = 10
+MAX_CONCURRENT_UPLOADS = 4
+UPLOAD_RETRY_BASE_SECONDS = 5
+UPLOAD_RETRY_MAX_SECONDS = 300
+
+# Interactive logins need a person at the keyboard, so concurrent uploads take turns.
+_interactive_login_lock = threading.Lock()
+
+BFMR_BATCH_SIZE = 30
+
+# Archived groups' cost maps, converted to the compact format on first use.
+ARCHIVES_FOLDER = "output/archives"
+# Versioned, since files of an earlier version are keyed differently: v2 keys are canonical
+# trackings (see tracking_keys).
+ARCHIVE_SUFFIX = ".v2.archive"
+
+# Sets a textarea's value through the native setter (so React-style wrappers
+# notice the change) and fires the events Angular and React listen for.
+BULK_INPUT_SCRIPT = """
+var element = arguments[0];
+var setter = Object.getOwnPropertyDescriptor(HTMLTextAreaElement.prototype, 'value').set;
+setter.call(element, arguments[1]);
+element.dispatchEvent(new Event('input', {bubbles: true}));
+element.dispatchEvent(new Event('change', {bubbles: true}));
+element.dispatchEvent(new Event('blur', {bubbles: true}));
+"""
+
+
+def upload_retry_delay(attempt: int) -> float:
+  """Seconds to wait before the given retry (1 for the first), doubling up to a cap."""
+  return min(UPLOAD_RETRY_BASE_SECONDS * 2**(attempt - 1), UPLOAD_RETRY_MAX_SECONDS)
+
+
+class UploadResult:
+  """How one group's upload went."""
+
+  def __init__(self, group, uploaded, skipped) -> None:
+    self.group = group
+    self.uploaded = uploaded
+    self.skipped = skipped
+    self.attempts = 0
+    self.seconds = 0.0
+    self.error = None
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+  def __str__(self) -> str:
+    if not self.ok:
+      return (f"{self.group}: FAILED after {MAX_UPLOAD_ATTEMPTS} attempts ({self.seconds:.1f}s): "
+              f"{self.error.__cause__ or self.error}")
+    if not self.uploaded:
+      return f"{self.group}: nothing new ({self.skipped} already uploaded)"
+    return (f"{self.group}: uploaded {self.uploaded} ({self.skipped} skipped) in "
+            f"{self.seconds:.1f}s, {self.attempts} attempt(s), "
+            f"{self.uploaded / max(self.seconds, 1e-3):.1f} trackings/s")
+
+  __repr__ = __str__
 
 
 class GroupSiteManager:
@@ -50,7 +111,43 @@ class GroupSiteManager:
     self.config = config
     self.driver_creator = driver_creator
     self.melul_portal_groups = config['melulPortals']
-    self.archive_manager = ArchiveManager(config)
+    self._archive_manager = None
+    # Groups whose portal loads carry on in the background (see forbid_login_prompts),
+    # and groups prompting for a login right now.
+    self.no_prompt_groups = set()
+    self.prompting_groups = set()
+    self.prompt_lock = threading.Lock()
+
+  @property
+  def archive_manager(self) -> Any:
+    if self._archive_manager is None:
+      from lib.archive_manager import ArchiveManager
+      self._archive_manager = ArchiveManager(self.config)
+    return self._archive_manager
+
+  def get_archives(self, group) -> list:
+    """
+    The group's archives (of its retired Melul portals) as CompactArchives,
+    scraping and archiving any that haven't been yet, and converting each from
+    the ArchiveManager's format the first time it's used.
+    """
+    group_config = self.config['groups'].get(group, {})
+    result = []
+    for archive_group in group_config.get('archives', []):
+      path = os.path.join(ARCHIVES_FOLDER, archive_group + ARCHIVE_SUFFIX)
+      if not os.path.exists(path):
+        print(f"Loading archive {archive_group}")
+        if not self.archive_manager.has_archive(archive_group):
+          archive_tracking_to_po, archive_po_cost, archive_trackings_cost = self._melul_get_tracking_pos_costs_maps(
+              archive_group, group_config['username'], group_config['password'])
+          self.archive_manager.put_archive(archive_group, archive_po_cost, archive_trackings_cost,
+                                           archive_tracking_to_po)
+        archive_po_cost, archive_trackings_cost = self.archive_manager.get_archive(archive_group)
+        _, archive_trackings_cost, archive_po_cost = canonical_cost_maps(
+            group, {}, archive_trackings_cost, archive_po_cost)
+        CompactArchive.write(path, archive_trackings_cost, archive_po_cost)
+      result.append(CompactArchive(path))
+    return result
 
   def get_tracked_groups(self):
     result = set(self.melul_portal_groups)
@@ -59,22 +156,63 @@ class GroupSiteManager:
     result.add('yrcw')
     return result
 
-  def upload(self, trackings) -> None:
+  def upload(self, trackings) -> Dict[str, "UploadResult"]:
+    """
+    Uploads new trackings to their groups' portals, several groups at a time,
+    and returns each group's result. A failing group doesn't stop the others.
+    """
+    from concurrent.futures import ThreadPoolExecutor
     groups_dict = collections.defaultdict(list)
     for tracking in trackings:
       groups_dict[tracking.group].append(tracking)
 
+    pending = {}
+    results = {}
     for group, trackings in groups_dict.items():
-      numbers = [tracking.tracking_number for tracking in trackings]
       group_config = self.config['groups'][group]
       if group_config.get('password') and group_config.get('username'):
-        self._upload_to_group(numbers, group)
+        ledger = UploadLedger(group)
+        numbers = ledger.new_numbers(tracking.tracking_number for tracking in trackings)
+        result = UploadResult(group, len(numbers), len(trackings) - len(numbers))
+        results[group] = result
+        if numbers:
+          pending[group] = numbers
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+      futures = {
+          group: executor.submit(self._upload_group, results[group], numbers)
+          for group, numbers in pending.items()
+      }
+      for group, future in futures.items():
+        future.result()
+        if results[group].ok:
+          UploadLedger(group).record_submitted(pending[group])
+
+    for result in results.values():
+      print(result)
+    return results
+
+  def _upload_group(self, result, numbers) -> None:
+    group = result.group
+    start = time.time()
+    with instrumentation.span("upload." + group, trackings=len(numbers)):
+      try:
+        result.attempts = self._upload_to_group(numbers, group)
+      except Exception as e:
+        result.error = e
+    result.seconds = time.time() - start
+    if result.ok:
+      instrumentation.count(f"upload.{group}.trackings", len(numbers))
 
   def get_new_tracking_pos_costs_maps_with_retry(self, group):
     last_exc = None
     for i in range(5):
       try:
-        return self.get_new_tracking_pos_costs_maps(group)
+        tracking_to_po, trackings_cost, po_cost = canonical_cost_maps(
+            group, *self.get_new_tracking_pos_costs_maps(group))
+        # Anything the portal lists has been uploaded, whoever uploaded it.
+        confirm_from_maps(group, tracking_to_po, trackings_cost)
+        return tracking_to_po, trackings_cost, po_cost
       except Exception as e:
         print(f"Received exception when getting costs: {str(e)}\n{util.get_traceback_lines()}\n"
               "Retrying up to five times.")
@@ -97,22 +235,11 @@ class GroupSiteManager:
       password = group_config['password']
       tracking_to_po, po_cost, trackings_cost = self._melul_get_tracking_pos_costs_maps(
           group, username, password)
-
-      if 'archives' in group_config:
-        for archive_group in group_config['archives']:
-          print(f"Loading archive {archive_group}")
-          if not self.archive_manager.has_archive(archive_group):
-            archive_tracking_to_po, archive_po_cost, archive_trackings_cost = self._melul_get_tracking_pos_costs_maps(
-                archive_group, username, password)
-            self.archive_manager.put_archive(archive_group, archive_po_cost, archive_trackings_cost,archive_tracking_to_po)
-
-          archive_po_cost, archive_trackings_cost = self.archive_manager.get_archive(archive_group)
-          po_cost.update(archive_po_cost)
-          trackings_cost.update(archive_trackings_cost)
-
+      # The group's archives aren't merged in here; reconcile queries them (see get_archives).
       return tracking_to_po,trackings_cost, po_cost
     elif group == "usa":
       print("Loading group usa")
+      import asyncio
       return asyncio.run(self._get_usa_tracking_pos_prices())
     elif group == "yrcw":
       print("Loading yrcw")
@@ -121,51 +248,78 @@ class GroupSiteManager:
 
   # returns ((trackings) -> cost, po -> cost) maps
   def _get_yrcw_tracking_pos_prices(self):
-    tracking_cost_map = collections.defaultdict(float)
-    po_cost_map = collections.defaultdict(float)
-    tracking_to_po_map = collections.defaultdict(int)
     driver = self._login_yrcw()
     try:
-      time.sleep(5)  # it can take a bit to load
+      api_config = self.config['groups']['yrcw'].get('trackingsApi')
+      if api_config:
+        try:
+          return self._fetch_yrcw_tracking_pos_prices(driver, api_config)
+        except Exception as e:
+          print(f"Could not load yrcw trackings from the JSON endpoint, scraping the page instead: {e}")
+          instrumentation.count("portal_api.fallback")
+      return self._scrape_yrcw_tracking_pos_prices(driver)
+    finally:
+      driver.quit()
 
-      # show all trackings, not just non-paid
-      driver.find_element_by_css_selector('button[title="Filters"]').click()
-      time.sleep(2)
-      driver.find_element_by_css_selector('div.modal-body button.ButtonLink').click()
-      select = Select(driver.find_element_by_tag_name('select'))
-      select.select_by_visible_text('Any')
+  def _new_yrcw_maps(self):
+    return collections.defaultdict(int), collections.defaultdict(
+        float), collections.defaultdict(float)
+
+  def _add_yrcw_tracking(self, maps, tracking, value) -> None:
+    tracking_to_po_map, tracking_cost_map, po_cost_map = maps
+    # USPS labels come with their barcode's routing prefix, which this drops.
+    tracking = canonical_tracking(tracking, "yrcw")
+    value = float(value.replace('$', '').replace(',', ''))
+    tracking_cost_map[(tracking,)] += value
+    po_cost_map[tracking] += value
+
+  def _fetch_yrcw_tracking_pos_prices(self, driver, api_config):
+    table = portal_api.JsonTable.from_config(api_config, portal_api.YRCW_TRACKING_FIELDS)
+    maps = self._new_yrcw_maps()
+    for item in portal_api.fetch_all(table, driver):
+      tracking = str(table.field(item, 'tracking') or '').strip()
+      # Like the rows the table view leaves out, entries without a tracking are skipped.
+      if tracking:
+        self._add_yrcw_tracking(maps, tracking, str(table.field(item, 'value') or 0))
+    return maps
+
+  def _scrape_yrcw_tracking_pos_prices(self, driver):
+    from selenium.webdriver.support.ui import Select
+    maps = self._new_yrcw_maps()
+    time.sleep(5)  # it can take a bit to load
+
+    # show all trackings, not just non-paid
+    driver.find_element_by_css_selector('button[title="Filters"]').click()
+    time.sleep(2)
+    driver.find_element_by_css_selector('div.modal-body button.ButtonLink').click()
+    select = Select(driver.find_element_by_tag_name('select'))
+    select.select_by_visible_text('Any')
 
-      driver.find_element_by_css_selector('div.modal-footer .btn-primary').click()
-      time.sleep(2)
+    driver.find_element_by_css_selector('div.modal-footer .btn-primary').click()
+    time.sleep(2)
 
-      # next load the actual data
-      nav_home = driver.find_element_by_id('nav-home')
-      table = nav_home.find_element_by_tag_name('table')
-      body = table.find_element_by_tag_name('tbody')
-      rows = body.find_elements_by_tag_name('tr')
-      for row in rows:
-        tds = row.find_elements_by_tag_name('td')
-        if len(tds) > 1:  # there's a ghost <tr> at the end
-          tracking = tds[1].text.upper().strip()
-          # Something screwy is going on here with USPS labels.
-          # Strip the first 8 chars
-          if len(tracking) == 30:
-            tracking = tracking[8:]
-          value = float(tds[4].text.replace('$', '').replace(',', ''))
-          tracking_cost_map[(tracking,)] += value
-          po_cost_map[tracking] += value
-    finally:
-      driver.quit()
-    return tracking_to_po_map, tracking_cost_map, po_cost_map
+    # next load the actual data
+    nav_home = driver.find_element_by_id('nav-home')
+    table = nav_home.find_element_by_tag_name('table')
+    body = table.find_element_by_tag_name('tbody')
+    rows = body.find_elements_by_tag_name('tr')
+    for row in rows:
+      tds = row.find_elements_by_tag_name('td')
+      if len(tds) > 1:  # there's a ghost <tr> at the end
+        self._add_yrcw_tracking(maps, tds[1].text, tds[4].text)
+    return maps
 
   def _get_usa_login_headers(self):
+    import requests
     group_config = self.config['groups']['usa']
     creds = {"credentials": group_config['username'], "password": group_config['password']}
-    response = requests.post(url=USA_API_LOGIN_URL, data=creds)
+    with instrumentation.span("usa_api.login"):
+      response = requests.post(url=USA_API_LOGIN_URL, data=creds)
     token = response.json()['data']['token']
     return {"Authorization": f"Bearer {token}"}
 
   def _get_usa_tracking_entries(self, headers):
+    import requests
     result = []
     start = 0
     params = {
@@ -178,7 +332,9 @@ class GroupSiteManager:
     }
     while True:
       params['start'] = start
-      json_result = requests.get(url=USA_API_TRACKINGS_URL, headers=headers, params=params).json()
+      with instrumentation.span("usa_api.trackings_page"):
+        json_result = requests.get(url=USA_API_TRACKINGS_URL, headers=headers,
+                                   params=params).json()
       total_items = json_result['totals']['items']
       result.extend(json_result['data'])
       start += 100
@@ -188,6 +344,7 @@ class GroupSiteManager:
 
   async def _retrieve_usa_tracking_price(self, tracking_number, session, tracking_tuples_to_prices):
     try:
+      instrumentation.count("usa_api.tracking.calls")
       response = await session.request(
           method="GET", url=f"{USA_API_TRACKINGS_URL}/{tracking_number}")
       response.raise_for_status()
@@ -199,6 +356,8 @@ class GroupSiteManager:
       print(e)
 
   async def _get_usa_tracking_pos_prices(self):
+    import aiohttp
+    import asyncio
     headers = self._get_usa_login_headers()
     pos_to_prices = {}
     all_entries = self._get_usa_tracking_entries(headers)
@@ -217,6 +376,7 @@ class GroupSiteManager:
       return tracking_to_po, tracking_tuples_to_prices, pos_to_prices
 
   def _upload_usa(self, numbers) -> None:
+    import requests
     headers = self._get_usa_login_headers()
     data = {"trackings": ",".join(numbers)}
     requests.post(url=USA_API_TRACKINGS_URL, headers=headers, data=data)
@@ -225,95 +385,140 @@ class GroupSiteManager:
   def _melul_get_tracking_pos_costs_maps(self, group, username, password):
     driver = self._login_melul(group, username, password)
     try:
-      self._load_page(driver, RECEIPTS_URL_FORMAT % group)
-      tracking_to_po_map = {}
-      po_to_cost_map = {}
-      trackings_to_cost_map = {}
-
-      # Clear the search field since it can cache results
-      search_button = driver.find_element_by_class_name('pf-search-button')
-      search_button.click()
-      time.sleep(1)
-      driver.find_element_by_xpath('//button[@title="Clear filters"]').click()
-      time.sleep(1)
-      driver.find_element_by_xpath('//md-icon[text()="last_page"]').click()
-      time.sleep(4)
-
-      # go to the first page (page selection can get a bit messed up with the multiple sites)
-      # use a list to avoid throwing an exception (don't fail if there's only one page)
-      first_page_buttons = driver.find_elements_by_xpath(
-          "//button[@ng-click='$pagination.first()']")
-      if first_page_buttons:
-        first_page_buttons[0].click()
-        time.sleep(4)
-
-      with tqdm(desc=f"Fetching {group} check-ins", unit='page') as pbar:
-        while True:
-          table = driver.find_element_by_xpath("//tbody[@class='md-body']")
-          rows = table.find_elements_by_tag_name('tr')
-          for row in rows:
-            tds = row.find_elements_by_tag_name('td')
-            verified_checkbox = tds[4].find_element_by_tag_name('md-checkbox')
-            verified = 'md-checked' in verified_checkbox.get_attribute('class')
-            po = str(tds[5].text)
-            cost = tds[13].text.replace('$', '').replace(',', '')
-            trackings = tds[14].text.replace('-', '').split(",")
-
-            if trackings:
-              trackings = [tracking.strip() for tracking in trackings if tracking]
-              if cost:
-                trackings_to_cost_map[tuple(trackings)] = float(cost) if verified else 0.0
-              for tracking in trackings:
-                tracking_to_po_map[tracking] = po
-            if cost and po:
-              po_to_cost_map[po] = float(cost)
-
-          next_page_buttons = driver.find_elements_by_xpath(
-              "//button[@ng-click='$pagination.next()']")
-          if next_page_buttons and next_page_buttons[0].get_property("disabled") == False:
-            next_page_buttons[0].click()
-            time.sleep(3)
-            pbar.update()
-          else:
-            break
-
-        return (tracking_to_po_map, po_to_cost_map, trackings_to_cost_map)
+      api_config = self.config.get('melulReceiptsApi')
+      if api_config:
+        try:
+          return self._melul_fetch_tracking_pos_costs_maps(group, driver, api_config)
+        except Exception as e:
+          print(f"Could not load {group} receipts from the JSON endpoint, scraping the page instead: {e}")
+          instrumentation.count("portal_api.fallback")
+      return self._melul_scrape_tracking_pos_costs_maps(group, driver)
     finally:
       driver.quit()
 
-  def _upload_to_group(self, numbers, group) -> None:
+  def _add_melul_receipt(self, group, maps, po, cost, trackings, verified) -> None:
+    """Adds one receipts row; cost is as displayed (e.g. "$1,234.50")."""
+    tracking_to_po_map, po_to_cost_map, trackings_to_cost_map = maps
+    cost = cost.replace('$', '').replace(',', '')
+    trackings = canonical_trackings(trackings, group)
+    if trackings:
+      if cost:
+        trackings_to_cost_map[trackings] = float(cost) if verified else 0.0
+      for tracking in trackings:
+        tracking_to_po_map[tracking] = po
+    if cost and po:
+      po_to_cost_map[po] = float(cost)
+
+  def _melul_fetch_tracking_pos_costs_maps(self, group, driver, api_config):
+    table = portal_api.JsonTable.from_config(api_config, portal_api.MELUL_RECEIPT_FIELDS, group)
+    maps = ({}, {}, {})
+    for item in portal_api.fetch_all(table, driver):
+      trackings = table.field(item, 'trackings') or []
+      if isinstance(trackings, str):
+        trackings = trackings.split(",")
+      cost = table.field(item, 'cost')
+      self._add_melul_receipt(group, maps, str(table.field(item, 'po') or ''),
+                              str(cost) if cost is not None else '', trackings,
+                              table.flag(item, 'verified'))
+    return maps
+
+  def _melul_scrape_tracking_pos_costs_maps(self, group, driver):
+    from tqdm import tqdm
+    self._load_page(driver, RECEIPTS_URL_FORMAT % group)
+    maps = ({}, {}, {})
+
+    # Clear the search field since it can cache results
+    search_button = driver.find_element_by_class_name('pf-search-button')
+    search_button.click()
+    time.sleep(1)
+    driver.find_element_by_xpath('//button[@title="Clear filters"]').click()
+    time.sleep(1)
+    driver.find_element_by_xpath('//md-icon[text()="last_page"]').click()
+    time.sleep(4)
+
+    # go to the first page (page selection can get a bit messed up with the multiple sites)
+    # use a list to avoid throwing an exception (don't fail if there's only one page)
+    first_page_buttons = driver.find_elements_by_xpath("//button[@ng-click='$pagination.first()']")
+    if first_page_buttons:
+      first_page_buttons[0].click()
+      time.sleep(4)
+
+    with tqdm(desc=f"Fetching {group} check-ins", unit='page') as pbar:
+      while True:
+        table = driver.find_element_by_xpath("//tbody[@class='md-body']")
+        rows = table.find_elements_by_tag_name('tr')
+        for row in rows:
+          tds = row.find_elements_by_tag_name('td')
+          verified_checkbox = tds[4].find_element_by_tag_name('md-checkbox')
+          verified = 'md-checked' in verified_checkbox.get_attribute('class')
+          self._add_melul_receipt(group, maps, str(tds[5].text), tds[13].text,
+                                  tds[14].text.split(","), verified)
+
+        next_page_buttons = driver.find_elements_by_xpath(
+            "//button[@ng-click='$pagination.next()']")
+        if next_page_buttons and next_page_buttons[0].get_property("disabled") == False:
+          next_page_buttons[0].click()
+          time.sleep(3)
+          pbar.update()
+        else:
+          break
+
+    return maps
+
+  def _upload_to_group(self, numbers, group) -> int:
+    """Uploads the numbers, retrying with backoff. Returns the attempts it took."""
     last_ex = None
     for attempt in range(MAX_UPLOAD_ATTEMPTS):
+      if attempt:
+        time.sleep(upload_retry_delay(attempt))
       try:
         if group in self.melul_portal_groups:
           username = self.config['groups'][group]['username']
           password = self.config['groups'][group]['password']
-          return self._upload_melul(numbers, group, username, password)
+          self._upload_melul(numbers, group, username, password)
         elif group == "usa":
-          return self._upload_usa(numbers)
+          self._upload_usa(numbers)
         elif group == "yrcw":
-          return self._upload_yrcw(numbers)
+          self._upload_yrcw(numbers)
         elif group == "bfmr":
-          return self._upload_bfmr(numbers)
+          self._upload_bfmr(numbers)
         else:
           raise Exception("Unknown group: " + group)
+        return attempt + 1
       except Exception as e:
         last_ex = e
-        print("Received exception when uploading: " + str(e))
+        print(f"Received exception when uploading to {group}: " + str(e))
         traceback.print_exc(file=sys.stdout)
     raise Exception("Exceeded retry limit") from last_ex
 
+  def _new_driver(self, no_headless=None) -> Any:
+    """A new WebDriver; `no_headless` overrides the --no-headless flag for this driver only."""
+    driver_creator = self.driver_creator
+    if no_headless is not None and driver_creator.args.no_headless != no_headless:
+      # Other threads create drivers from the shared creator, so this one gets its own args.
+      driver_creator = copy.copy(driver_creator)
+      driver_creator.args = copy.copy(driver_creator.args)
+      driver_creator.args.no_headless = no_headless
+    return instrumentation.instrument(driver_creator.new(), "webdriver")
+
   def _load_page(self, driver, url) -> None:
     driver.get(url)
     time.sleep(3)
 
-  def _upload_bfmr(self, numbers) -> None:
-    for batch in util.chunks(numbers, 30):
-      self._upload_bfmr_batch(batch)
+  def _fill_textarea(self, driver, textarea, text) -> None:
+    """
+    Sets the textarea's value in one go and fires the input/change events the
+    page's framework listens for, instead of typing it a key at a time.
+    """
+    driver.execute_script(BULK_INPUT_SCRIPT, textarea, text)
+    if textarea.get_property("value") != text:
+      # The page didn't take the value; fall back to typing it.
+      driver.execute_script("arguments[0].value = '';", textarea)
+      textarea.send_keys(text)
 
-  def _upload_bfmr_batch(self, numbers) -> None:
+  def _upload_bfmr(self, numbers) -> None:
     group_config = self.config['groups']['bfmr']
-    driver = self.driver_creator.new()
+    driver = self._new_driver()
     try:
       # load the login page first
       self._load_page(driver, "https://buyformeretail.com/login")
@@ -323,37 +528,51 @@ class GroupSiteManager:
 
       time.sleep(2)
 
-      # hope there's a button to submit tracking numbers -- it doesn't matter which one
-      try:
-        submit_button = driver.find_element_by_xpath("//button[text() = \"Submit tracking #'s\"]")
-        submit_button.click()
-      except NoSuchElementException:
-        raise Exception(
-            "Could not find submit-trackings button. Make sure that you've subscribed to a deal and that the login credentials are correct"
-        )
+      # The form takes at most BFMR_BATCH_SIZE numbers per submission, but the
+      # same session can submit any number of batches.
+      for batch in util.chunks(numbers, BFMR_BATCH_SIZE):
+        self._upload_bfmr_batch(driver, batch)
+    finally:
+      driver.quit()
 
-      time.sleep(2)
+  def _upload_bfmr_batch(self, driver, numbers) -> None:
+    from selenium.common.exceptions import NoSuchElementException
+    # hope there's a button to submit tracking numbers -- it doesn't matter which one
+    try:
+      submit_button = driver.find_element_by_xpath("//button[text() = \"Submit tracking #'s\"]")
+      submit_button.click()
+    except NoSuchElementException:
+      raise Exception(
+          "Could not find submit-trackings button. Make sure that you've subscribed to a deal and that the login credentials are correct"
+      )
 
-      modal = driver.find_element_by_class_name("modal-body")
-      form = modal.find_element_by_tag_name("form")
+    time.sleep(2)
 
-      textarea = form.find_element_by_class_name("textarea-control")
-      textarea.send_keys("\n".join(numbers))
-      form.find_element_by_xpath("//button[text() = 'Submit']").click()
-      time.sleep(1)
+    modal = driver.find_element_by_class_name("modal-body")
+    form = modal.find_element_by_tag_name("form")
 
-      # If there are some dupes, we need to remove the dupes and submit again
-      modal = driver.find_element_by_class_name("modal-body")
-      if "Tracking number was already entered" in modal.text:
-        dupes_list = form.find_element_by_css_selector('ul.error-message > li.ng-star-inserted')
-        dupe_numbers = dupes_list.text.strip().split(", ")
-        new_numbers = [n for n in numbers if not n in dupe_numbers]
-        driver.find_element_by_class_name("modal-close").click()
-        if len(new_numbers) > 0:
-          # Re-run this batch with only new numbers, if there are any
-          self._upload_bfmr_batch(driver, new_numbers)
-    finally:
-      driver.quit()
+    textarea = form.find_element_by_class_name("textarea-control")
+    self._fill_textarea(driver, textarea, "\n".join(numbers))
+    form.find_element_by_xpath("//button[text() = 'Submit']").click()
+    time.sleep(1)
+
+    # If there are some dupes, we need to remove the dupes and submit again
+    modal = driver.find_element_by_class_name("modal-body")
+    if "Tracking number was already entered" in modal.text:
+      dupes_list = form.find_element_by_css_selector('ul.error-message > li.ng-star-inserted')
+      dupe_numbers = dupes_list.text.strip().split(", ")
+      UploadLedger('bfmr').record_confirmed(dupe_numbers)
+      new_numbers = [n for n in numbers if not n in dupe_numbers]
+      driver.find_element_by_class_name("modal-close").click()
+      if len(new_numbers) > 0:
+        # Re-run this batch with only new numbers, if there are any
+        self._upload_bfmr_batch(driver, new_numbers)
+    else:
+      # Close the modal so the next batch can open it again.
+      close_buttons = driver.find_elements_by_class_name("modal-close")
+      if close_buttons:
+        close_buttons[0].click()
+        time.sleep(1)
 
   def _upload_yrcw(self, numbers) -> None:
     driver = self._login_yrcw()
@@ -361,7 +580,8 @@ class GroupSiteManager:
       self._load_page(driver, YRCW_URL + "dashboard")
       driver.find_element_by_xpath("//button[@data-target='#modalAddTrackingNumbers']").click()
       time.sleep(0.5)
-      driver.find_element_by_tag_name("textarea").send_keys(",".join(numbers))
+      textarea = driver.find_element_by_tag_name("textarea")
+      self._fill_textarea(driver, textarea, ",".join(numbers))
       driver.find_element_by_xpath("//button[text() = 'Add']").click()
       time.sleep(0.5)
       driver.find_element_by_xpath("//button[text() = 'Submit All']").click()
@@ -383,20 +603,87 @@ class GroupSiteManager:
         if not textareas:
           raise Exception("Could not find order management for group %s" % group)
 
-      textarea = textareas[0]
-      textarea.send_keys('\n'.join(numbers))
+      self._fill_textarea(driver, textareas[0], '\n'.join(numbers))
       driver.find_element_by_xpath(SUBMIT_BUTTON_SELECTOR).click()
       time.sleep(1)
     finally:
       driver.quit()
 
   def _login_melul(self, group, username, password) -> Any:
-    # Always use no-headless for Melul portals for CAPTCHA solving,
-    # and save previous no-headless state and restore it aftewards.
-    former_headless = self.driver_creator.args.no_headless
-    self.driver_creator.args.no_headless = True
-    driver = self.driver_creator.new()
-    self.driver_creator.args.no_headless = former_headless
+    # A session saved by a previous interactive login skips the CAPTCHA and 2FA,
+    # so it can run with whatever headless setting was requested.
+    driver = self._resume_melul_session(group)
+    if driver:
+      return driver
+    with self.prompt_lock:
+      if group in self.no_prompt_groups:
+        raise Exception(f"The saved {group} session has expired and logging in again needs "
+                        "the console, which a background refresh can't use")
+      self.prompting_groups.add(group)
+    try:
+      with _interactive_login_lock:
+        driver = self._login_melul_interactive(group, username, password)
+    finally:
+      with self.prompt_lock:
+        self.prompting_groups.discard(group)
+    self._save_melul_session(group, driver)
+    return driver
+
+  def forbid_login_prompts(self, group) -> bool:
+    """
+    Makes the group's portal fail rather than prompt for a login from now on,
+    for loads that continue in the background while the console is used for
+    other things. Returns False, forbidding nothing, if it's prompting (or
+    queued to) already.
+    """
+    with self.prompt_lock:
+      if group in self.prompting_groups:
+        return False
+      self.no_prompt_groups.add(group)
+      return True
+
+  def _resume_melul_session(self, group) -> Any:
+    cookies_table = get_sessions_store().table(BROWSER_COOKIES_NAMESPACE)
+    cookies = cookies_table.get(group)
+    now = time.time()
+    cookies = [cookie for cookie in cookies or [] if cookie.get('expiry', now + 1) > now]
+    if not cookies:
+      return None
+
+    with instrumentation.span("melul.resume_session", group=group):
+      driver = self._new_driver()
+      try:
+        # Cookies can only be added for the domain of the current page.
+        self._load_page(driver, BASE_URL_FORMAT % group)
+        for cookie in cookies:
+          driver.add_cookie(cookie)
+        self._load_page(driver, BASE_URL_FORMAT % group)
+        logged_in = not driver.find_elements_by_name(LOGIN_EMAIL_FIELD)
+      except Exception as e:
+        print(f"Could not restore the saved {group} session: {e}")
+        logged_in = False
+
+    if logged_in:
+      instrumentation.count("melul.session.hit")
+      return driver
+    print(f"Saved {group} session has expired, logging in again")
+    instrumentation.count("melul.session.miss")
+    driver.quit()
+    del cookies_table[group]
+    return None
+
+  def _save_melul_session(self, group, driver) -> None:
+    try:
+      cookies = driver.get_cookies()
+    except Exception as e:
+      print(f"Could not save the {group} session: {e}")
+      return
+    if cookies:
+      get_sessions_store().table(BROWSER_COOKIES_NAMESPACE)[group] = cookies
+
+  def _login_melul_interactive(self, group, username, password) -> Any:
+    # Always use no-headless for Melul portals for CAPTCHA solving.
+    driver = self._new_driver(no_headless=True)
     self._load_page(driver, BASE_URL_FORMAT % group)
     driver.find_element_by_name(LOGIN_EMAIL_FIELD).send_keys(username)
     driver.find_element_by_name(LOGIN_PASSWORD_FIELD).send_keys(password)
@@ -413,10 +700,12 @@ class GroupSiteManager:
       print("Fetching 2FA code from email ...")
 
       # get the email client and search for the code
-      mail = self._get_all_mail_folder()
-      _, email_ids = mail.uid('SEARCH', None, '(SUBJECT "Passcode for")')
-      last_id = email_ids[0].split()[-1]
-      _, data = mail.uid("FETCH", last_id, "(RFC822)")
+      mail_backend = open_mail_backend(self.config)
+      try:
+        _, data = mail_backend.run(
+            lambda mail: mail.fetch(mail.search(subject="Passcode for")[-1]))
+      finally:
+        mail_backend.close()
       msg = email.message_from_string(str(data[0][1], 'utf-8'))
       subject = msg['Subject']
       pattern = r'Passcode for .*(\d{3}-\d{3})'
@@ -432,7 +721,7 @@ class GroupSiteManager:
     return driver
 
   def _login_yrcw(self) -> Any:
-    driver = self.driver_creator.new()
+    driver = self._new_driver()
     self._load_page(driver, YRCW_URL)
     group_config = self.config['groups']['yrcw']
     driver.find_element_by_xpath("//input[@type='email']").send_keys(group_config['username'])
@@ -441,22 +730,20 @@ class GroupSiteManager:
     time.sleep(2)
     return driver
 
-  def _get_all_mail_folder(self):
-    mail = email_auth.email_authentication()
-    mail.select('"[Gmail]/All Mail"')
-    return mail
-
   def _get_bfmr_costs(self):
-    mail = self._get_all_mail_folder()
-    status, response = mail.uid('SEARCH', None, 'SUBJECT "BuyForMeRetail - Payment Sent"',
-                                'SINCE "01-Aug-2019"')
-    email_ids = response[0].decode('utf-8').split()
+    from bs4 import BeautifulSoup
+    from tqdm import tqdm
+    mail_backend = open_mail_backend(self.config)
+    try:
+      emails = mail_backend.run(lambda mail: mail.fetch_many(
+          mail.search(subject="BuyForMeRetail - Payment Sent", since="01-Aug-2019")))
+    finally:
+      mail_backend.close()
     # some hacks, "po" will just also be the tracking
     tracking_map = dict()
     result = collections.defaultdict(float)
 
-    for email_id in tqdm(email_ids, desc='Fetching BFMR check-ins', unit='email'):
-      fetch_result, data = mail.uid("FETCH", email_id, "(RFC822)")
+    for _, data in tqdm(emails.values(), desc='Parsing BFMR check-ins', unit='email'):
       soup = BeautifulSoup(
           quopri.decodestring(data[0][1]), features="html.parser", from_encoding="iso-8859-1")
 
@@ -474,7 +761,7 @@ class GroupSiteManager:
       tds = tds[:-2]
 
       for i in range(len(tds) // 5):
-        tracking = tds[i * 5].getText().upper()
+        tracking = canonical_tracking(tds[i * 5].getText(), "bfmr")
         total_text = tds[i * 5 + 4].getText()
         total = float(total_text.replace(',', '').replace('$', ''))
         result[tracking] += total
@@ -487,6 +774,7 @@ class GroupSiteManager:
     return (tracking_to_po, po_to_cost) 
     
   def _get_usa_po_to_price(self) -> Dict[Any, float]: 
+    from tqdm import tqdm
     result = {} 
     driver = self._login_usa()  
     try:  
@@ -515,6 +803,7 @@ class GroupSiteManager:
       driver.quit()  
     
   def _get_usa_tracking_to_purchase_order(self) -> dict:  
+    from tqdm import tqdm
     result = {} 
     #trackings_to_cost, po_to_cost ={}  
     driver = self._login_usa()  
@@ -566,7 +855,7 @@ class GroupSiteManager:
       driver.quit()  
     
   def _login_usa(self) -> Any:  
-    driver = self.driver_creator.new()  
+    driver = self._new_driver()  
     self._load_page(driver, USA_LOGIN_URL)  
     group_config = self.config['groups']['usa'] 
     driver.find_element_by_name("credentials").send_keys( 
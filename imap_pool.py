@@ -0,0 +1,91 @@
+"""
+A pool of authenticated IMAP connections with "[Gmail]/All Mail" selected.
+
+Connections are opened on first use (so a run that only hits the order cache
+never logs in), handed out one per thread, and replaced when the server drops
+them.
+"""
+
+import imaplib
+import threading
+import lib.email_auth as email_auth
+from lib import instrumentation
+from lib.mail_search import MailSearch
+from typing import Any, Callable
+
+ALL_MAIL_FOLDER = '"[Gmail]/All Mail"'
+DEFAULT_CONNECTIONS = 4
+MAX_RECONNECTS = 2
+
+# What a dropped or timed-out connection raises (socket and SSL errors are OSErrors).
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+
+class ImapPool:
+
+  def __init__(self, size: int = DEFAULT_CONNECTIONS) -> None:
+    self.size = max(1, size)
+    # Idle connections, most recently used last. Waiters are woken whenever a
+    # connection is returned or discarded, since either lets them proceed.
+    self.idle = []
+    self.available = threading.Condition()
+    self.opened = 0
+
+  def _connect(self) -> MailSearch:
+    with instrumentation.span("imap.connect"):
+      mail = instrumentation.instrument_imap(email_auth.email_authentication())
+      mail.select(ALL_MAIL_FOLDER)
+    return MailSearch(mail)
+
+  def _acquire(self) -> MailSearch:
+    with self.available:
+      while not self.idle and self.opened >= self.size:
+        self.available.wait()
+      if self.idle:
+        return self.idle.pop()
+      self.opened += 1
+    try:
+      return self._connect()
+    except Exception:
+      with self.available:
+        self.opened -= 1
+        self.available.notify()
+      raise
+
+  def _release(self, connection: MailSearch) -> None:
+    with self.available:
+      self.idle.append(connection)
+      self.available.notify()
+
+  def _discard(self, connection: MailSearch) -> None:
+    with self.available:
+      self.opened -= 1
+      self.available.notify()
+    connection.close()
+
+  def run(self, fn: Callable[[MailSearch], Any]) -> Any:
+    """
+    Calls fn with a connection (as a MailSearch) that no other thread is using,
+    retrying on a fresh connection if the server drops this one.
+    """
+    for attempt in range(MAX_RECONNECTS + 1):
+      connection = self._acquire()
+      try:
+        result = fn(connection)
+      except CONNECTION_ERRORS:
+        self._discard(connection)
+        instrumentation.count("imap.reconnects")
+        if attempt == MAX_RECONNECTS:
+          raise
+        continue
+      except Exception:
+        self._release(connection)
+        raise
+      self._release(connection)
+      return result
+
+  def close(self) -> None:
+    with self.available:
+      connections, self.idle = self.idle, []
+    for connection in connections:
+      self._discard(connection)
@@ -0,0 +1,223 @@
+"""
+Lightweight spans and counters for finding where a reconcile run spends its time.
+
+Everything is a no-op until `enable()` is called: `span()` hands back a shared
+null context, `count()` returns immediately and `instrument()` returns the
+object it was given, so the disabled cost is a flag check per call.
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import os.path
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+_enabled = False
+_track_memory = False
+_lock = threading.Lock()
+_events: List[Dict[str, Any]] = []
+_counters: Dict[str, float] = collections.defaultdict(float)
+_start = time.perf_counter()
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def enable(track_memory: bool = False) -> None:
+  """Starts recording. With `track_memory`, spans also note the traced heap growth inside them."""
+  global _enabled, _start, _track_memory
+  _enabled = True
+  _track_memory = track_memory
+  if track_memory and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  _start = time.perf_counter()
+
+
+def disable() -> None:
+  global _enabled, _track_memory
+  _enabled = False
+  if _track_memory:
+    tracemalloc.stop()
+  _track_memory = False
+
+
+def is_enabled() -> bool:
+  return _enabled
+
+
+def reset() -> None:
+  with _lock:
+    _events.clear()
+    _counters.clear()
+
+
+class _Span:
+
+  def __init__(self, name, args) -> None:
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    if _track_memory:
+      self.memory = tracemalloc.get_traced_memory()[0]
+    self.begin = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    end = time.perf_counter()
+    event = {
+        "name": self.name,
+        "cat": self.name.split(".")[0],
+        "ph": "X",
+        "ts": (self.begin - _start) * 1e6,
+        "dur": (end - self.begin) * 1e6,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+    }
+    if self.args:
+      event["args"] = self.args
+    if _track_memory:
+      memory = tracemalloc.get_traced_memory()[0]
+      event.setdefault("args", {})["mem_delta_kb"] = (memory - self.memory) / 1024
+    if exc_type is not None:
+      event.setdefault("args", {})["error"] = exc_type.__name__
+    with _lock:
+      _events.append(event)
+
+
+def span(name: str, **args) -> Any:
+  """A context manager timing the enclosed block as `name` (e.g. "imap.search")."""
+  if not _enabled:
+    return _NULL_SPAN
+  return _Span(name, args)
+
+
+def count(name: str, amount: float = 1) -> None:
+  """Adds `amount` to a named counter, e.g. bytes fetched or cache hits."""
+  if not _enabled:
+    return
+  with _lock:
+    _counters[name] += amount
+
+
+def timed(name: str):
+  """Decorator version of `span` for whole functions."""
+
+  def decorator(fn):
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not _enabled:
+        return fn(*args, **kwargs)
+      with _Span(name, None):
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+  return decorator
+
+
+class _Instrumented:
+  """A proxy that times every method call on the wrapped object as `<prefix>.<method>`."""
+
+  def __init__(self, wrapped, prefix) -> None:
+    object.__setattr__(self, "_wrapped", wrapped)
+    object.__setattr__(self, "_prefix", prefix)
+
+  def __getattr__(self, attr):
+    value = getattr(self._wrapped, attr)
+    if not callable(value):
+      return value
+    name = f"{self._prefix}.{attr}"
+
+    @functools.wraps(value)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        result = value(*args, **kwargs)
+      count(name + ".calls")
+      return result
+
+    return wrapper
+
+  def __setattr__(self, attr, value) -> None:
+    setattr(self._wrapped, attr, value)
+
+
+class _InstrumentedImap(_Instrumented):
+  """Like _Instrumented, but names UID commands by verb and counts fetched bytes."""
+
+  def uid(self, command, *args):
+    verb = command.lower()
+    with span(f"{self._prefix}.{verb}"):
+      result = self._wrapped.uid(command, *args)
+    count(f"{self._prefix}.{verb}.calls")
+    if verb == "fetch":
+      _, data = result
+      fetched = sum(len(part[1]) for part in data or [] if isinstance(part, tuple))
+      count(f"{self._prefix}.bytes", fetched)
+    return result
+
+
+def instrument(obj, prefix: str) -> Any:
+  """Returns `obj` wrapped so its method calls are timed, or `obj` itself when disabled."""
+  if not _enabled:
+    return obj
+  return _Instrumented(obj, prefix)
+
+
+def instrument_imap(mail, prefix: str = "imap") -> Any:
+  if not _enabled:
+    return mail
+  return _InstrumentedImap(mail, prefix)
+
+
+def events() -> List[Dict[str, Any]]:
+  with _lock:
+    return list(_events)
+
+
+def summary_lines() -> List[str]:
+  with _lock:
+    events = list(_events)
+    counters = dict(_counters)
+
+  totals = collections.OrderedDict()
+  for event in events:
+    calls, total, longest = totals.get(event["name"], (0, 0.0, 0.0))
+    totals[event["name"]] = (calls + 1, total + event["dur"], max(longest, event["dur"]))
+
+  lines = [f"{'span':<48} {'calls':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+  for name, (calls, total, longest) in totals.items():
+    lines.append(f"{name:<48} {calls:>8} {total / 1e6:>10.2f} {total / calls / 1e3:>10.1f} "
+                 f"{longest / 1e3:>10.1f}")
+  if counters:
+    lines.append("")
+    lines.append(f"{'counter':<48} {'value':>10}")
+    for name in sorted(counters):
+      lines.append(f"{name:<48} {counters[name]:>10g}")
+  cache_names = sorted(set(name.rsplit(".", 1)[0] for name in counters
+                          if name.endswith(".hit") or name.endswith(".miss")))
+  for name in cache_names:
+    hits = counters.get(name + ".hit", 0)
+    misses = counters.get(name + ".miss", 0)
+    lines.append(f"{name} hit rate: {hits / (hits + misses):.1%}")
+  return lines
+
+
+def print_summary() -> None:
+  print("\n".join(summary_lines()))
+
+
+def write_trace(path: str) -> None:
+  """Writes the recorded spans as a Chrome trace (chrome://tracing, Perfetto) with the counters."""
+  folder = os.path.dirname(path)
+  if folder and not os.path.exists(folder):
+    os.makedirs(folder)
+  with _lock:
+    trace = {"traceEvents": list(_events), "otherData": {"counters": dict(_counters)}}
+  with open(path, 'w') as stream:
+    json.dump(trace, stream)
+  print(f"Wrote trace to {path}")
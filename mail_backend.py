@@ -0,0 +1,23 @@
+"""
+Picks the mail backend order lookups and email-based portals read from: IMAP
+(the default) or the Gmail API, set by the "mailBackend" config key.
+
+A backend is used through `run(fn)`, which calls fn with an object no other
+thread is using that offers search(**terms), fetch(id) and fetch_many(ids)
+(see MailSearch), and released with `close()`.
+"""
+
+from lib.imap_pool import ImapPool
+
+IMAP_BACKEND = "imap"
+GMAIL_API_BACKEND = "gmail_api"
+
+
+def open_mail_backend(config, connections: int = 1):
+  backend = config.get('mailBackend', IMAP_BACKEND)
+  if backend == IMAP_BACKEND:
+    return ImapPool(connections)
+  if backend == GMAIL_API_BACKEND:
+    from lib.gmail_api import GmailApiBackend
+    return GmailApiBackend.from_config(config, connections)
+  raise Exception("Unknown mail backend: " + backend)
@@ -0,0 +1,147 @@
+"""
+Mail searches that use Gmail's own search engine when the server is Gmail.
+
+Generic IMAP `SEARCH BODY "..."` over "[Gmail]/All Mail" is executed slowly by
+Gmail, while its X-GM-RAW extension runs the same query through Gmail search
+(`"exact phrase" subject:"..." from:... after:YYYY/MM/DD`). Other servers get
+the equivalent standard SEARCH criteria. On Gmail, messages are identified by
+X-GM-MSGID, which stays the same across folders, rather than the folder UID.
+"""
+
+import re
+from lib import instrumentation
+from typing import Any, Dict, List, Optional, Tuple
+
+GMAIL_CAPABILITY = "X-GM-EXT-1"
+MSGID_REGEX = rb'X-GM-MSGID (\d+)'
+FETCH_CHUNK_SIZE = 100
+
+
+def quote(text: str) -> str:
+  """An IMAP quoted string."""
+  return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def supports_gmail_extensions(mail) -> bool:
+  capabilities = getattr(mail, "capabilities", None) or ()
+  return any(str(capability).upper() == GMAIL_CAPABILITY for capability in capabilities)
+
+
+class MailSearch:
+
+  def __init__(self, mail) -> None:
+    self.mail = mail
+    self.gmail = supports_gmail_extensions(mail)
+
+  def criteria(self,
+               phrase: Optional[str] = None,
+               subject: Optional[str] = None,
+               sender: Optional[str] = None,
+               since: Optional[str] = None,
+               phrases: Optional[List[str]] = None) -> Tuple:
+    """
+    The SEARCH arguments matching all of the given terms. `since` is an IMAP
+    date such as "01-Aug-2019"; `phrases` matches messages containing any of them.
+    """
+    if self.gmail:
+      return ("X-GM-RAW", quote(gmail_query(phrase, subject, sender, since, phrases)))
+
+    criteria = []
+    if phrase:
+      criteria.append("BODY " + quote(phrase))
+    if phrases:
+      any_phrase = "BODY " + quote(phrases[-1])
+      for other in reversed(phrases[:-1]):
+        any_phrase = f"OR BODY {quote(other)} {any_phrase}"
+      criteria.append(any_phrase)
+    if subject:
+      criteria.append("SUBJECT " + quote(subject))
+    if sender:
+      criteria.append("FROM " + quote(sender))
+    if since:
+      criteria.append("SINCE " + quote(since))
+    return (None, *criteria)
+
+  def search(self, **terms) -> List[str]:
+    """The UIDs of the messages matching the terms (see `criteria`), oldest first."""
+    backend = "gmail" if self.gmail else "imap"
+    instrumentation.count(f"mail_search.{backend}.calls")
+    _, response = self.mail.uid('SEARCH', *self.criteria(**terms))
+    if not response or not response[0]:
+      return []
+    return response[0].decode('utf-8').split()
+
+  def fetch(self, uid) -> Tuple[str, Any]:
+    """
+    Fetches the message, returning its stable ID (the X-GM-MSGID on Gmail,
+    otherwise the UID) and the FETCH data.
+    """
+    if not self.gmail:
+      _, data = self.mail.uid("FETCH", uid, "(RFC822)")
+      return uid, data
+    _, data = self.mail.uid("FETCH", uid, "(X-GM-MSGID RFC822)")
+    match = re.search(MSGID_REGEX, data[0][0]) if data and isinstance(data[0], tuple) else None
+    return (match.group(1).decode('utf-8') if match else uid), data
+
+  def fetch_many(self, uids) -> Dict[str, Tuple[str, Any]]:
+    """Like `fetch` for many messages, FETCH_CHUNK_SIZE per round trip, by UID."""
+    items = "(X-GM-MSGID RFC822)" if self.gmail else "(RFC822)"
+    result = {}
+    for start in range(0, len(uids), FETCH_CHUNK_SIZE):
+      chunk = uids[start:start + FETCH_CHUNK_SIZE]
+      _, data = self.mail.uid("FETCH", ",".join(chunk), items)
+      for part in data or []:
+        if not isinstance(part, tuple):
+          continue
+        uid_match = re.search(rb'UID (\d+)', part[0])
+        if not uid_match:
+          continue
+        uid = uid_match.group(1).decode('utf-8')
+        msgid_match = re.search(MSGID_REGEX, part[0]) if self.gmail else None
+        stable_id = msgid_match.group(1).decode('utf-8') if msgid_match else uid
+        result[uid] = (stable_id, [part, b")"])
+    return result
+
+  def msgids(self, uids) -> Dict[str, str]:
+    """The X-GM-MSGIDs of the messages by UID (none unless the server is Gmail)."""
+    if not self.gmail:
+      return {}
+    result = {}
+    for start in range(0, len(uids), FETCH_CHUNK_SIZE):
+      chunk = uids[start:start + FETCH_CHUNK_SIZE]
+      _, data = self.mail.uid("FETCH", ",".join(chunk), "(X-GM-MSGID)")
+      for part in data or []:
+        line = part[0] if isinstance(part, tuple) else part
+        uid_match = re.search(rb'UID (\d+)', line or b"")
+        msgid_match = re.search(MSGID_REGEX, line or b"")
+        if uid_match and msgid_match:
+          result[uid_match.group(1).decode('utf-8')] = msgid_match.group(1).decode('utf-8')
+    return result
+
+  def close(self) -> None:
+    try:
+      self.mail.logout()
+    except Exception:
+      pass
+
+
+def gmail_query(phrase=None, subject=None, sender=None, since=None, phrases=None) -> str:
+  """The terms as a Gmail search query (what X-GM-RAW and the Gmail API's `q` take)."""
+  terms = []
+  if phrase:
+    terms.append(quote(phrase))
+  if phrases:
+    terms.append("{" + " ".join(quote(other) for other in phrases) + "}")
+  if subject:
+    terms.append("subject:" + quote(subject))
+  if sender:
+    terms.append("from:" + sender)
+  if since:
+    terms.append("after:" + gmail_date(since))
+  return " ".join(terms)
+
+
+def gmail_date(imap_date: str) -> str:
+  """Converts an IMAP date ("01-Aug-2019") to a Gmail search date ("2019/08/01")."""
+  import datetime
+  return datetime.datetime.strptime(imap_date, "%d-%b-%Y").strftime("%Y/%m/%d")
@@ -1,17 +1,105 @@
+import email
 import pickle
 import os.path
-import imaplib
 import re
 import quopri
-import lib.email_auth as email_auth
-from bs4 import BeautifulSoup
-from lib.objects_to_drive import ObjectsToDrive
-from typing import Any, Dict, Optional, Union
+import threading
+import time
+from lib import instrumentation
+from lib.imap_pool import ImapPool, DEFAULT_CONNECTIONS
+from lib.mail_backend import open_mail_backend
+from lib.store import get_store, ORDERS_NAMESPACE, ORDER_MISSES_NAMESPACE
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 OUTPUT_FOLDER = "output"
 ORDERS_FILENAME = "orders.pickle"
 ORDERS_FILE = OUTPUT_FOLDER + "/" + ORDERS_FILENAME
 
+# Orders searched for per round trip, and emails fetched per round trip (one
+# FETCH, or one Gmail API batch request).
+ORDER_SEARCH_CHUNK_SIZE = 25
+EMAIL_FETCH_CHUNK_SIZE = 100
+
+# Each pattern starts with a literal, so the regex engine can skip ahead to its
+# candidates rather than try every position: order IDs are found by their
+# "-NNNNNNN-NNNNNNN" tail, then checked for the three digits before it.
+AMAZON_ORDER_TAIL_REGEX = re.compile(rb'-\d{7}-\d{7}')
+AMAZON_PRETAX_REGEX = re.compile(rb'Total Before Tax:[^$]*\$([\d,]+\.\d{2})')
+AMAZON_TAX_REGEX = re.compile(rb'Estimated Tax:[^$]*\$([\d,]+\.\d{2})')
+# The "price" class of the cells personal-account emails list their totals in
+# (possibly quoted-printable, where "=" is "=3D").
+AMAZON_PRICE_CELL_REGEX = re.compile(rb'class=(?:3D)?["\']?(?:[^"\'>]*\s)?price\b')
+ENCODED_PART_REGEX = re.compile(rb'(?i)content-transfer-encoding:\s*(?:quoted-printable|base64)')
+
+# Orders whose email couldn't be found or parsed are retried on an exponential
+# backoff: one day after the first miss, doubling up to a month.
+MISS_RETRY_BASE_SECONDS = 24 * 60 * 60
+MISS_RETRY_MAX_SECONDS = 30 * 24 * 60 * 60
+
+# Set once cached email IDs that were "[Gmail]/All Mail" UIDs have been re-keyed
+# to X-GM-MSGIDs (see OrderInfoRetriever.migrate_email_ids).
+EMAIL_IDS_MIGRATED_KEY = "order_email_ids_migrated"
+# UIDs are 32-bit; X-GM-MSGIDs are 64-bit and far larger.
+MAX_UID = 2**32 - 1
+
+
+def is_folder_uid(email_id) -> bool:
+  return email_id is not None and str(email_id).isdigit() and int(email_id) <= MAX_UID
+
+
+def clear_unresolved_orders() -> None:
+  """Forgets all recorded misses so that every unresolved order is retried on the next lookup."""
+  get_store().table(ORDER_MISSES_NAMESPACE).clear()
+
+
+def miss_retry_delay(attempts: int) -> float:
+  """Seconds to wait after the given number of consecutive misses before searching again."""
+  if attempts <= 0:
+    return 0
+  return min(MISS_RETRY_BASE_SECONDS * 2**(attempts - 1), MISS_RETRY_MAX_SECONDS)
+
+
+def scan_amazon_email(raw_email: bytes) -> Tuple[List[str], List[float], List[float]]:
+  """
+  The order IDs (deduplicated, in order of appearance), pretax totals and
+  estimated taxes of an Amazon order email, read straight from its bytes.
+  """
+  orders = {}
+  position = 0
+  while True:
+    match = AMAZON_ORDER_TAIL_REGEX.search(raw_email, position)
+    if not match:
+      break
+    start = match.start()
+    if start >= 3 and raw_email[start - 3:start].isdigit():
+      orders[raw_email[start - 3:match.end()].decode("ascii")] = None
+      position = match.end()
+    else:
+      position = start + 1
+  pretax_totals = [
+      float(cost.replace(b',', b'')) for cost in AMAZON_PRETAX_REGEX.findall(raw_email)
+  ]
+  taxes = [float(cost.replace(b',', b'')) for cost in AMAZON_TAX_REGEX.findall(raw_email)]
+  return list(orders), pretax_totals, taxes
+
+
+def searchable_text(fetched) -> bytes:
+  """
+  The raw bytes of a fetched (stable email ID, FETCH data) email, followed by
+  its quoted-printable or base64 text parts decoded, since that's what a BODY
+  search matches.
+  """
+  if not fetched or not fetched[1] or not isinstance(fetched[1][0], tuple):
+    return b""
+  raw = fetched[1][0][1]
+  if not ENCODED_PART_REGEX.search(raw):
+    return raw
+  texts = [raw]
+  for part in email.message_from_bytes(raw).walk():
+    if part.get_content_maintype() == 'text':
+      texts.append(part.get_payload(decode=True) or b"")
+  return b"\n".join(texts)
+
 
 class OrderInfo:
   """
@@ -39,25 +127,38 @@ class OrderInfoRetriever:
   def __init__(self, config) -> None:
     self.config = config
     self.orders_dict = self.load_dict()
-    self.mail = self.load_mail()
+    # order ID -> (consecutive misses, time of last attempt) for unresolved orders
+    self.misses_dict = get_store().table(ORDER_MISSES_NAMESPACE)
+    # The number of mail connections (and lookup threads) is set by "imapConnections".
+    self.workers = config.get('imapConnections', DEFAULT_CONNECTIONS)
+    self.mail_backend = open_mail_backend(config, self.workers)
+    self.lock = threading.Lock()
+    self.email_ids_migrated = False
 
-  def load_mail(self):
-    mail = email_auth.email_authentication()
-    mail.select('"[Gmail]/All Mail"')
-    return mail
+  def close(self) -> None:
+    self.mail_backend.close()
 
   def flush(self) -> None:
-    if not os.path.exists(OUTPUT_FOLDER):
-      os.mkdir(OUTPUT_FOLDER)
-
-    with open(ORDERS_FILE, 'wb') as stream:
-      pickle.dump(self.orders_dict, stream)
-
-    objects_to_drive = ObjectsToDrive()
-    objects_to_drive.save(self.config, ORDERS_FILENAME, ORDERS_FILE)
+    # Order infos are committed to the local store as they're fetched, so only
+    # the Drive backup of the database needs refreshing here (if it changed).
+    get_store().backup_to_drive(self.config)
 
   def load_dict(self) -> Any:
-    objects_to_drive = ObjectsToDrive()
+    """
+    Returns a dict-like view of the order infos in the local store. The store
+    is first restored from its Drive backup if that's newer; only failing that
+    is the legacy orders pickle (from Drive or disk) imported, the first time
+    the store is opened.
+    """
+    store = get_store()
+    store.restore_from_drive(self.config)
+    orders = store.table(ORDERS_NAMESPACE)
+    store.import_once(orders, self.load_legacy_dict)
+    return orders
+
+  def load_legacy_dict(self) -> Any:
+    from lib.objects_to_drive import ObjectsToDrive
+    objects_to_drive = instrumentation.instrument(ObjectsToDrive(), "drive")
     from_drive = objects_to_drive.load(self.config, ORDERS_FILENAME)
     if from_drive:
       return from_drive
@@ -68,25 +169,226 @@ class OrderInfoRetriever:
     with open(ORDERS_FILE, 'rb') as stream:
       return pickle.load(stream)
 
+  def migrate_email_ids(self) -> None:
+    """
+    Re-keys the cached orders whose email ID is still an All Mail UID, from
+    before emails on Gmail were known by their X-GM-MSGID (see MailSearch.fetch),
+    so they compare with the IDs of emails fetched now. Done once per store,
+    before the first lookup that fetches emails, over IMAP whichever backend
+    fetches them (UIDs are an IMAP notion).
+    """
+    with self.lock:
+      if self.email_ids_migrated:
+        return
+      self.email_ids_migrated = True
+      store = get_store()
+      if store.get_meta(EMAIL_IDS_MIGRATED_KEY):
+        return
+      cached = self.orders_dict.load_all()
+      uids = sorted(set(info.email_id for info in cached.values() if is_folder_uid(info.email_id)))
+      if uids:
+        mail_backend = self.mail_backend if isinstance(self.mail_backend, ImapPool) else ImapPool(1)
+        try:
+          msgids = mail_backend.run(lambda mail: mail.msgids(uids))
+        except Exception as e:
+          # Tried again on the next run; until then cached and new IDs don't compare.
+          print(f"Could not re-key cached orders by X-GM-MSGID: {e}")
+          return
+        finally:
+          if mail_backend is not self.mail_backend:
+            mail_backend.close()
+        if msgids:
+          print(f"Re-keying the cached orders of {len(msgids)} emails by X-GM-MSGID")
+          self.orders_dict.update({
+              order_id: OrderInfo(msgids[info.email_id], info.cost)
+              for order_id, info in cached.items()
+              if info.email_id in msgids
+          })
+      store.set_meta(EMAIL_IDS_MIGRATED_KEY, "1")
+
   def get_order_info(self, order_id) -> OrderInfo:
-    # Fetch the order from email if it's new or if we attempted to fetch it
-    # previously but weren't able to find a cost (i.e. cost is still 0).
-    if order_id not in self.orders_dict or self.orders_dict[order_id].cost == 0:
-      from_email = self.load_order_total(order_id)
-      if not from_email:
-        from_email = {order_id: OrderInfo(None, 0.0)}
-      self.orders_dict.update(from_email)
+    order_info = self.get_cached_order_info(order_id)
+    if order_info is None:
+      order_info = self.fetch_order_info(order_id)
       self.flush()
-    return self.orders_dict[order_id]
+    return order_info
+
+  def get_order_infos(self, order_ids,
+                      progress=None) -> Tuple[Dict[str, OrderInfo], Dict[str, Exception]]:
+    """
+    Looks up many orders at once. Uncached orders are searched for
+    ORDER_SEARCH_CHUNK_SIZE at a time on a pool of threads (one mail connection
+    each), then each order's email is picked out of those found (see
+    find_order_emails) and parsed. Returns the
+    order infos and the exceptions of the orders that failed, each by order ID.
+    `progress` is called once per order as it completes.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    result = {}
+    errors = {}
+    to_fetch = []
+    for order_id in dict.fromkeys(order_ids):
+      order_info = self.get_cached_order_info(order_id)
+      if order_info is None:
+        to_fetch.append(order_id)
+      else:
+        result[order_id] = order_info
+        if progress:
+          progress()
+    if not to_fetch:
+      return result, errors
+    self.migrate_email_ids()
+
+    def lookup(chunk):
+      try:
+        email_ids = self.mail_backend.run(lambda mail: mail.search(phrases=chunk))
+        return chunk, self.find_order_emails(chunk, email_ids), None
+      except Exception as e:
+        return chunk, None, e
+
+    found = {}
+    unmatched = []
+    chunks = [
+        to_fetch[start:start + ORDER_SEARCH_CHUNK_SIZE]
+        for start in range(0, len(to_fetch), ORDER_SEARCH_CHUNK_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      for chunk, chunk_found, error in executor.map(lookup, chunks):
+        if error is not None:
+          for order_id in chunk:
+            errors[order_id] = error
+            if progress:
+              progress()
+          continue
+        for order_id in chunk:
+          if order_id in chunk_found:
+            found[order_id] = chunk_found[order_id]
+          else:
+            # Gmail matched the order ID where no email we can decode spells it
+            # out: search for it alone.
+            unmatched.append(order_id)
+
+    def search_alone(order_id):
+      try:
+        return order_id, self.get_relevant_raw_email_data(order_id), None
+      except Exception as e:
+        return order_id, None, e
+
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      for order_id, fetched, error in executor.map(search_alone, unmatched):
+        if error is None:
+          found[order_id] = fetched
+        else:
+          errors[order_id] = error
+          if progress:
+            progress()
+
+    for order_id, (email_id, data) in found.items():
+      try:
+        instrumentation.count("order_info.cache.miss")
+        result[order_id] = self.record_fetched(order_id,
+                                               self.parse_order_email(order_id, email_id, data))
+      except Exception as e:
+        errors[order_id] = e
+      if progress:
+        progress()
+    self.flush()
+    return result, errors
+
+  def find_order_emails(self, order_ids, email_ids) -> Dict[str, Tuple[str, Any]]:
+    """
+    Each order's oldest email among `email_ids` (oldest first) that mentions it,
+    as (stable email ID, FETCH data), which is the email searching for the order
+    alone finds. An order with no emails at all gets (None, None); one whose
+    emails don't mention it is left out. Emails are fetched oldest first, never
+    more per round trip than orders still without one, so the later shipping
+    and delivery notices the search also matches are mostly never fetched.
+    """
+    if not email_ids:
+      return {order_id: (None, None) for order_id in order_ids}
+    result = {}
+    pending = list(order_ids)
+    start = 0
+    while pending and start < len(email_ids):
+      batch = email_ids[start:start + min(len(pending), EMAIL_FETCH_CHUNK_SIZE)]
+      start += len(batch)
+      emails = self.mail_backend.run(lambda mail: mail.fetch_many(batch))
+      for email_id in batch:
+        text = searchable_text(emails.get(email_id))
+        still_pending = []
+        for order_id in pending:
+          if order_id.encode("utf-8") in text:
+            result[order_id] = emails[email_id]
+          else:
+            still_pending.append(order_id)
+        pending = still_pending
+    return result
+
+  def get_cached_order_info(self, order_id) -> Optional[OrderInfo]:
+    """
+    The stored order info, or None if the order needs fetching from email:
+    it's new, or we attempted to fetch it previously but weren't able to find
+    a cost (i.e. cost is still 0) and its backoff since the last miss has elapsed.
+    """
+    order_info = self.orders_dict.get(order_id)
+    if order_info is not None and order_info.cost != 0:
+      instrumentation.count("order_info.cache.hit")
+      return order_info
+    if order_info is not None and not self.should_retry(order_id):
+      instrumentation.count("order_info.backoff_skip")
+      return order_info
+    return None
+
+  def fetch_order_info(self, order_id) -> OrderInfo:
+    self.migrate_email_ids()
+    instrumentation.count("order_info.cache.miss")
+    return self.record_fetched(order_id, self.load_order_total(order_id))
+
+  def record_fetched(self, order_id, from_email: Dict[str, OrderInfo]) -> OrderInfo:
+    if not from_email:
+      from_email = {order_id: OrderInfo(None, 0.0)}
+    with self.lock:
+      # Another thread may have found some of these orders meanwhile (e.g.
+      # through the same split-order email); never replace a cost with a miss.
+      from_email = {
+          found_id: order_info
+          for found_id, order_info in from_email.items()
+          if order_info.cost or not self.has_cost(found_id)
+      }
+      self.orders_dict.update(from_email)
+      self.record_attempt(order_id, from_email)
+      return self.orders_dict[order_id]
+
+  def has_cost(self, order_id) -> bool:
+    order_info = self.orders_dict.get(order_id)
+    return order_info is not None and order_info.cost != 0
+
+  def should_retry(self, order_id) -> bool:
+    miss = self.misses_dict.get(order_id)
+    if not miss:
+      return True
+    attempts, last_attempt = miss
+    return time.time() - last_attempt >= miss_retry_delay(attempts)
+
+  def record_attempt(self, order_id, from_email: Dict[str, OrderInfo]) -> None:
+    for found_id, order_info in from_email.items():
+      if order_info.cost and found_id in self.misses_dict:
+        del self.misses_dict[found_id]
+    if (order_id not in from_email or not from_email[order_id].cost) and not self.has_cost(order_id):
+      attempts, _ = self.misses_dict.get(order_id, (0, 0.0))
+      self.misses_dict[order_id] = (attempts + 1, time.time())
 
   def load_order_total(self, order_id: str) -> Dict[str, OrderInfo]:
+    email_id, data = self.get_relevant_raw_email_data(order_id)
+    return self.parse_order_email(order_id, email_id, data)
+
+  def parse_order_email(self, order_id: str, email_id, data) -> Dict[str, OrderInfo]:
     if order_id.startswith("BBY01"):
-      return self.load_order_total_bb(order_id)
+      return self.parse_order_total_bb(order_id, email_id, data)
     else:
-      return self.load_order_total_amazon(order_id)
+      return self.parse_order_total_amazon(order_id, email_id, data)
 
-  def load_order_total_bb(self, order_id: str) -> Dict[str, OrderInfo]:
-    email_id, data = self.get_relevant_raw_email_data(order_id)
+  def parse_order_total_bb(self, order_id: str, email_id, data) -> Dict[str, OrderInfo]:
     if not data:
       print("Could not find email for order ID %s" % order_id)
       return {}
@@ -104,51 +406,42 @@ class OrderInfoRetriever:
     tax = float(tax_match.group(1).replace(',', ''))
     return {order_id: OrderInfo(email_id, subtotal + tax)}
 
-  def load_order_total_amazon(self, order_id: str) -> Dict[str, OrderInfo]:
-    email_id, data = self.get_relevant_raw_email_data(order_id)
+  def parse_order_total_amazon(self, order_id: str, email_id, data) -> Dict[str, OrderInfo]:
     if not data:
       print("Could not find email for order ID %s" % order_id)
       return {}
 
-    raw_email = str(data[0][1])
-    regex_pretax = r'Total Before Tax:[^$]*\$([\d,]+\.\d{2})'
-    regex_est_tax = r'Estimated Tax:[^$]*\$([\d,]+\.\d{2})'
-    regex_order = r'(\d{3}-\d{7}-\d{7})'
+    raw_email = data[0][1]
+    # Sometimes it's been split into multiple orders, with totals for each
+    orders, pretax_totals, taxes = scan_amazon_email(raw_email)
 
-    orders_with_duplicates = re.findall(regex_order, raw_email)
-    orders = []
-    for order in orders_with_duplicates:
-      if order not in orders:
-        orders.append(order)
-
-    # Sometimes it's been split into multiple orders. Find totals for each
-    pretax_totals = [float(cost.replace(',', '')) for cost in re.findall(regex_pretax, raw_email)]
-
-    # personal emails might not have the regexes, need to do something different
+    # personal emails don't have the totals, but list prices in their HTML instead
     if not pretax_totals:
+      if not AMAZON_PRICE_CELL_REGEX.search(raw_email):
+        return {}
       return self.get_personal_amazon_totals(email_id, data, orders)
 
-    taxes = [float(cost.replace(',', '')) for cost in re.findall(regex_est_tax, raw_email)]
-
     order_infos = [OrderInfo(email_id, t[0] + t[1]) for t in zip(pretax_totals, taxes)]
     return dict(zip(orders, order_infos))
 
   def get_relevant_raw_email_data(self, order_id) -> Union[str, Optional[str]]:
-    status, search_result = self.mail.uid('SEARCH', None, 'BODY "%s"' % order_id)
-    email_id = search_result[0]
-    if not email_id:
-      return None, None
 
-    email_ids = search_result[0].decode('utf-8').split()
-    if not email_ids:
-      return None, None
+    def search_and_fetch(mail_search):
+      email_ids = mail_search.search(phrase=order_id)
+      if not email_ids:
+        return None, None
+      return mail_search.fetch(email_ids[0])
 
-    result, data = self.mail.uid("FETCH", email_ids[0], "(RFC822)")
-    return email_ids[0], data
+    return self.mail_backend.run(search_and_fetch)
 
   def get_personal_amazon_totals(self, email_id, data, orders) -> Dict[str, OrderInfo]:
+    from bs4 import BeautifulSoup, SoupStrainer
+    # Only the price cells are built into the tree; the rest of the email is skipped.
     soup = BeautifulSoup(
-        quopri.decodestring(data[0][1]), features="html.parser", from_encoding="iso-8859-1")
+        quopri.decodestring(data[0][1]),
+        features="html.parser",
+        from_encoding="iso-8859-1",
+        parse_only=SoupStrainer('td', {"class": "price"}))
     prices = [
         elem.getText().strip().replace(',', '').replace('$', '')
         for elem in soup.find_all('td', {"class": "price"})
@@ -0,0 +1,149 @@
+"""
+Pulls portal tables straight from the JSON endpoints behind their web apps.
+
+The Melul and YRCW sites are single-page apps, so once a Selenium login has
+set their session cookies (and, for some, a token in local storage) the same
+session can page through the underlying JSON with large pages fetched
+concurrently, rather than clicking through the rendered table.
+
+Endpoints are described in the config, since they differ between portals:
+
+  melulReceiptsApi:            # shared by every Melul portal
+    url: https://%s.com/api/receipts   # %s is replaced by the group
+    pageSize: 500
+    fields: {po: ..., cost: ..., trackings: ..., verified: ...}
+  groups:
+    yrcw:
+      trackingsApi:
+        url: https://app.yrcwtech.com/api/trackings
+        tokenStorageKey: token           # sent as "Authorization: Bearer <token>"
+        fields: {tracking: ..., value: ...}
+"""
+
+import math
+from lib import instrumentation
+from typing import Any, Dict, List, Optional
+
+DEFAULT_PAGE_SIZE = 500
+MAX_CONCURRENT_PAGES = 8
+
+MELUL_RECEIPT_FIELDS = {"po": "po", "cost": "cost", "trackings": "trackings", "verified": "verified"}
+YRCW_TRACKING_FIELDS = {"tracking": "tracking_number", "value": "amount"}
+
+
+class PortalApiError(Exception):
+  pass
+
+
+class JsonTable:
+  """A paged JSON endpoint returning `{items_key: [...], total_key: N}` per page."""
+
+  def __init__(self,
+               url: str,
+               fields: Dict[str, str],
+               page_size: int = DEFAULT_PAGE_SIZE,
+               items_key: str = "items",
+               total_key: str = "total",
+               page_param: str = "page",
+               size_param: str = "limit",
+               first_page: int = 1,
+               token_storage_key: Optional[str] = None) -> None:
+    self.url = url
+    self.fields = fields
+    self.page_size = page_size
+    self.items_key = items_key
+    self.total_key = total_key
+    self.page_param = page_param
+    self.size_param = size_param
+    self.first_page = first_page
+    self.token_storage_key = token_storage_key
+
+  @classmethod
+  def from_config(cls, api_config, default_fields, group=None) -> "JsonTable":
+    url = api_config['url']
+    if group and "%s" in url:
+      url = url % group
+    return cls(
+        url,
+        fields={**default_fields, **api_config.get('fields', {})},
+        page_size=api_config.get('pageSize', DEFAULT_PAGE_SIZE),
+        items_key=api_config.get('itemsKey', "items"),
+        total_key=api_config.get('totalKey', "total"),
+        page_param=api_config.get('pageParam', "page"),
+        size_param=api_config.get('sizeParam', "limit"),
+        first_page=api_config.get('firstPage', 1),
+        token_storage_key=api_config.get('tokenStorageKey'))
+
+  def params(self, page) -> Dict[str, Any]:
+    return {self.page_param: page, self.size_param: self.page_size}
+
+  def field(self, item, name) -> Any:
+    return item.get(self.fields[name])
+
+  def flag(self, item, name) -> bool:
+    """A true/false field, which some portals send as a string ("true", "false") or a number."""
+    value = self.field(item, name)
+    if isinstance(value, str):
+      return value.strip().lower() in ("true", "1", "yes")
+    return bool(value)
+
+
+def session_from_driver(driver, table: JsonTable) -> Dict[str, Any]:
+  """The cookies and headers that let an HTTP client act as the logged-in browser."""
+  cookies = {cookie['name']: cookie['value'] for cookie in driver.get_cookies()}
+  headers = {"Accept": "application/json"}
+  user_agent = driver.execute_script("return navigator.userAgent")
+  if user_agent:
+    headers["User-Agent"] = user_agent
+  if table.token_storage_key:
+    token = driver.execute_script("return window.localStorage.getItem(arguments[0])",
+                                  table.token_storage_key)
+    if not token:
+      raise PortalApiError(f"No {table.token_storage_key} token in local storage")
+    headers["Authorization"] = f"Bearer {token}"
+  return {"cookies": cookies, "headers": headers}
+
+
+async def _fetch_page(session, table: JsonTable, page) -> dict:
+  with instrumentation.span("portal_api.page", url=table.url, page=page):
+    async with session.get(table.url, params=table.params(page)) as response:
+      if response.status != 200:
+        raise PortalApiError(f"{table.url} page {page} returned HTTP {response.status}")
+      result = await response.json(content_type=None)
+  if not isinstance(result, dict) or not isinstance(result.get(table.items_key), list):
+    raise PortalApiError(f"{table.url} page {page} has no '{table.items_key}' list")
+  instrumentation.count("portal_api.items", len(result[table.items_key]))
+  return result
+
+
+async def _fetch_all(table: JsonTable, cookies, headers) -> List[dict]:
+  import aiohttp
+  import asyncio
+  connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_PAGES)
+  async with aiohttp.ClientSession(cookies=cookies, headers=headers,
+                                   connector=connector) as session:
+    first = await _fetch_page(session, table, table.first_page)
+    items = list(first[table.items_key])
+    total = first.get(table.total_key)
+    if total is not None:
+      # The total is known up front, so the remaining pages are fetched together.
+      num_pages = math.ceil(int(total) / table.page_size)
+      pages = range(table.first_page + 1, table.first_page + num_pages)
+      results = await asyncio.gather(*[_fetch_page(session, table, page) for page in pages])
+      for result in results:
+        items.extend(result[table.items_key])
+    else:
+      page = table.first_page
+      last = first
+      while len(last[table.items_key]) >= table.page_size:
+        page += 1
+        last = await _fetch_page(session, table, page)
+        items.extend(last[table.items_key])
+    return items
+
+
+def fetch_all(table: JsonTable, driver) -> List[dict]:
+  """Every item of the table, using the session of the logged-in driver."""
+  import asyncio
+  session = session_from_driver(driver, table)
+  return asyncio.run(_fetch_all(table, session["cookies"], session["headers"]))
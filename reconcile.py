@@ -1,83 +1,245 @@
 #!/usr/bin/env python3
 
 import argparse
-from typing import Dict, Tuple
-import lib.donations
+import contextlib
+import threading
+import time
+from typing import Dict, Optional, Tuple
 from lib import clusters
-import sys
+from lib import instrumentation
+from lib import replay
+from lib import tracking_keys
 from tqdm import tqdm
-import yaml
-from lib.cancelled_items_retriever import CancelledItemsRetriever
 from lib.config import open_config
-from lib.order_info import OrderInfo, OrderInfoRetriever
+from lib.order_info import OrderInfo, OrderInfoRetriever, clear_unresolved_orders
 from lib.group_site_manager import GroupSiteManager
-from lib.driver_creator import DriverCreator
 from lib.reconciliation_uploader import ReconciliationUploader
-from lib.tracking_output import TrackingOutput
-from lib.tracking_uploader import TrackingUploader
+from lib.store import get_store, APPLIED_TRACKINGS_NAMESPACE, ORDERS_NAMESPACE
+
+# The tracking output, cancelled items and WebDriver modules pull in the Google
+# API clients and selenium, so they're imported by the stages that use them.
+
+TRACE_FILE = "output/reconcile_trace.json"
+
+# Portals are loaded this many at a time. A group whose portal fails or is slow
+# can fall back on cost maps saved by an earlier run, if they're recent enough,
+# and portals still loading get a while to finish once reconcile is done (these
+# limits can be set in the "reconciliation" config).
+PORTAL_WORKERS = 4
+DEFAULT_COST_MAPS_MAX_STALE_HOURS = 24
+DEFAULT_COST_MAPS_WAIT_SECONDS = 15 * 60
+DEFAULT_COST_MAPS_EXIT_WAIT_SECONDS = 5 * 60
+
+# The threads loading portals' cost maps, some of which outlive load_group_cost_maps.
+_portal_threads = []
+
+# Incremental runs still rebuild all clusters from scratch once a week.
+FULL_REBUILD_INTERVAL = 7 * 24 * 60 * 60
+LAST_FULL_REBUILD_KEY = "last_full_rebuild"
 
 
 def fill_costs(all_clusters, config):
   print("Filling costs")
   order_info_retriever = OrderInfoRetriever(config)
+  order_infos, errors = order_info_retriever.get_order_infos(
+      [order_id for cluster in all_clusters for order_id in cluster.orders])
+  order_info_retriever.close()
+  for order_id, e in errors.items():
+    print(
+        f"Exception when getting order info for {order_id}. Please check the oldest email associated with that order. Skipping..."
+    )
+    print(str(e))
   for cluster in all_clusters:
     cluster.expected_cost = 0.0
     for order_id in cluster.orders:
-      try:
-        order_info = order_info_retriever.get_order_info(order_id)
-      except Exception as e:
-        print(
-            f"Exception when getting order info for {order_id}. Please check the oldest email associated with that order. Skipping..."
-        )
-        print(str(e))
-        continue
-      cluster.expected_cost += order_info.cost
+      if order_id in order_infos:
+        cluster.expected_cost += order_infos[order_id].cost
 
 
 def fill_email_ids(all_clusters, config):
   order_info_retriever = OrderInfoRetriever(config)
-  total_orders = sum([len(cluster.orders) for cluster in all_clusters])
-  with tqdm(desc='Fetching order costs', unit='order', total=total_orders) as pbar:
-    for cluster in all_clusters:
-      cluster.expected_cost = 0.0
-      cluster.email_ids = set()
-      for order_id in cluster.orders:
-        try:
-          order_info = order_info_retriever.get_order_info(order_id)
-          # Only add the email ID if it's present; don't add Nones!
-          if order_info.email_id:
-            cluster.email_ids.add(order_info.email_id)
-          cluster.expected_cost += order_info.cost
-        except Exception as e:
-          tqdm.write(
-              f"Exception when getting order info for {order_id}. Please check the oldest email associated with that order. Skipping..."
-          )
-          tqdm.write(str(e))
-        pbar.update()
+  order_ids = list(dict.fromkeys(order_id for cluster in all_clusters for order_id in cluster.orders))
+  with tqdm(desc='Fetching order costs', unit='order', total=len(order_ids)) as pbar:
+    order_infos, errors = order_info_retriever.get_order_infos(order_ids, pbar.update)
+    for order_id, e in errors.items():
+      tqdm.write(
+          f"Exception when getting order info for {order_id}. Please check the oldest email associated with that order. Skipping..."
+      )
+      tqdm.write(str(e))
+  order_info_retriever.close()
+
+  for cluster in all_clusters:
+    cluster.expected_cost = 0.0
+    cluster.email_ids = set()
+    for order_id in cluster.orders:
+      if order_id in order_infos:
+        order_info = order_infos[order_id]
+        # Only add the email ID if it's present; don't add Nones!
+        if order_info.email_id:
+          cluster.email_ids.add(order_info.email_id)
+        cluster.expected_cost += order_info.cost
+
 
+def reconciled_groups(config, args) -> list:
+  return list(args.groups) if args.groups else list(config['groups'].keys())
 
-def get_new_tracking_pos_costs_maps(config, group_site_manager, args):
+
+def get_new_tracking_pos_costs_maps(config, group_site_manager, args, archived_by_group=None):
+  """
+  The groups' cost maps merged, in group order. A group's archived entries
+  (see archived_trackings_costs) go in right after its own live entries.
+  """
   print("Loading tracked costs. This will take several minutes.")
   if args.groups:
     print("Only reconciling groups %s" % ",".join(args.groups))
-    groups = args.groups
-  else:
-    groups = config['groups'].keys()
+  groups = reconciled_groups(config, args)
 
+  maps_by_group, stale_ages = load_group_cost_maps(config, group_site_manager, groups)
   trackings_to_costs_map = {}
   po_to_cost_map = {}
   trackings_to_po_map = {}
   for group in groups:
-    trackings_to_po, group_trackings_to_po, group_po_to_cost = group_site_manager.get_new_tracking_pos_costs_maps_with_retry(
-        group)
+    trackings_to_po, group_trackings_to_po, group_po_to_cost = maps_by_group[group]
     trackings_to_costs_map.update({k: (
         group,
         v,
     ) for (k, v) in group_trackings_to_po.items()})
+    if archived_by_group:
+      trackings_to_costs_map.update(
+          {k: (group, v) for (k, v) in archived_by_group.get(group, {}).items()})
     po_to_cost_map.update(group_po_to_cost)
     trackings_to_po_map.update(trackings_to_po)
 
-  return (trackings_to_po_map, trackings_to_costs_map, po_to_cost_map)
+  return (trackings_to_po_map, trackings_to_costs_map, po_to_cost_map, stale_ages)
+
+
+def load_group_cost_maps(config, group_site_manager,
+                         groups) -> Tuple[Dict[str, tuple], Dict[str, float]]:
+  """
+  Loads the groups' (tracking->PO, trackings->cost, PO->cost) maps from their
+  portals, PORTAL_WORKERS at a time, saving each group's as its last good
+  maps. A group whose portal fails, hasn't answered within
+  "costMapsWaitSeconds" of starting to load, or is still queued behind other
+  portals "costMapsWaitSeconds" after loading began, falls back on its last good maps
+  if they're at most "costMapsMaxStaleHours" old, while its portal keeps
+  loading in the background (without prompting for a login) to refresh them.
+  Returns the maps by group, and the age in seconds of those that are stale.
+  """
+  from concurrent.futures import Future, TimeoutError
+  reconciliation_config = config.get('reconciliation', {})
+  max_stale_seconds = reconciliation_config.get('costMapsMaxStaleHours',
+                                                DEFAULT_COST_MAPS_MAX_STALE_HOURS) * 60 * 60
+  wait_seconds = reconciliation_config.get('costMapsWaitSeconds', DEFAULT_COST_MAPS_WAIT_SECONDS)
+  store = get_store()
+  workers = threading.BoundedSemaphore(PORTAL_WORKERS)
+  started = {group: threading.Event() for group in groups}
+  start_times = {}
+
+  def refresh(group, future):
+    with workers:
+      if not future.set_running_or_notify_cancel():
+        return
+      start_times[group] = time.time()
+      started[group].set()
+      try:
+        with instrumentation.span("portal." + group):
+          maps = group_site_manager.get_new_tracking_pos_costs_maps_with_retry(group)
+        store.put_cost_maps(group, *maps)
+        future.set_result(maps)
+      except BaseException as e:
+        future.set_exception(e)
+
+  # Daemon threads, so portals still loading in the background can't keep the
+  # process alive (see finish_background_refreshes).
+  futures = {}
+  for group in groups:
+    futures[group] = Future()
+    thread = threading.Thread(target=refresh, args=(group, futures[group]), daemon=True)
+    thread.start()
+    _portal_threads.append(thread)
+
+  maps_by_group = {}
+  stale_ages = {}
+  load_start = time.time()
+  try:
+    for group, future in futures.items():
+      try:
+        # Each group's wait starts when its portal does, but queueing behind hung
+        # portals is bounded too.
+        if started[group].wait(max(0, load_start + wait_seconds - time.time())):
+          remaining = start_times[group] + wait_seconds - time.time()
+          maps_by_group[group] = future.result(timeout=max(0, remaining))
+          continue
+        problem = f"is still queued behind other portals after {wait_seconds}s"
+        error = None
+      except TimeoutError:
+        problem = f"hasn't answered in {wait_seconds}s"
+        error = None
+      except Exception as e:
+        problem = f"failed ({e})"
+        error = e
+      age = store.get_cost_maps_age(group)
+      has_recent_maps = age is not None and age <= max_stale_seconds
+      if has_recent_maps and error is None and not group_site_manager.forbid_login_prompts(group):
+        # Someone is at the console logging in, so it's worth waiting for.
+        print(f"Portal for group {group} {problem} but is logging in; waiting for it")
+        try:
+          maps_by_group[group] = future.result()
+          continue
+        except Exception as e:
+          problem = f"failed ({e})"
+      if has_recent_maps:
+        print(f"Portal for group {group} {problem}; using its cost maps from "
+              f"{age / 60 / 60:.1f} hours ago")
+        # Maps saved before trackings were canonicalized still need it.
+        maps_by_group[group] = tracking_keys.canonical_cost_maps(group,
+                                                                 *store.get_cost_maps(group))
+        stale_ages[group] = age
+        instrumentation.count("portal.stale_groups")
+      elif error is not None:
+        raise error
+      else:
+        print(f"Portal for group {group} {problem} and has no recent cost maps; waiting for it")
+        maps_by_group[group] = future.result()
+  except BaseException:
+    for future in futures.values():
+      future.cancel()
+    raise
+  return maps_by_group, stale_ages
+
+
+def finish_background_refreshes(config) -> None:
+  """
+  Gives portals still loading in the background up to "costMapsExitWaitSeconds"
+  in total to save their maps for the next run, then lets the process exit.
+  """
+  exit_wait_seconds = config.get('reconciliation', {}).get('costMapsExitWaitSeconds',
+                                                           DEFAULT_COST_MAPS_EXIT_WAIT_SECONDS)
+  running = [thread for thread in _portal_threads if thread.is_alive()]
+  if running:
+    print(f"Waiting up to {exit_wait_seconds}s for {len(running)} portals to finish loading")
+  deadline = time.time() + exit_wait_seconds
+  for thread in running:
+    thread.join(max(0, deadline - time.time()))
+  unfinished = sum(thread.is_alive() for thread in running)
+  if unfinished:
+    print(f"Not waiting for {unfinished} portals still loading; they'll refresh on the next run")
+  _portal_threads.clear()
+
+
+def archived_trackings_costs(clusters_by_tracking, archives_by_group) -> Dict[str, dict]:
+  """
+  The entries of the groups' archives (see GroupSiteManager.get_archives) that
+  include a tracking of the clusters, as trackings->cost maps by group.
+  """
+  result = {}
+  for group, archives in archives_by_group.items():
+    group_result = result.setdefault(group, {})
+    for archive in archives:
+      for tracking in clusters_by_tracking:
+        for trackings_tuple, cost in archive.trackings_entries(tracking):
+          group_result[trackings_tuple] = cost
+  return result
 
 
 def map_clusters_by_tracking(all_clusters):
@@ -89,6 +251,9 @@ def map_clusters_by_tracking(all_clusters):
 
 
 def merge_by_trackings_tuples(clusters_by_tracking, trackings_to_cost, all_clusters):
+  # Track merged-away clusters by identity so removal is O(1) per merge; the
+  # surviving cluster list is rebuilt once at the end (in its original order).
+  removed_ids = set()
   for trackings_tuple, cost in trackings_to_cost.items():
     if len(trackings_tuple) == 1:
       continue
@@ -106,14 +271,18 @@ def merge_by_trackings_tuples(clusters_by_tracking, trackings_to_cost, all_clust
     # then set all trackings to have the first cluster as their value
     first_cluster = cluster_list[0]
     for other_cluster in cluster_list[1:]:
+      if other_cluster is first_cluster:
+        continue
       if not (other_cluster.trackings.issubset(first_cluster.trackings) and
               other_cluster.orders.issubset(first_cluster.orders)):
-        if other_cluster in all_clusters:
-          all_clusters.remove(other_cluster)
+        removed_ids.add(id(other_cluster))
         first_cluster.merge_with(other_cluster)
     for tracking in trackings_tuple:
       clusters_by_tracking[tracking] = first_cluster
 
+  if removed_ids:
+    all_clusters[:] = [cluster for cluster in all_clusters if id(cluster) not in removed_ids]
+
 
 def fill_costs_new(clusters_by_tracking, trackings_to_cost, po_to_cost, args):
   for cluster in clusters_by_tracking.values():
@@ -128,6 +297,7 @@ def fill_costs_new(clusters_by_tracking, trackings_to_cost, po_to_cost, args):
   for trackings_tuple, (group, cost) in trackings_to_cost.items():
     first_tracking: str = trackings_tuple[0]
     if first_tracking in clusters_by_tracking:
+      tracking_keys.note_join(first_tracking, group, tracking_keys.TRACKING_OUTPUT)
       cluster = clusters_by_tracking[first_tracking]
       cluster.tracked_cost += cost
       for tracking in trackings_tuple:
@@ -145,6 +315,7 @@ def fill_costs_new(clusters_by_tracking, trackings_to_cost, po_to_cost, args):
 
 
 def fill_cancellations(all_clusters, config):
+  from lib.cancelled_items_retriever import CancelledItemsRetriever
   retriever = CancelledItemsRetriever(config)
   cancellations_by_order = retriever.get_cancelled_items()
 
@@ -155,36 +326,208 @@ def fill_cancellations(all_clusters, config):
         cluster.cancelled_items += cancellations_by_order[order]
 
 
-def reconcile_new(config, args):
-  reconciliation_uploader = ReconciliationUploader(config)
+def filter_trackings_by_groups(trackings, groups, existing_clusters=()) -> list:
+  """
+  The trackings of the given groups, plus any other tracking sharing an order
+  with them (update_clusters would put it in the same cluster) or a cluster of
+  the last full run (e.g. joined through a portal's trackings tuple or an email).
+  """
+  selected = set(t.tracking_number for t in trackings if t.group in groups)
+  joined = set()
+  for cluster in existing_clusters:
+    if not selected.isdisjoint(cluster.trackings):
+      joined.update(cluster.trackings)
+  included = [t for t in trackings if t.group in groups or t.tracking_number in joined]
+  orders = set(order for t in included for order in t.order_ids)
+  return [
+      t for t in trackings
+      if t.group in groups or t.tracking_number in joined or orders.intersection(t.order_ids)
+  ]
+
+
+def tracking_fingerprint(tracking) -> tuple:
+  return (tracking.group, tuple(sorted(tracking.order_ids)), str(tracking.ship_date),
+          str(tracking.delivery_date), tracking.to_email)
+
+
+def plan_incremental(config, reconcilable_trackings) -> Optional[Tuple[list, list]]:
+  """
+  Returns the clusters persisted by the last run and the trackings added or
+  changed since, or None if this run should rebuild everything from scratch.
+  """
+  store = get_store()
+  last_full_rebuild = store.get_meta(LAST_FULL_REBUILD_KEY)
+  if not last_full_rebuild or time.time() - float(last_full_rebuild) > FULL_REBUILD_INTERVAL:
+    print("Last full rebuild is missing or too old; rebuilding all clusters")
+    return None
+
+  applied = store.table(APPLIED_TRACKINGS_NAMESPACE).load_all()
+  current = set(t.tracking_number for t in reconcilable_trackings)
+  if any(tracking_number not in current for tracking_number in applied):
+    print("Some trackings were removed since the last run; rebuilding all clusters")
+    return None
+
+  new_trackings = []
+  for tracking in reconcilable_trackings:
+    previous = applied.get(tracking.tracking_number)
+    fingerprint = tracking_fingerprint(tracking)
+    if previous == fingerprint:
+      continue
+    # Clusters only ever grow, so a tracking that moved group or lost orders needs a rebuild.
+    if previous is not None and previous[:2] != fingerprint[:2]:
+      print(f"Tracking {tracking.tracking_number} changed orders or group; rebuilding all clusters")
+      return None
+    new_trackings.append(tracking)
+
+  existing_clusters = clusters.get_existing_clusters(config)
+  if not existing_clusters:
+    return None
+  return existing_clusters, new_trackings
+
+
+def unresolved_clusters(all_clusters) -> list:
+  """
+  The clusters whose cost isn't settled: an order's cost isn't known yet (e.g.
+  its email hadn't arrived), or became known after the cluster was last filled.
+  """
+  orders = get_store().table(ORDERS_NAMESPACE)
+  unresolved = []
+  for cluster in all_clusters:
+    order_infos = [orders.get(order_id) for order_id in cluster.orders]
+    if any(order_info is None or not order_info.cost for order_info in order_infos):
+      unresolved.append(cluster)
+      continue
+    email_ids = set(order_info.email_id for order_info in order_infos if order_info.email_id)
+    cost = sum(order_info.cost for order_info in order_infos)
+    if email_ids != cluster.email_ids or abs(cost - cluster.expected_cost) > 0.005:
+      unresolved.append(cluster)
+  return unresolved
 
-  tracking_output = TrackingOutput(config)
-  trackings = tracking_output.get_existing_trackings()
-  reconcilable_trackings = [t for t in trackings if t.reconcile]
-  # start from scratch
-  all_clusters = []
-  clusters.update_clusters(all_clusters, reconcilable_trackings)
 
-  fill_email_ids(all_clusters, config)
-  all_clusters = clusters.merge_orders(all_clusters)
-  fill_costs(all_clusters, config)
+def record_applied_trackings(reconcilable_trackings, full_rebuild) -> None:
+  store = get_store()
+  store.table(APPLIED_TRACKINGS_NAMESPACE).replace_all(
+      {t.tracking_number: tracking_fingerprint(t) for t in reconcilable_trackings})
+  if full_rebuild:
+    store.set_meta(LAST_FULL_REBUILD_KEY, str(time.time()))
 
-  # add manual PO entries (and only manual ones)
-  reconciliation_uploader.override_pos_and_costs(all_clusters)
 
+def reconcile_new(config, args):
+  reconciliation_uploader = ReconciliationUploader(config)
+
+  with instrumentation.span("reconcile.load_trackings"):
+    from lib.tracking_output import TrackingOutput
+    tracking_output = TrackingOutput(config)
+    trackings = tracking_output.get_existing_trackings()
+    reconcilable_trackings = [t for t in trackings if t.reconcile]
+    for tracking in reconcilable_trackings:
+      tracking.tracking_number = tracking_keys.canonical_tracking(tracking.tracking_number,
+                                                                  tracking_keys.TRACKING_OUTPUT)
+  if args.groups:
+    reconcilable_trackings = filter_trackings_by_groups(reconcilable_trackings, args.groups,
+                                                        clusters.get_existing_clusters(config))
+  instrumentation.count("reconcile.trackings", len(reconcilable_trackings))
+
+  # A --groups run only sees part of the trackings, so it neither starts from
+  # nor replaces the persisted clusters.
+  if args.incremental and args.groups:
+    print("Ignoring --incremental since only some groups are being reconciled")
+  plan = None
+  if args.incremental and not args.groups:
+    plan = plan_incremental(config, reconcilable_trackings)
+  if plan:
+    all_clusters, new_trackings = plan
+    print(f"Applying {len(new_trackings)} new or changed trackings to {len(all_clusters)} "
+          "existing clusters")
+    with instrumentation.span("reconcile.update_clusters"):
+      affected = clusters.update_clusters(all_clusters, new_trackings)
+      # Clusters whose cost wasn't settled last time are filled again, as a full rebuild would.
+      affected_ids = set(id(cluster) for cluster in affected)
+      affected.extend(cluster for cluster in unresolved_clusters(all_clusters)
+                      if id(cluster) not in affected_ids)
+      # A full rebuild merges before any POs are filled in, so the POs the
+      # persisted clusters picked up last run mustn't merge anything either;
+      # override_pos_and_costs restores them from the sheet below.
+      for cluster in all_clusters:
+        cluster.purchase_orders = set()
+
+    with instrumentation.span("reconcile.fill_email_ids"):
+      fill_email_ids(affected, config)
+    with instrumentation.span("reconcile.merge_orders"):
+      all_clusters, affected = clusters.merge_affected_orders(all_clusters, affected)
+    with instrumentation.span("reconcile.fill_costs"):
+      fill_costs(affected, config)
+
+    # add manual PO entries (and only manual ones)
+    with instrumentation.span("reconcile.override_pos_and_costs"):
+      reconciliation_uploader.override_pos_and_costs(all_clusters)
+  else:
+    # start from scratch
+    processes = args.processes
+    with instrumentation.span("reconcile.update_clusters"):
+      if processes > 1:
+        all_clusters = clusters.update_clusters_sharded(reconcilable_trackings, processes)
+      else:
+        all_clusters = []
+        clusters.update_clusters(all_clusters, reconcilable_trackings)
+
+    with instrumentation.span("reconcile.fill_email_ids"):
+      fill_email_ids(all_clusters, config)
+    with instrumentation.span("reconcile.merge_orders"):
+      if processes > 1:
+        all_clusters = clusters.merge_orders_sharded(all_clusters, processes)
+      else:
+        all_clusters = clusters.merge_orders(all_clusters)
+    with instrumentation.span("reconcile.fill_costs"):
+      fill_costs(all_clusters, config)
+
+    # add manual PO entries (and only manual ones)
+    with instrumentation.span("reconcile.override_pos_and_costs"):
+      reconciliation_uploader.override_pos_and_costs(all_clusters)
+
+  from lib.driver_creator import DriverCreator
   driver_creator = DriverCreator()
   group_site_manager = GroupSiteManager(config, driver_creator)
 
-  trackings_to_po, trackings_to_cost, po_to_cost = get_new_tracking_pos_costs_maps(config, group_site_manager, args)
-
-  clusters_by_tracking = map_clusters_by_tracking(all_clusters)
-  merge_by_trackings_tuples(clusters_by_tracking, trackings_to_cost, all_clusters)
-
-  fill_costs_new(clusters_by_tracking, trackings_to_cost, po_to_cost, args)
-
-  fill_cancellations(all_clusters, config)
-  fill_purchase_orders(all_clusters, trackings_to_po, args)
-  reconciliation_uploader.download_upload_clusters_new(all_clusters)
+  with instrumentation.span("reconcile.archived_costs"):
+    archives_by_group = {
+        group: group_site_manager.get_archives(group) for group in reconciled_groups(config, args)
+    }
+    clusters_by_tracking = map_clusters_by_tracking(all_clusters)
+    # Archives are only queried for the trackings being reconciled, not loaded whole.
+    archived_by_group = archived_trackings_costs(clusters_by_tracking, archives_by_group)
+    for archives in archives_by_group.values():
+      for archive in archives:
+        archive.close()
+
+  with instrumentation.span("reconcile.get_tracking_pos_costs_maps"):
+    trackings_to_po, trackings_to_cost, po_to_cost, stale_ages = get_new_tracking_pos_costs_maps(
+        config, group_site_manager, args, archived_by_group)
+
+  with instrumentation.span("reconcile.merge_by_trackings_tuples"):
+    merge_by_trackings_tuples(clusters_by_tracking, trackings_to_cost, all_clusters)
+
+  with instrumentation.span("reconcile.fill_costs_new"):
+    fill_costs_new(clusters_by_tracking, trackings_to_cost, po_to_cost, args)
+
+  with instrumentation.span("reconcile.fill_cancellations"):
+    fill_cancellations(all_clusters, config)
+  with instrumentation.span("reconcile.fill_purchase_orders"):
+    fill_purchase_orders(all_clusters, trackings_to_po, args)
+  with instrumentation.span("reconcile.upload"):
+    reconciliation_uploader.download_upload_clusters_new(all_clusters, args.groups)
+  if not args.groups:
+    with instrumentation.span("reconcile.write_clusters"):
+      clusters.write_clusters(config, all_clusters)
+      record_applied_trackings(reconcilable_trackings, full_rebuild=not plan)
+  instrumentation.count("reconcile.clusters", len(all_clusters))
+  recovered = tracking_keys.recovered_matches()
+  if recovered:
+    print(f"Canonical tracking numbers recovered {sum(recovered.values())} matches: " + ", ".join(
+        f"{count} from {source}" for source, count in sorted(recovered.items())))
+  if stale_ages:
+    print("WARNING: these groups were reconciled against stale portal data: " + ", ".join(
+        f"{group} (from {age / 60 / 60:.1f} hours ago)" for group, age in sorted(stale_ages.items())))
 
 def fill_purchase_orders(all_clusters, tracking_to_po, args): 
     print("Filling purchase orders")  
@@ -209,11 +552,65 @@ def main():
       "-u",
       action="store_true",
       help="print unknown trackings found in BG portals")
+  parser.add_argument(
+      "--refresh-unresolved",
+      action="store_true",
+      help="retry email lookups for all orders without a cost, ignoring their backoff")
+  parser.add_argument(
+      "--incremental",
+      action="store_true",
+      help="start from the last run's clusters and only apply new or changed trackings "
+      "(a full rebuild still happens weekly, or when trackings were removed or regrouped)")
+  parser.add_argument(
+      "--processes",
+      type=int,
+      default=1,
+      help="build clusters in this many worker processes, sharded by group "
+      "(same result as a single process)")
+  parser.add_argument(
+      "--trace",
+      nargs="?",
+      const=TRACE_FILE,
+      help="time each stage and external call, print a summary and write a Chrome trace "
+      f"(default {TRACE_FILE})")
+  parser.add_argument(
+      "--record",
+      metavar="FIXTURE",
+      help="capture every IMAP, portal, Sheets and Drive response of this run into a fixture")
+  parser.add_argument(
+      "--replay",
+      metavar="FIXTURE",
+      help="run offline against the responses captured in a fixture instead of live services")
   args, _ = parser.parse_known_args()
   config = open_config()
 
+  if args.trace:
+    instrumentation.enable()
+
+  fixture = replay.Fixture()
+  if args.record:
+    backends = replay.recording(fixture)
+  elif args.replay:
+    fixture = replay.Fixture.load(replay.fixture_path(args.replay))
+    backends = replay.replaying(fixture)
+  else:
+    backends = contextlib.nullcontext()
+
   print("Reconciling ...")
-  reconcile_new(config, args)
+  try:
+    with backends:
+      # Before anything reads the store, so a newer backup (e.g. from another machine) is used.
+      get_store().restore_from_drive(config)
+      if args.refresh_unresolved:
+        clear_unresolved_orders()
+      reconcile_new(config, args)
+      finish_background_refreshes(config)
+    if args.record:
+      fixture.save(replay.fixture_path(args.record))
+  finally:
+    if args.trace:
+      instrumentation.print_summary()
+      instrumentation.write_trace(args.trace)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 from lib import clusters
+from lib import instrumentation
+from lib import tracking_keys
 from functools import cmp_to_key
-from lib.objects_to_sheet import ObjectsToSheet
 from typing import Any, TypeVar
 
 _T = TypeVar('_T')
@@ -55,6 +56,25 @@ def clear_formatting(service, base_sheet_id, tab_id, ranges):
     service.spreadsheets().batchUpdate(spreadsheetId=base_sheet_id, body=body).execute()
 
 
+class SheetRow:
+  """A cluster as uploaded to a known sheet row, so its formulas can refer to that row."""
+
+  def __init__(self, cluster, row_number) -> None:
+    self.cluster = cluster
+    self.row_number = row_number
+
+  def get_header(self) -> list:
+    return self.cluster.get_header()
+
+  def to_row(self) -> list:
+    return self.cluster.to_row(self.row_number)
+
+
+def sheet_rows(sorted_clusters) -> list:
+  # Row 1 is the header.
+  return [SheetRow(cluster, i + 2) for i, cluster in enumerate(sorted_clusters)]
+
+
 def get_conditional_formatting_body(service, base_sheet_id, tab_title, num_objects):
   response = service.spreadsheets().get(spreadsheetId=base_sheet_id, ranges=[tab_title]).execute()
   tab = [sheet for sheet in response['sheets'] if sheet['properties']['title'] == tab_title][0]
@@ -99,6 +119,8 @@ def get_conditional_formatting_body(service, base_sheet_id, tab_title, num_objec
       "startColumnIndex": 13, 
       "endColumnIndex": 14  
   }
+  # The rules' formulas are relative to the range's first row and only cover
+  # the uploaded rows, rather than comparing whole open-ended columns.
   total_diff_range = {
       "sheetId": int(tab_id),
       "startRowIndex": 1,
@@ -177,7 +199,7 @@ def get_conditional_formatting_body(service, base_sheet_id, tab_title, num_objec
                       "condition": {
                           "type": "CUSTOM_FORMULA",
                           "values": [{
-                              'userEnteredValue': '=OR((K2:K)+(E2:E)=D2:D, L2:L=TRUE)'
+                              'userEnteredValue': '=OR($K2+$E2=$D2, $L2=TRUE)'
                           }]
                       },
                       "format": {
@@ -201,7 +223,7 @@ def get_conditional_formatting_body(service, base_sheet_id, tab_title, num_objec
                       "condition": {
                           "type": "CUSTOM_FORMULA",
                           "values": [{
-                              'userEnteredValue': '=AND(M2:M<=D2:D*0.05, M2:M>=0)'
+                              'userEnteredValue': '=AND($M2<=$D2*0.05, $M2>=0)'
                           }]
                       },
                       "format": {
@@ -225,7 +247,7 @@ def get_conditional_formatting_body(service, base_sheet_id, tab_title, num_objec
                       "condition": {
                           "type": "CUSTOM_FORMULA",
                           "values": [{
-                              'userEnteredValue': '=(K2:K)+(E2:E)>D2:D'
+                              'userEnteredValue': '=$K2+$E2>$D2'
                           }]
                       },
                       "format": {
@@ -249,7 +271,7 @@ def get_conditional_formatting_body(service, base_sheet_id, tab_title, num_objec
                       "condition": {
                           "type": "CUSTOM_FORMULA",
                           "values": [{
-                              'userEnteredValue': '=(K2:K)+(E2:E)<D2:D'
+                              'userEnteredValue': '=$K2+$E2<$D2'
                           }]
                       },
                       "format": {
@@ -270,8 +292,14 @@ def get_conditional_formatting_body(service, base_sheet_id, tab_title, num_objec
 class ReconciliationUploader:
 
   def __init__(self, config) -> None:
+    from lib.objects_to_sheet import ObjectsToSheet
     self.config = config
-    self.objects_to_sheet = ObjectsToSheet()
+    self.objects_to_sheet = instrumentation.instrument(ObjectsToSheet(), "sheets")
+    if 'chunkedUpload' in config['reconciliation']:
+      from lib.sheet_upload import ChunkedSheetUpload
+      self.sheet_upload = ChunkedSheetUpload.from_config(config)
+    else:
+      self.sheet_upload = self.objects_to_sheet
 
   def override_pos_and_costs(self, all_clusters):
     print("Filling manual PO adjustments")
@@ -279,9 +307,10 @@ class ReconciliationUploader:
     downloaded_clusters = self.objects_to_sheet.download_from_sheet(clusters.from_row,
                                                                     base_sheet_id,
                                                                     "Reconciliation v2")
+    downloads_by_tracking = index_by_tracking(downloaded_clusters)
 
     for cluster in all_clusters:
-      candidate_downloads = self.find_candidate_downloads(cluster, downloaded_clusters)
+      candidate_downloads = self.find_candidate_downloads(cluster, downloads_by_tracking)
       pos = set()
       non_reimbursed_trackings = set()
       total_tracked_cost = 0.0
@@ -293,22 +322,34 @@ class ReconciliationUploader:
       cluster.non_reimbursed_trackings = non_reimbursed_trackings
       cluster.tracked_cost = total_tracked_cost
 
-  def download_upload_clusters_new(self, all_clusters) -> None:
+  def download_upload_clusters_new(self, all_clusters, groups=None) -> None:
+    """
+    Uploads the clusters to the sheet. If only some groups were reconciled,
+    the sheet's rows for clusters outside those groups are carried over as-is.
+    """
     base_sheet_id = self.config['reconciliation']['baseSpreadsheetId']
-    self.fill_adjustments(all_clusters, base_sheet_id, "Reconciliation v2")
+    downloaded_clusters = self.fill_adjustments(all_clusters, base_sheet_id, "Reconciliation v2")
+
+    to_upload = list(all_clusters)
+    if groups:
+      carried_over = carried_over_clusters(downloaded_clusters, all_clusters, groups)
+      print(f"Carrying over {len(carried_over)} clusters outside groups {', '.join(groups)}")
+      to_upload.extend(carried_over)
 
-    all_clusters.sort(key=cmp_to_key(compare))
+    to_upload.sort(key=cmp_to_key(compare))
     print("Uploading new reconciliation to sheet")
-    self.objects_to_sheet.upload_to_sheet(all_clusters, base_sheet_id, "Reconciliation v2",
-                                          get_conditional_formatting_body)
+    self.sheet_upload.upload_to_sheet(sheet_rows(to_upload), base_sheet_id, "Reconciliation v2",
+                                      get_conditional_formatting_body)
 
-  def fill_adjustments(self, all_clusters, base_sheet_id, tab_title) -> None:
+  def fill_adjustments(self, all_clusters, base_sheet_id, tab_title) -> list:
+    """Copies manual adjustments from the sheet onto the clusters, returning the downloaded ones."""
     print("Filling in cost adjustments if applicable")
     downloaded_clusters = self.objects_to_sheet.download_from_sheet(clusters.from_row,
                                                                     base_sheet_id, tab_title)
+    downloads_by_tracking = index_by_tracking(downloaded_clusters)
 
     for cluster in all_clusters:
-      candidate_downloads = self.find_candidate_downloads(cluster, downloaded_clusters)
+      candidate_downloads = self.find_candidate_downloads(cluster, downloads_by_tracking)
       cluster.adjustment = sum([candidate.adjustment for candidate in candidate_downloads])
       cluster.notes = "; ".join(
           [candidate.notes for candidate in candidate_downloads if candidate.notes.strip()])
@@ -323,10 +364,49 @@ class ReconciliationUploader:
           cluster.manual_override = sheet_cluster.manual_override
           cluster.verified = sheet_cluster.verified
           cluster.below_cost = sheet_cluster.below_cost
+    return downloaded_clusters
 
-  def find_candidate_downloads(self, cluster, downloaded_clusters) -> list:
-    result = []
-    for downloaded_cluster in downloaded_clusters:
-      if downloaded_cluster.trackings.intersection(cluster.trackings):
-        result.append(downloaded_cluster)
-    return result
+  def find_candidate_downloads(self, cluster, downloads_by_tracking) -> list:
+    """The downloaded clusters sharing a tracking with the cluster, in sheet order."""
+    result = {}
+    for tracking in cluster.trackings:
+      for position, downloaded_cluster in downloads_by_tracking.get(tracking, ()):
+        tracking_keys.note_join(tracking, tracking_keys.SHEET, tracking_keys.TRACKING_OUTPUT)
+        result[position] = downloaded_cluster
+    return [result[position] for position in sorted(result)]
+
+
+def index_by_tracking(downloaded_clusters) -> dict:
+  """Maps each tracking to the (sheet position, cluster) pairs of the downloaded clusters with it."""
+  result = {}
+  for position, downloaded_cluster in enumerate(downloaded_clusters):
+    for tracking in downloaded_cluster.trackings:
+      result.setdefault(tracking, []).append((position, downloaded_cluster))
+  return result
+
+
+def cluster_groups(cluster) -> set:
+  # Clusters merged across groups have comma-separated groups, e.g. "a, b".
+  return set(group.strip() for group in str(cluster.group).split(','))
+
+
+def carried_over_clusters(downloaded_clusters, all_clusters, groups) -> list:
+  """The downloaded clusters that belong only to groups outside `groups` and weren't rebuilt."""
+  selected = set(groups)
+  rebuilt_trackings = set()
+  for cluster in all_clusters:
+    rebuilt_trackings.update(cluster.trackings)
+  # Rows shared with other groups are rebuilt whole (see filter_trackings_by_groups), unless
+  # they were clustered after the last full run.
+  missing = set()
+  for downloaded in downloaded_clusters:
+    if cluster_groups(downloaded) & selected:
+      missing.update(downloaded.trackings - rebuilt_trackings)
+  if missing:
+    print(f"Warning: {len(missing)} trackings on the sheet weren't rebuilt, e.g. "
+          f"{sorted(missing)[0]}; run a full reconcile to bring them back")
+  return [
+      downloaded for downloaded in downloaded_clusters
+      if not cluster_groups(downloaded) & selected and
+      not downloaded.trackings & rebuilt_trackings
+  ]
@@ -0,0 +1,654 @@
+"""
+Record/replay of the external services reconcile talks to, for offline runs.
+
+Recording wraps the real IMAP connections (or Gmail API backend), WebDrivers,
+ObjectsToSheet and ObjectsToDrive (plus the USA API pull and the portals' JSON
+tables) and captures their responses into a fixture file. Replaying swaps in fake backends serving those responses, so a
+run needs no accounts, network or browser. Both run against a throwaway store,
+leaving the real one's clusters, cost maps and ledgers alone.
+
+IMAP, Gmail API, Sheets, Drive and USA API responses are keyed by call (method and
+arguments), portal JSON tables by URL. WebDriver sessions are replayed in call order per element,
+since page state makes the same call return different results over time.
+"""
+
+import argparse
+import collections
+import contextlib
+import copy
+import os
+import os.path
+import pickle
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+from typing import Any, Dict, List, Tuple
+
+FIXTURES_FOLDER = "fixtures"
+
+# The grid size of a new tab.
+DEFAULT_ROW_COUNT = 1000
+
+# Calls that don't need recording to be replayed (connection setup/teardown).
+_IMAP_DEFAULTS = {"select": ("OK", [b"1"]), "login": ("OK", [b""]), "logout": ("BYE", [b""]),
+                  "close": ("OK", [b""])}
+
+_PLAIN_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+class ReplayError(Exception):
+  """Raised when a replayed run makes a call that wasn't recorded."""
+
+
+class Fixture:
+  """The recorded responses of one run: keyed calls per backend plus WebDriver sessions."""
+
+  def __init__(self) -> None:
+    self.calls: Dict[str, Dict[Any, bytes]] = collections.defaultdict(dict)
+    self.sessions: List[Dict[int, list]] = []
+
+  def save(self, path) -> None:
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    with open(path, 'wb') as stream:
+      pickle.dump({"calls": dict(self.calls), "sessions": self.sessions}, stream)
+    print(f"Saved fixture to {path}")
+
+  @staticmethod
+  def load(path) -> "Fixture":
+    fixture = Fixture()
+    with open(path, 'rb') as stream:
+      state = pickle.load(stream)
+    fixture.calls.update(state["calls"])
+    fixture.sessions = state["sessions"]
+    return fixture
+
+
+def _normalize(value) -> Any:
+  """Reduces a call argument to something hashable and stable across runs."""
+  if isinstance(value, _PLAIN_TYPES):
+    return value
+  if isinstance(value, dict):
+    # configs: the same fixture should replay regardless of credentials
+    return "<dict>"
+  if isinstance(value, (list, tuple)):
+    return tuple(_normalize(v) for v in value)
+  if callable(value):
+    return getattr(value, "__qualname__", type(value).__name__)
+  return type(value).__name__
+
+
+def call_key(method, args, kwargs) -> Tuple:
+  return (method, _normalize(args), tuple(sorted((k, _normalize(v)) for k, v in kwargs.items())))
+
+
+class RecordingProxy:
+  """Forwards method calls to `wrapped`, storing each (pickled) result under its call key."""
+
+  def __init__(self, wrapped, calls) -> None:
+    self._wrapped = wrapped
+    self._calls = calls
+
+  def __getattr__(self, attr):
+    value = getattr(self._wrapped, attr)
+    if not callable(value):
+      return value
+
+    def wrapper(*args, **kwargs):
+      result = value(*args, **kwargs)
+      self._calls[call_key(attr, args, kwargs)] = pickle.dumps(result)
+      return result
+
+    return wrapper
+
+
+class ReplayProxy:
+  """Serves recorded results by call key."""
+
+  def __init__(self, calls, name, defaults=None) -> None:
+    self._calls = calls
+    self._name = name
+    self._defaults = defaults or {}
+
+  def __getattr__(self, attr):
+    if attr.startswith("__"):
+      raise AttributeError(attr)
+
+    def replayed(*args, **kwargs):
+      key = call_key(attr, args, kwargs)
+      if key in self._calls:
+        return pickle.loads(self._calls[key])
+      if attr in self._defaults:
+        return self._defaults[attr]
+      raise ReplayError(f"No recorded {self._name} response for {key}")
+
+    return replayed
+
+
+class RecordingMailBackend(RecordingProxy):
+  """A RecordingProxy for a mail backend: `run` passes fn the proxy, so fn's calls get recorded."""
+
+  def run(self, fn) -> Any:
+    return fn(self)
+
+  def close(self) -> None:
+    self._wrapped.close()
+
+
+class ReplayMailBackend(ReplayProxy):
+  """Serves a mail backend's recorded search and fetch results."""
+
+  def run(self, fn) -> Any:
+    return fn(self)
+
+  def close(self) -> None:
+    pass
+
+
+class FakeObjectsToSheet:
+  """An in-memory ObjectsToSheet: uploads are kept and served back, other reads are replayed."""
+
+  def __init__(self, calls=None) -> None:
+    self.recorded = ReplayProxy(calls if calls is not None else {}, "sheets")
+    self.tabs: Dict[Tuple[str, str], Tuple[list, list]] = {}
+
+  def download_from_sheet(self, from_row_fn, sheet_id, tab_title) -> list:
+    if (sheet_id, tab_title) in self.tabs:
+      header, rows = self.tabs[(sheet_id, tab_title)]
+      return [from_row_fn(header, row) for row in rows]
+    try:
+      return self.recorded.download_from_sheet(from_row_fn, sheet_id, tab_title)
+    except ReplayError:
+      return []
+
+  def upload_to_sheet(self, objects, sheet_id, tab_title, formatting_fn=None) -> None:
+    header = objects[0].get_header() if objects else []
+    rows = [[_as_displayed(value) for value in obj.to_row()] for obj in objects]
+    self.tabs[(sheet_id, tab_title)] = (header, rows)
+
+
+class FakeHttpError(Exception):
+  """Shaped like googleapiclient's HttpError: the HTTP response is in `resp`."""
+
+  def __init__(self, status, message="") -> None:
+    super().__init__(f"HTTP {status} {message}".strip())
+    self.resp = types.SimpleNamespace(status=status)
+
+
+class _FakeRequest:
+
+  def __init__(self, fn) -> None:
+    self.fn = fn
+
+  def execute(self) -> Any:
+    return self.fn()
+
+
+class FakeSheetsService:
+  """
+  An in-memory Sheets API client, for the calls chunked uploads and the
+  formatting helpers make, writing through to a FakeObjectsToSheet's tabs.
+
+  Value writes take `latency` plus `row_latency` per row seconds, fail once
+  with a 503 every `fail_every`th write, and always fail after `max_writes`.
+  With `lost_responses`, failing writes still reach the sheet, as when a
+  response is lost to a timeout.
+  """
+
+  def __init__(self, sheets: FakeObjectsToSheet, latency=0.0, row_latency=0.0, fail_every=0,
+               max_writes=None, lost_responses=False) -> None:
+    self.sheets = sheets
+    self.latency = latency
+    self.row_latency = row_latency
+    self.fail_every = fail_every
+    self.max_writes = max_writes
+    self.lost_responses = lost_responses
+    self.writes = 0
+    self.lock = threading.Lock()
+    self.grids: Dict[Tuple[str, str], list] = {}
+    self.row_counts: Dict[Tuple[str, str], int] = {}
+    self.tab_ids: Dict[str, int] = {}
+
+  def spreadsheets(self) -> "FakeSheetsService":
+    return self
+
+  def values(self) -> "FakeSheetsService":
+    return self
+
+  def get(self, spreadsheetId, ranges=(), fields=None) -> _FakeRequest:
+    tab_title = list(ranges)[0]
+    properties = {
+        "title": tab_title,
+        "sheetId": self.tab_ids.setdefault(tab_title, len(self.tab_ids)),
+        "gridProperties": {
+            "rowCount": self.row_counts.get((spreadsheetId, tab_title), DEFAULT_ROW_COUNT)
+        },
+    }
+    return _FakeRequest(lambda: {"sheets": [{"properties": properties}]})
+
+  def batchUpdate(self, spreadsheetId, body) -> _FakeRequest:
+
+    def execute():
+      titles = {tab_id: title for title, tab_id in self.tab_ids.items()}
+      for request in body["requests"]:
+        properties = request.get("updateSheetProperties", {}).get("properties", {})
+        row_count = properties.get("gridProperties", {}).get("rowCount")
+        if row_count is not None:
+          self.row_counts[(spreadsheetId, titles[properties["sheetId"]])] = row_count
+      return {}
+
+    return _FakeRequest(execute)
+
+  def update(self, spreadsheetId, range, valueInputOption, body) -> _FakeRequest:
+
+    def execute():
+      tab_title, start_row, _ = _parse_range(range)
+      rows = body["values"]
+      time.sleep(self.latency + self.row_latency * len(rows))
+      with self.lock:
+        self.writes += 1
+        error = None
+        if self.max_writes is not None and self.writes > self.max_writes:
+          error = FakeHttpError(503, "unavailable")
+        elif self.fail_every and self.writes % self.fail_every == 0:
+          error = FakeHttpError(503, "try again")
+        if error and not self.lost_responses:
+          raise error
+        row_count = self.row_counts.get((spreadsheetId, tab_title), DEFAULT_ROW_COUNT)
+        if start_row - 1 + len(rows) > row_count:
+          raise FakeHttpError(400, "range exceeds grid limits")
+        grid = self._grid(spreadsheetId, tab_title)
+        while len(grid) < start_row - 1 + len(rows):
+          grid.append([])
+        grid[start_row - 1:start_row - 1 + len(rows)] = [
+            [_as_displayed(value) for value in row] for row in rows
+        ]
+        self._publish(spreadsheetId, tab_title)
+        if error:
+          raise error
+      return {"updatedRows": len(rows)}
+
+    return _FakeRequest(execute)
+
+  def clear(self, spreadsheetId, range, body) -> _FakeRequest:
+
+    def execute():
+      tab_title, start_row, end_row = _parse_range(range)
+      with self.lock:
+        grid = self._grid(spreadsheetId, tab_title)
+        if end_row >= len(grid):
+          del grid[start_row - 1:]
+        else:
+          grid[start_row - 1:end_row] = [[] for _ in grid[start_row - 1:end_row]]
+        self._publish(spreadsheetId, tab_title)
+      return {}
+
+    return _FakeRequest(execute)
+
+  def _grid(self, sheet_id, tab_title) -> list:
+    if (sheet_id, tab_title) not in self.grids:
+      if (sheet_id, tab_title) in self.sheets.tabs:
+        header, rows = self.sheets.tabs[(sheet_id, tab_title)]
+        self.grids[(sheet_id, tab_title)] = [header] + rows
+      else:
+        self.grids[(sheet_id, tab_title)] = []
+    return self.grids[(sheet_id, tab_title)]
+
+  def _publish(self, sheet_id, tab_title) -> None:
+    grid = self.grids[(sheet_id, tab_title)]
+    self.sheets.tabs[(sheet_id, tab_title)] = (grid[0] if grid else [], grid[1:])
+
+
+def _parse_range(a1_range) -> Tuple[str, int, int]:
+  """(tab title, first row, last row) of "'Tab'!A<row>" or "'Tab'!<first>:<last>"."""
+  match = re.fullmatch(r"'(.*)'!(?:A(\d+)|(\d+):(\d+))", a1_range)
+  if not match:
+    raise FakeHttpError(400, "unsupported range " + a1_range)
+  tab_title = match.group(1).replace("''", "'")
+  if match.group(2):
+    return tab_title, int(match.group(2)), int(match.group(2))
+  return tab_title, int(match.group(3)), int(match.group(4))
+
+
+def _as_displayed(value) -> Any:
+  # Sheets treats a leading apostrophe as "keep this as text" and doesn't show it.
+  if isinstance(value, str) and value.startswith("'"):
+    return value[1:]
+  return value
+
+
+class FakeObjectsToDrive:
+  """An in-memory ObjectsToDrive: saved files are served back, other loads are replayed."""
+
+  def __init__(self, calls=None) -> None:
+    self.recorded = ReplayProxy(calls if calls is not None else {}, "drive")
+    self.files: Dict[str, str] = {}
+
+  def save(self, config, filename, local_path) -> None:
+    # Keep a path rather than the bytes so frequent flushes stay cheap.
+    self.files[filename] = local_path
+
+  def load(self, config, filename) -> Any:
+    if filename in self.files:
+      with open(self.files[filename], 'rb') as stream:
+        return pickle.load(stream)
+    try:
+      return self.recorded.load(config, filename)
+    except ReplayError:
+      return None
+
+
+def _is_plain(value) -> bool:
+  if isinstance(value, _PLAIN_TYPES):
+    return True
+  if isinstance(value, (list, tuple)):
+    return all(_is_plain(v) for v in value)
+  if isinstance(value, dict):
+    return all(_is_plain(k) and _is_plain(v) for k, v in value.items())
+  return False
+
+
+class _DriverSession:
+  """Per-handle call logs of one WebDriver and the objects (elements) it returned."""
+
+  def __init__(self) -> None:
+    self.entries: Dict[int, list] = collections.defaultdict(list)
+    self.next_handle = 1
+
+  def encode(self, value) -> Tuple[str, Any]:
+    if _is_plain(value):
+      return ("value", value)
+    if isinstance(value, list):
+      return ("list", [self.encode(v) for v in value])
+    handle = self.next_handle
+    self.next_handle += 1
+    return ("handle", handle, _RecordingHandle(value, self, handle))
+
+
+class _RecordingHandle:
+  """Wraps a WebDriver or WebElement, logging every call and attribute read in order."""
+
+  def __init__(self, wrapped, session, handle) -> None:
+    object.__setattr__(self, "_wrapped", wrapped)
+    object.__setattr__(self, "_session", session)
+    object.__setattr__(self, "_handle", handle)
+
+  def _log(self, attr, kind, encoded) -> Any:
+    if encoded[0] == "handle":
+      self._session.entries[self._handle].append((attr, kind, encoded[:2]))
+      return encoded[2]
+    if encoded[0] == "list":
+      logged = ("list", [e[:2] for e in encoded[1]])
+      self._session.entries[self._handle].append((attr, kind, logged))
+      return [e[2] if e[0] == "handle" else e[1] for e in encoded[1]]
+    self._session.entries[self._handle].append((attr, kind, encoded))
+    return encoded[1]
+
+  def __getattr__(self, attr):
+    value = getattr(self._wrapped, attr)
+    if not callable(value):
+      return self._log(attr, "attr", self._session.encode(value))
+
+    def wrapper(*args, **kwargs):
+      try:
+        result = value(*args, **kwargs)
+      except Exception as e:
+        try:
+          raised = pickle.dumps(e)
+        except Exception:
+          raised = pickle.dumps(Exception(str(e)))
+        self._session.entries[self._handle].append((attr, "call", ("raise", raised)))
+        raise
+      return self._log(attr, "call", self._session.encode(result))
+
+    return wrapper
+
+  def __setattr__(self, attr, value) -> None:
+    setattr(self._wrapped, attr, value)
+
+
+class _ReplayHandle:
+  """Plays back a recorded WebDriver or WebElement, one logged call at a time."""
+
+  def __init__(self, entries, handle) -> None:
+    object.__setattr__(self, "_entries", entries)
+    object.__setattr__(self, "_handle", handle)
+
+  def _decode(self, encoded) -> Any:
+    if encoded[0] == "handle":
+      return _ReplayHandle(self._entries, encoded[1])
+    if encoded[0] == "list":
+      return [self._decode(e) for e in encoded[1]]
+    if encoded[0] == "raise":
+      raise pickle.loads(encoded[1])
+    return encoded[1]
+
+  def _next(self, attr) -> Tuple[str, Any]:
+    queue = self._entries[self._handle]
+    if not queue:
+      raise ReplayError(f"WebDriver replay ran past the recording at {attr}")
+    recorded_attr, kind, encoded = queue.popleft()
+    if recorded_attr != attr:
+      raise ReplayError(f"WebDriver replay expected {recorded_attr} but got {attr}")
+    return kind, encoded
+
+  def __getattr__(self, attr):
+    if attr.startswith("__"):
+      raise AttributeError(attr)
+    queue = self._entries[self._handle]
+    if queue and queue[0][0] == attr and queue[0][1] == "attr":
+      return self._decode(self._next(attr)[1])
+    return lambda *args, **kwargs: self._decode(self._next(attr)[1])
+
+  def __setattr__(self, attr, value) -> None:
+    pass
+
+
+class RecordingDriverCreator:
+  """Wraps a DriverCreator so every driver it creates is logged as a fixture session."""
+
+  def __init__(self, driver_creator, fixture) -> None:
+    self.driver_creator = driver_creator
+    self.fixture = fixture
+
+  @property
+  def args(self):
+    return self.driver_creator.args
+
+  @args.setter
+  def args(self, args) -> None:
+    self.driver_creator.args = args
+
+  def __copy__(self) -> "RecordingDriverCreator":
+    return RecordingDriverCreator(copy.copy(self.driver_creator), self.fixture)
+
+  def new(self, *args, **kwargs) -> Any:
+    session = _DriverSession()
+    self.fixture.sessions.append(session.entries)
+    return _RecordingHandle(self.driver_creator.new(*args, **kwargs), session, 0)
+
+
+class FakeDriverCreator:
+  """Hands out the recorded WebDriver sessions in the order they were created."""
+
+  def __init__(self, fixture=None) -> None:
+    self.args = argparse.Namespace(no_headless=False)
+    self.sessions = collections.deque(fixture.sessions if fixture else [])
+
+  def new(self, *args, **kwargs) -> Any:
+    if not self.sessions:
+      raise ReplayError("No recorded WebDriver sessions left to replay")
+    entries = {
+        handle: collections.deque(calls) for handle, calls in self.sessions.popleft().items()
+    }
+    return _ReplayHandle(collections.defaultdict(collections.deque, entries), 0)
+
+
+def _lib_modules() -> list:
+  return [
+      module for name, module in list(sys.modules.items())
+      if module is not None and (name.startswith("lib.") or name in ("reconcile", "__main__"))
+  ]
+
+
+@contextlib.contextmanager
+def swapped(replacements: Dict[Any, Any]):
+  """
+  Replaces every module-level reference to each original object in the loaded
+  lib modules (and reconcile) with its replacement, restoring them on exit.
+  """
+  undo = []
+  for module in _lib_modules():
+    for name, value in list(vars(module).items()):
+      for original, replacement in replacements.items():
+        if value is original:
+          undo.append((module, name, value))
+          setattr(module, name, replacement)
+  try:
+    yield
+  finally:
+    for module, name, value in reversed(undo):
+      setattr(module, name, value)
+
+
+@contextlib.contextmanager
+def scratch_store():
+  """
+  Points get_store() at a throwaway database for the enclosed code, so a
+  recorded or replayed run neither reads nor overwrites the real one (its
+  clusters, applied trackings, cost maps, ledgers and caches), nor its Drive
+  backup.
+  """
+  from lib import store
+  with tempfile.TemporaryDirectory() as folder:
+    scratch = store.Store(os.path.join(folder, store.DB_FILENAME), drive_backup=False)
+    try:
+      with swapped({
+          store.get_store: lambda path=None: scratch,
+          store.get_sessions_store: lambda: scratch,
+      }):
+        yield scratch
+    finally:
+      scratch.conn.close()
+
+
+@contextlib.contextmanager
+def _patched_attr(owner, name, value):
+  original = getattr(owner, name)
+  setattr(owner, name, value)
+  try:
+    yield
+  finally:
+    setattr(owner, name, original)
+
+
+def _no_sleep_time() -> types.ModuleType:
+  """A stand-in for the time module whose sleep() returns at once (portals wait for page loads)."""
+  module = types.ModuleType("time")
+  module.__dict__.update(vars(time))
+  module.sleep = lambda seconds: None
+  return module
+
+
+@contextlib.contextmanager
+def recording(fixture: Fixture):
+  """Runs the enclosed code against the real services, capturing their responses into `fixture`."""
+  import lib.email_auth as email_auth
+  from lib.driver_creator import DriverCreator
+  from lib.group_site_manager import GroupSiteManager
+  from lib.objects_to_drive import ObjectsToDrive
+  from lib.objects_to_sheet import ObjectsToSheet
+  from lib.mail_backend import open_mail_backend, GMAIL_API_BACKEND
+  from lib.portal_api import fetch_all
+
+  real_email_authentication = email_auth.email_authentication
+  real_usa_prices = GroupSiteManager._get_usa_tracking_pos_prices
+
+  async def record_usa_prices(self):
+    result = await real_usa_prices(self)
+    fixture.calls["usa_api"][call_key("get_usa_tracking_pos_prices", (), {})] = pickle.dumps(result)
+    return result
+
+  def record_mail_backend(config, connections=1):
+    backend = open_mail_backend(config, connections)
+    # IMAP connections are recorded through email_authentication.
+    if config.get('mailBackend') == GMAIL_API_BACKEND:
+      return RecordingMailBackend(backend, fixture.calls["gmail_api"])
+    return backend
+
+  def record_fetch_all(table, driver):
+    result = fetch_all(table, driver)
+    fixture.calls["portal_api"][call_key("fetch_all", (table.url,), {})] = pickle.dumps(result)
+    return result
+
+  replacements = {
+      real_email_authentication:
+          lambda: RecordingProxy(real_email_authentication(), fixture.calls["imap"]),
+      ObjectsToSheet: lambda: RecordingProxy(ObjectsToSheet(), fixture.calls["sheets"]),
+      ObjectsToDrive: lambda: RecordingProxy(ObjectsToDrive(), fixture.calls["drive"]),
+      DriverCreator: lambda: RecordingDriverCreator(DriverCreator(), fixture),
+      open_mail_backend: record_mail_backend,
+      fetch_all: record_fetch_all,
+  }
+  with swapped(replacements), scratch_store(), \
+      _patched_attr(GroupSiteManager, "_get_usa_tracking_pos_prices", record_usa_prices):
+    yield fixture
+
+
+@contextlib.contextmanager
+def replaying(fixture: Fixture):
+  """Runs the enclosed code against fake backends serving the responses recorded in `fixture`."""
+  import lib.email_auth as email_auth
+  import lib.group_site_manager as group_site_manager
+  from lib.driver_creator import DriverCreator
+  from lib.group_site_manager import GroupSiteManager
+  from lib.objects_to_drive import ObjectsToDrive
+  from lib.objects_to_sheet import ObjectsToSheet
+  from lib.mail_backend import open_mail_backend, GMAIL_API_BACKEND
+  from lib.portal_api import fetch_all, session_from_driver
+  from lib.sheet_upload import sheets_service
+
+  sheets = FakeObjectsToSheet(fixture.calls["sheets"])
+  sheets_api = FakeSheetsService(sheets)
+  drive = FakeObjectsToDrive(fixture.calls["drive"])
+  usa_api = ReplayProxy(fixture.calls["usa_api"], "usa_api")
+
+  async def replay_usa_prices(self):
+    return usa_api.get_usa_tracking_pos_prices()
+
+  def replay_mail_backend(config, connections=1):
+    if config.get('mailBackend') == GMAIL_API_BACKEND:
+      return ReplayMailBackend(fixture.calls["gmail_api"], "gmail_api")
+    return open_mail_backend(config, connections)
+
+  portal_api = ReplayProxy(fixture.calls["portal_api"], "portal_api")
+
+  def replay_fetch_all(table, driver):
+    # Reads the session off the driver as the real pull did, keeping the driver's calls in order.
+    session_from_driver(driver, table)
+    return portal_api.fetch_all(table.url)
+
+  driver_creator = FakeDriverCreator(fixture)
+  replacements = {
+      email_auth.email_authentication:
+          lambda: ReplayProxy(fixture.calls["imap"], "imap", _IMAP_DEFAULTS),
+      ObjectsToSheet: lambda: sheets,
+      sheets_service: lambda token_file: sheets_api,
+      ObjectsToDrive: lambda: drive,
+      DriverCreator: lambda: driver_creator,
+      open_mail_backend: replay_mail_backend,
+      fetch_all: replay_fetch_all,
+  }
+  with swapped(replacements), scratch_store(), \
+      _patched_attr(GroupSiteManager, "_get_usa_tracking_pos_prices", replay_usa_prices), \
+      _patched_attr(group_site_manager, "time", _no_sleep_time()):
+    yield fixture
+
+
+def fixture_path(name) -> str:
+  return name if os.path.sep in name or name.endswith(".pickle") else os.path.join(
+      FIXTURES_FOLDER, name + ".pickle")
@@ -0,0 +1,219 @@
+"""
+Uploads rows to a sheet tab through the Sheets API in chunks, rather than as
+the single values write ObjectsToSheet makes, which at our row counts runs into
+request-size limits and timeouts.
+
+Chunks of `chunkRows` rows (the header counts as one) are written up to
+`workers` at a time, each retried with backoff on rate limits, server errors and
+dropped connections. Every chunk the API confirms is recorded in the store as a
+digest of its position and rows, so running a failed upload again only writes
+the chunks the sheet doesn't already hold. The record belongs to one upload (a
+digest of all its chunks) and is only trusted for RESUME_EXPIRY_SECONDS: a
+different upload to the tab, or one long enough ago that the sheet may have been
+edited since, starts over. The record is dropped once an upload completes.
+
+Configured under "reconciliation":
+
+  chunkedUpload:
+    tokenFile: sheets_token.json   # an authorized-user OAuth token with the spreadsheets scope
+    chunkRows: 2000                # optional
+    workers: 4                     # optional
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import threading
+import time
+from lib import instrumentation
+from lib.store import get_store, SHEET_UPLOADS_NAMESPACE
+from typing import Any, Callable, Dict
+
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+DEFAULT_CHUNK_ROWS = 2000
+DEFAULT_WORKERS = 4
+MAX_CHUNK_ATTEMPTS = 5
+CHUNK_RETRY_BASE_SECONDS = 1
+# Rate limiting and server errors; other errors (e.g. a bad range) won't go away on retry.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# The progress record's entry for the upload it belongs to, next to the chunks' start rows.
+UPLOAD_KEY = "upload"
+RESUME_EXPIRY_SECONDS = 24 * 60 * 60
+
+
+def sheets_service(token_file) -> Any:
+  from google.auth.transport.requests import Request
+  from google.oauth2.credentials import Credentials
+  from googleapiclient.discovery import build
+  credentials = Credentials.from_authorized_user_file(token_file, SCOPES)
+  if not credentials.valid:
+    credentials.refresh(Request())
+  return build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+
+
+def is_retriable(error) -> bool:
+  # Socket and SSL errors are OSErrors; API errors carry the HTTP response.
+  if isinstance(error, OSError):
+    return True
+  status = getattr(getattr(error, 'resp', None), 'status', None)
+  return status is not None and int(status) in RETRY_STATUSES
+
+
+def chunk_digest(start_row, rows) -> str:
+  encoded = json.dumps([start_row, rows], default=str)
+  return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def a1_range(tab_title, start_row, end_row=None) -> str:
+  """Column A of `start_row`, or whole rows `start_row` to `end_row` (1-based) if given."""
+  quoted = "'" + tab_title.replace("'", "''") + "'"
+  if end_row is None:
+    return f"{quoted}!A{start_row}"
+  return f"{quoted}!{start_row}:{end_row}"
+
+
+class ChunkedSheetUpload:
+
+  def __init__(self,
+               service_factory: Callable[[], Any],
+               chunk_rows: int = DEFAULT_CHUNK_ROWS,
+               workers: int = DEFAULT_WORKERS) -> None:
+    self.service_factory = service_factory
+    self.chunk_rows = max(1, chunk_rows)
+    self.workers = max(1, workers)
+    self.local = threading.local()
+
+  @classmethod
+  def from_config(cls, config) -> "ChunkedSheetUpload":
+    upload_config = config['reconciliation']['chunkedUpload']
+    token_file = upload_config['tokenFile']
+    return cls(lambda: sheets_service(token_file),
+               upload_config.get('chunkRows', DEFAULT_CHUNK_ROWS),
+               upload_config.get('workers', DEFAULT_WORKERS))
+
+  def _service(self) -> Any:
+    # API clients aren't thread-safe, so each thread builds its own.
+    if not hasattr(self.local, 'service'):
+      self.local.service = self.service_factory()
+    return self.local.service
+
+  def upload_to_sheet(self, objects, sheet_id, tab_title, formatting_fn=None) -> None:
+    """Uploads the objects' rows under their header, like ObjectsToSheet.upload_to_sheet."""
+    header = objects[0].get_header() if objects else []
+    values = [header] + [obj.to_row() for obj in objects]
+    progress = get_store().table(f"{SHEET_UPLOADS_NAMESPACE}/{sheet_id}/{tab_title}")
+    all_chunks = []
+    for start in range(0, len(values), self.chunk_rows):
+      rows = values[start:start + self.chunk_rows]
+      all_chunks.append((start + 1, rows, chunk_digest(start + 1, rows)))
+    encoded = "".join(digest for _, _, digest in all_chunks).encode("utf-8")
+    upload_digest = hashlib.sha256(encoded).hexdigest()
+
+    confirmed = progress.load_all()
+    upload = confirmed.pop(UPLOAD_KEY, None)
+    if (not upload or upload["digest"] != upload_digest or
+        time.time() - upload["started"] > RESUME_EXPIRY_SECONDS):
+      # Another upload may have written the tab since these chunks were confirmed.
+      if confirmed:
+        print("Discarding the progress of an earlier upload")
+      progress.clear()
+      confirmed = {}
+      progress[UPLOAD_KEY] = {"digest": upload_digest, "started": time.time()}
+    chunks = [chunk for chunk in all_chunks if confirmed.get(str(chunk[0])) != chunk[2]]
+    skipped = len(all_chunks) - len(chunks)
+    if skipped:
+      print(f"Resuming upload: {skipped} chunks were already uploaded")
+      instrumentation.count("sheets.chunks_skipped", skipped)
+
+    service = self._service()
+    properties = self._tab_properties(service, sheet_id, tab_title)
+    row_count = properties['gridProperties']['rowCount']
+    if row_count < len(values):
+      self._set_row_count(service, sheet_id, properties['sheetId'], len(values))
+
+    self._write_chunks(sheet_id, tab_title, chunks, progress)
+
+    # Clear what's left of a longer earlier upload.
+    if row_count > len(values):
+      service.spreadsheets().values().clear(spreadsheetId=sheet_id,
+                                            range=a1_range(tab_title, len(values) + 1, row_count),
+                                            body={}).execute()
+    if formatting_fn:
+      body = formatting_fn(service, sheet_id, tab_title, len(objects))
+      service.spreadsheets().batchUpdate(spreadsheetId=sheet_id, body=body).execute()
+    progress.clear()
+
+  def _write_chunks(self, sheet_id, tab_title, chunks, progress) -> None:
+    start = time.perf_counter()
+    written_rows = 0
+    with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+      futures = {
+          executor.submit(self._write_chunk, sheet_id, tab_title, start_row, rows):
+              (start_row, rows, digest) for start_row, rows, digest in chunks
+      }
+      try:
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+          future.result()
+          start_row, rows, digest = futures[future]
+          progress[str(start_row)] = digest
+          written_rows += len(rows)
+          elapsed = max(time.perf_counter() - start, 1e-9)
+          print(f"Uploaded chunk {done}/{len(chunks)} "
+                f"({written_rows} rows, {written_rows / elapsed:.0f} rows/s)")
+      except Exception:
+        # Chunks already confirmed stay recorded, so running again resumes from them.
+        for future in futures:
+          future.cancel()
+        raise
+
+  def _write_chunk(self, sheet_id, tab_title, start_row, rows) -> None:
+    for attempt in range(MAX_CHUNK_ATTEMPTS):
+      if attempt:
+        time.sleep(CHUNK_RETRY_BASE_SECONDS * 2**(attempt - 1))
+      try:
+        with instrumentation.span("sheets.write_chunk", rows=len(rows)):
+          self._service().spreadsheets().values().update(
+              spreadsheetId=sheet_id,
+              range=a1_range(tab_title, start_row),
+              valueInputOption="USER_ENTERED",
+              body={
+                  "values": rows
+              }).execute()
+        return
+      except Exception as error:
+        if not is_retriable(error) or attempt == MAX_CHUNK_ATTEMPTS - 1:
+          raise
+        instrumentation.count("sheets.chunk_retries")
+        if isinstance(error, OSError):
+          # The connection is likely gone; start the next attempt on a new one.
+          self.local.__dict__.pop('service', None)
+
+  def _tab_properties(self, service, sheet_id, tab_title) -> Dict[str, Any]:
+    response = service.spreadsheets().get(spreadsheetId=sheet_id,
+                                          ranges=[tab_title],
+                                          fields="sheets.properties").execute()
+    tabs = [
+        sheet['properties']
+        for sheet in response['sheets']
+        if sheet['properties']['title'] == tab_title
+    ]
+    if not tabs:
+      raise Exception(f"No tab {tab_title} in spreadsheet {sheet_id}")
+    return tabs[0]
+
+  def _set_row_count(self, service, sheet_id, tab_id, row_count) -> None:
+    body = {
+        "requests": [{
+            "updateSheetProperties": {
+                "properties": {
+                    "sheetId": int(tab_id),
+                    "gridProperties": {
+                        "rowCount": row_count
+                    }
+                },
+                "fields": "gridProperties.rowCount"
+            }
+        }]
+    }
+    service.spreadsheets().batchUpdate(spreadsheetId=sheet_id, body=body).execute()
@@ -0,0 +1,375 @@
+import gzip
+import hashlib
+import os.path
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+OUTPUT_FOLDER = "output"
+DB_FILENAME = "reconcile.db"
+DB_FILE = OUTPUT_FOLDER + "/" + DB_FILENAME
+# Live login sessions are kept apart, in a database that is never backed up to Drive.
+SESSIONS_DB_FILE = OUTPUT_FOLDER + "/sessions.db"
+
+ORDERS_NAMESPACE = "orders"
+ORDER_MISSES_NAMESPACE = "order_misses"
+CLUSTERS_NAMESPACE = "clusters"
+APPLIED_TRACKINGS_NAMESPACE = "applied_trackings"
+BROWSER_COOKIES_NAMESPACE = "browser_cookies"
+UPLOAD_LEDGER_NAMESPACE = "upload_ledger"
+SHEET_UPLOADS_NAMESPACE = "sheet_uploads"
+COST_MAP_KINDS = ("tracking_to_po", "trackings_cost", "po_cost")
+
+# Tuple keys (e.g. the trackings tuples of portal cost maps) are stored as a
+# single text column joined with the ASCII unit separator.
+TUPLE_KEY_SEPARATOR = "\x1f"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+  namespace TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value BLOB NOT NULL,
+  PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+# Drive backups are gzipped next to the database; the SHA-256 of the database
+# last uploaded (or restored) is kept beside it, so unchanged databases aren't
+# uploaded again. ObjectsToDrive stores pickles, so the backup goes up as a
+# pickle of {"sha256", "gzipped"}, followed by its digest on its own, which
+# startup compares against .synced without downloading the whole backup.
+BACKUP_SUFFIX = ".gz"
+SYNCED_DIGEST_SUFFIX = ".synced"
+DRIVE_BACKUP_FILENAME = DB_FILENAME + ".backup.pickle"
+DRIVE_DIGEST_FILENAME = DB_FILENAME + ".sha256.pickle"
+BACKUP_COMPRESSION_LEVEL = 6
+BACKUP_CHUNK_SIZE = 1 << 20
+
+_stores: Dict[str, "Store"] = {}
+
+
+def file_digest(path: str) -> str:
+  digest = hashlib.sha256()
+  with open(path, 'rb') as stream:
+    for chunk in iter(lambda: stream.read(BACKUP_CHUNK_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def get_store(path: str = DB_FILE) -> "Store":
+  """Returns the (process-wide) store backed by the database at the given path."""
+  path = os.path.abspath(path)
+  if path not in _stores:
+    _stores[path] = Store(path)
+  return _stores[path]
+
+
+def get_sessions_store() -> "Store":
+  """Returns the local-only store for browser sessions (BROWSER_COOKIES_NAMESPACE)."""
+  path = os.path.abspath(SESSIONS_DB_FILE)
+  if path not in _stores:
+    _stores[path] = Store(path, drive_backup=False)
+    # Sessions used to be saved in the main store, which is backed up.
+    get_store().table(BROWSER_COOKIES_NAMESPACE).clear()
+  return _stores[path]
+
+
+class Table(MutableMapping):
+  """
+  A dict-like view of one namespace of the store.
+
+  Nothing is loaded up front: lookups, membership tests and writes each touch
+  only the rows involved, so memory use doesn't grow with the size of the
+  history. Values are pickled per row.
+  """
+
+  def __init__(self, store: "Store", namespace: str, tuple_keys: bool = False) -> None:
+    self.store = store
+    self.namespace = namespace
+    self.tuple_keys = tuple_keys
+
+  def _encode_key(self, key) -> str:
+    if self.tuple_keys:
+      return TUPLE_KEY_SEPARATOR.join(key)
+    return str(key)
+
+  def _decode_key(self, key: str) -> Any:
+    if self.tuple_keys:
+      return tuple(key.split(TUPLE_KEY_SEPARATOR))
+    return key
+
+  def __getitem__(self, key) -> Any:
+    with self.store.lock:
+      row = self.store.conn.execute("SELECT value FROM kv WHERE namespace = ? AND key = ?",
+                                    (self.namespace, self._encode_key(key))).fetchone()
+    if row is None:
+      raise KeyError(key)
+    return pickle.loads(row[0])
+
+  def __contains__(self, key) -> bool:
+    with self.store.lock:
+      row = self.store.conn.execute("SELECT 1 FROM kv WHERE namespace = ? AND key = ?",
+                                    (self.namespace, self._encode_key(key))).fetchone()
+    return row is not None
+
+  def __setitem__(self, key, value) -> None:
+    self.update({key: value})
+
+  def __delitem__(self, key) -> None:
+    with self.store.lock, self.store.conn:
+      cursor = self.store.conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?",
+                                       (self.namespace, self._encode_key(key)))
+    if not cursor.rowcount:
+      raise KeyError(key)
+
+  def __iter__(self) -> Iterator[Any]:
+    for key in self._encoded_keys():
+      yield self._decode_key(key)
+
+  def __len__(self) -> int:
+    with self.store.lock:
+      return self.store.conn.execute("SELECT COUNT(*) FROM kv WHERE namespace = ?",
+                                     (self.namespace,)).fetchone()[0]
+
+  def update(self, other=(), **kwargs) -> None:
+    """Upserts all entries in a single transaction, skipping rows whose value is unchanged."""
+    items = other.items() if hasattr(other, 'items') else other
+    rows = [(self.namespace, self._encode_key(key), pickle.dumps(value))
+            for key, value in items]
+    rows.extend((self.namespace, self._encode_key(key), pickle.dumps(value))
+                for key, value in kwargs.items())
+    if not rows:
+      return
+    with self.store.lock, self.store.conn:
+      self.store.conn.executemany(
+          "INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?) "
+          "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value "
+          "WHERE kv.value IS NOT excluded.value", rows)
+
+  def clear(self) -> None:
+    with self.store.lock, self.store.conn:
+      self.store.conn.execute("DELETE FROM kv WHERE namespace = ?", (self.namespace,))
+
+  def load_all(self) -> Dict[Any, Any]:
+    """Bulk-loads the whole namespace into a plain dict."""
+    with self.store.lock:
+      rows = self.store.conn.execute("SELECT key, value FROM kv WHERE namespace = ?",
+                                     (self.namespace,)).fetchall()
+    return {self._decode_key(key): pickle.loads(value) for key, value in rows}
+
+  def replace_all(self, mapping) -> None:
+    """Makes the namespace hold exactly the given entries, writing only the rows that differ."""
+    new_keys = set(self._encode_key(key) for key in mapping)
+    stale_keys = [(self.namespace, key) for key in self._encoded_keys() if key not in new_keys]
+    with self.store.lock, self.store.conn:
+      self.store.conn.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?", stale_keys)
+    self.update(mapping)
+
+  def _encoded_keys(self) -> list:
+    with self.store.lock:
+      cursor = self.store.conn.execute("SELECT key FROM kv WHERE namespace = ?", (self.namespace,))
+      return [key for (key,) in cursor]
+
+
+class Store:
+  """
+  A local SQLite database (in WAL mode) holding the order infos, clusters and
+  portal cost maps that used to live in whole-file pickles.
+  """
+
+  def __init__(self, path: str = DB_FILE, drive_backup: bool = True) -> None:
+    """Without `drive_backup`, the database is never restored from or backed up to Drive."""
+    self.path = path
+    self.drive_backup = drive_backup
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+      os.makedirs(folder)
+    self.lock = threading.RLock()
+    self.backup_lock = threading.Lock()
+    self.conn = self._connect()
+    # conn.total_changes as of the last Drive backup made or found current
+    self.backed_up_changes = None
+    self.restore_checked = False
+
+  def _connect(self) -> sqlite3.Connection:
+    conn = sqlite3.connect(self.path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+  def table(self, namespace: str, tuple_keys: bool = False) -> Table:
+    return Table(self, namespace, tuple_keys)
+
+  def get_meta(self, key: str) -> Optional[str]:
+    row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+  def set_meta(self, key: str, value: str) -> None:
+    with self.lock, self.conn:
+      self.conn.execute(
+          "INSERT INTO meta (key, value) VALUES (?, ?) "
+          "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, value))
+
+  def import_once(self, table: Table, loader: Callable[[], Any]) -> bool:
+    """
+    Bulk-loads the dict returned by `loader` (e.g. a legacy pickle) into the
+    table the first time this namespace is seen. Returns True if an import ran.
+    """
+    if self.get_meta("imported:" + table.namespace):
+      return False
+    legacy = loader()
+    if legacy:
+      print(f"Importing {len(legacy)} legacy entries into {table.namespace}")
+      table.update(legacy)
+    self.mark_imported(table)
+    return True
+
+  def mark_imported(self, table: Table) -> None:
+    """Records that the table's contents supersede any legacy pickle."""
+    self.set_meta("imported:" + table.namespace, "1")
+
+  def checkpoint(self) -> None:
+    """Folds the write-ahead log into the main database file (e.g. before copying it)."""
+    with self.lock:
+      self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+  def _synced_digest(self) -> Optional[str]:
+    synced_file = self.path + SYNCED_DIGEST_SUFFIX
+    if not os.path.exists(synced_file):
+      return None
+    with open(synced_file) as stream:
+      return stream.read().strip()
+
+  def is_empty(self) -> bool:
+    with self.lock:
+      return self.conn.execute("SELECT 1 FROM kv LIMIT 1").fetchone() is None
+
+  def restore_from_drive(self, config) -> bool:
+    """
+    Replaces the database with its Drive backup if the local one is empty, or
+    unchanged since it was last synced while Drive has a newer backup (e.g.
+    uploaded from another machine). Checked once per process, before the
+    store's first use. Returns True if it restored.
+    """
+    from lib import instrumentation
+    if self.restore_checked or not self.drive_backup:
+      return False
+    self.restore_checked = True
+    from lib.objects_to_drive import ObjectsToDrive
+    objects_to_drive = instrumentation.instrument(ObjectsToDrive(), "drive")
+    remote_digest = objects_to_drive.load(config, DRIVE_DIGEST_FILENAME)
+    synced_digest = self._synced_digest()
+    if not remote_digest or remote_digest == synced_digest:
+      return False
+    if not self.is_empty():
+      with self.lock:
+        self.checkpoint()
+        local_digest = file_digest(self.path)
+      if local_digest == remote_digest:
+        with open(self.path + SYNCED_DIGEST_SUFFIX, 'w') as stream:
+          stream.write(remote_digest)
+        return False
+      if local_digest != synced_digest:
+        print("Both the local database and its Drive backup changed since they were last "
+              "synced; keeping the local database")
+        return False
+
+    print("Restoring the database from its Drive backup")
+    backup = objects_to_drive.load(config, DRIVE_BACKUP_FILENAME)
+    if not backup or backup["sha256"] != remote_digest:
+      print("The Drive backup is being replaced; keeping the local database")
+      return False
+    restored_file = self.path + ".restored"
+    with open(restored_file, 'wb') as stream:
+      stream.write(gzip.decompress(backup["gzipped"]))
+    if file_digest(restored_file) != remote_digest:
+      os.remove(restored_file)
+      raise Exception("The database restored from Drive doesn't match its digest")
+    instrumentation.count("drive.bytes_downloaded", len(backup["gzipped"]))
+
+    with self.lock:
+      self.conn.close()
+      for suffix in ("-wal", "-shm"):
+        if os.path.exists(self.path + suffix):
+          os.remove(self.path + suffix)
+      os.replace(restored_file, self.path)
+      self.conn = self._connect()
+      with open(self.path + SYNCED_DIGEST_SUFFIX, 'w') as stream:
+        stream.write(remote_digest)
+      self.backed_up_changes = self.conn.total_changes
+    return True
+
+  def backup_to_drive(self, config) -> bool:
+    """
+    Uploads the database to Drive, gzipped, unless its contents match the last
+    upload (whose SHA-256 is kept next to it). Returns True if it uploaded.
+    """
+    from lib import instrumentation
+    if not self.drive_backup:
+      return False
+    with self.backup_lock:
+      with self.lock:
+        changes = self.conn.total_changes
+        if self.backed_up_changes == changes:
+          instrumentation.count("drive.backups_skipped")
+          return False
+        self.checkpoint()
+        digest = file_digest(self.path)
+        if self._synced_digest() == digest:
+          self.backed_up_changes = changes
+          instrumentation.count("drive.backups_skipped")
+          return False
+
+        gzipped_file = self.path + BACKUP_SUFFIX
+        with open(self.path, 'rb') as source, gzip.open(
+            gzipped_file, 'wb', compresslevel=BACKUP_COMPRESSION_LEVEL) as target:
+          shutil.copyfileobj(source, target, BACKUP_CHUNK_SIZE)
+
+      # Uploading doesn't hold the store lock, so lookups can carry on meanwhile.
+      backup_file = self.path + ".backup.pickle"
+      with open(gzipped_file, 'rb') as source, open(backup_file, 'wb') as target:
+        pickle.dump({"sha256": digest, "gzipped": source.read()}, target)
+      digest_file = self.path + ".sha256.pickle"
+      with open(digest_file, 'wb') as stream:
+        pickle.dump(digest, stream)
+      from lib.objects_to_drive import ObjectsToDrive
+      objects_to_drive = instrumentation.instrument(ObjectsToDrive(), "drive")
+      # The digest goes up last, so it never names a backup that isn't there yet.
+      objects_to_drive.save(config, DRIVE_BACKUP_FILENAME, backup_file)
+      objects_to_drive.save(config, DRIVE_DIGEST_FILENAME, digest_file)
+      instrumentation.count("drive.bytes_uploaded", os.path.getsize(backup_file))
+      with open(self.path + SYNCED_DIGEST_SUFFIX, 'w') as stream:
+        stream.write(digest)
+      self.backed_up_changes = changes
+      return True
+
+  def get_cost_maps(self, group: str) -> Optional[Tuple[dict, dict, dict]]:
+    """Returns the last saved (tracking->PO, trackings->cost, PO->cost) maps for a group."""
+    if not self.get_meta("cost_maps:" + group):
+      return None
+    return tuple(self._cost_map_table(group, kind).load_all() for kind in COST_MAP_KINDS)
+
+  def get_cost_maps_age(self, group: str) -> Optional[float]:
+    """Seconds since the group's cost maps were saved, or None if they never were."""
+    saved_at = self.get_meta("cost_maps:" + group)
+    if not saved_at:
+      return None
+    # Maps saved before timestamps were recorded count as arbitrarily old.
+    return time.time() - float(saved_at)
+
+  def put_cost_maps(self, group: str, tracking_to_po, trackings_cost, po_cost) -> None:
+    for kind, mapping in zip(COST_MAP_KINDS, (tracking_to_po, trackings_cost, po_cost)):
+      self._cost_map_table(group, kind).replace_all(mapping)
+    self.set_meta("cost_maps:" + group, str(time.time()))
+
+  def _cost_map_table(self, group: str, kind: str) -> Table:
+    return self.table(f"cost_maps/{group}/{kind}", tuple_keys=(kind == "trackings_cost"))
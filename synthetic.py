@@ -0,0 +1,483 @@
+"""
+Deterministic synthetic datasets for offline benchmarks of the reconcile pipeline.
+
+A dataset of N trackings covers roughly N/2 orders spread over a few groups,
+with the shapes that exercise every stage: split-order emails shared by two
+orders (merged by email ID), portal entries covering two trackings (merged by
+trackings tuple), orders with no email and trackings unknown to the portal.
+Emails are rendered on demand, so memory stays proportional to the trackings.
+"""
+
+import base64
+import contextlib
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+from lib import replay
+from lib.order_info import OrderInfo
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_GROUPS = ("alpha", "beta", "gamma")
+
+# One in SPLIT_EVERY emails covers two orders; one in TUPLE_EVERY order pairs has
+# a portal entry spanning both; one in MISSING_EVERY orders has no email at all.
+SPLIT_EVERY = 10
+TUPLE_EVERY = 20
+MISSING_EVERY = 50
+UNKNOWN_TRACKING_EVERY = 100
+# One in VARIANT_EVERY trackings is listed by its portal in another shape (lower
+# case, dashed), which only matches the tracking output once canonicalized.
+VARIANT_EVERY = 25
+
+# In the email parsing corpus, one in PERSONAL_EVERY emails is a personal-account
+# email and one in NOTICE_EVERY a shipping notice, each padded with item lines.
+PERSONAL_EVERY = 5
+NOTICE_EVERY = 10
+CORPUS_FILLER_LINES = 150
+
+
+class SyntheticTracking:
+  """The subset of a tracking-output Tracking that reconcile reads."""
+  __slots__ = ("tracking_number", "group", "order_ids", "ship_date", "delivery_date", "to_email",
+               "reconcile")
+
+  def __init__(self, tracking_number, group, order_ids, ship_date, delivery_date, to_email) -> None:
+    self.tracking_number = tracking_number
+    self.group = group
+    self.order_ids = order_ids
+    self.ship_date = ship_date
+    self.delivery_date = delivery_date
+    self.to_email = to_email
+    self.reconcile = True
+
+
+def order_id(index) -> str:
+  return "112-%07d-%07d" % (index // 10**7, index % 10**7)
+
+
+def order_index(order_id_str) -> int:
+  _, high, low = order_id_str.split("-")
+  return int(high) * 10**7 + int(low)
+
+
+def tracking_number(index) -> str:
+  return "1ZSYN%013d" % index
+
+
+def portal_tracking(index) -> str:
+  tracking = tracking_number(index)
+  if index % VARIANT_EVERY == 3:
+    return (tracking[:5] + "-" + tracking[5:]).lower()
+  return tracking
+
+
+class SyntheticDataset:
+
+  def __init__(self, num_trackings, groups=DEFAULT_GROUPS) -> None:
+    self.num_trackings = num_trackings
+    self.groups = list(groups)
+    self.num_orders = (num_trackings + 1) // 2
+    self.config = {
+        'groups': {group: {} for group in self.groups},
+        'melulPortals': [],
+        'reconciliation': {
+            'baseSpreadsheetId': 'synthetic'
+        },
+    }
+
+  def group_of(self, order) -> str:
+    # Consecutive order pairs share a group so that split emails and tuple entries can merge.
+    return self.groups[(order // 2) % len(self.groups)]
+
+  def order_cost(self, order) -> Tuple[float, float]:
+    pretax = 10 + (order * 7919 % 50000) / 100
+    return pretax, round(pretax * 0.07, 2)
+
+  def email_uid(self, order) -> Optional[int]:
+    if order % MISSING_EVERY == MISSING_EVERY - 1:
+      return None
+    if order % SPLIT_EVERY == 1:
+      return order - 1
+    return order
+
+  def email_orders(self, uid) -> List[int]:
+    orders = [uid]
+    if uid % SPLIT_EVERY == 0 and uid + 1 < self.num_orders:
+      orders.append(uid + 1)
+    return orders
+
+  def render_email(self, uid, filler_lines=0) -> bytes:
+    lines = ["Subject: Your Amazon.com order", "", "Thanks for your order!"]
+    lines.extend(item_lines(uid, filler_lines))
+    for order in self.email_orders(uid):
+      pretax, tax = self.order_cost(order)
+      lines.append(f"Order #{order_id(order)}")
+      lines.append(f"Total Before Tax: ${pretax:,.2f}")
+      lines.append(f"Estimated Tax: ${tax:,.2f}")
+    return "\r\n".join(lines).encode("utf-8")
+
+  def render_personal_email(self, uid, filler_lines=0) -> bytes:
+    """The email as a personal account gets it: totals only in (quoted-printable) HTML cells."""
+    lines = ["Subject: Your Amazon.com order", "Content-Transfer-Encoding: quoted-printable", ""]
+    lines.append("<html><body><table>")
+    lines.extend(f"<tr><td>{line}</td></tr>" for line in item_lines(uid, filler_lines))
+    for order in self.email_orders(uid):
+      pretax, tax = self.order_cost(order)
+      lines.append(f'<tr><td>Order #{order_id(order)}</td><td class=3D"price">${pretax:,.2f}</td>'
+                   f'<td class=3D"price">${tax:,.2f}</td></tr>')
+    lines.append("</table></body></html>")
+    return "\r\n".join(lines).encode("utf-8")
+
+  def render_notice_email(self, uid, filler_lines=0) -> bytes:
+    """A shipping notice for the email's orders, which mentions them but no totals."""
+    lines = ["Subject: Your Amazon.com order has shipped", ""]
+    lines.extend(item_lines(uid, filler_lines))
+    lines.extend(f"Order #{order_id(order)} is on its way." for order in self.email_orders(uid))
+    return "\r\n".join(lines).encode("utf-8")
+
+  def search_uids(self, criteria: str) -> List[int]:
+    """The UIDs of the emails mentioning any order ID in the search criteria, ascending."""
+    uids = set()
+    for phrase in re.findall(r"112-\d{7}-\d{7}", criteria):
+      order = order_index(phrase)
+      uid = self.email_uid(order) if order < self.num_orders else None
+      if uid is not None:
+        uids.add(uid)
+    return sorted(uids)
+
+  def trackings(self) -> List[SyntheticTracking]:
+    result = []
+    for index in range(self.num_trackings):
+      order = index // 2
+      result.append(
+          SyntheticTracking(
+              tracking_number(index), self.group_of(order), [order_id(order)],
+              "2020-%02d-%02d" % (1 + order % 12, 1 + order % 28),
+              "2020-%02d-%02d" % (1 + order % 12, 1 + (order + 3) % 28),
+              "buyer%d@example.com" % (order % 7)))
+    return result
+
+  def portal_maps(self, group) -> Tuple[Dict[str, str], Dict[tuple, float], Dict[str, float]]:
+    tracking_to_po = {}
+    trackings_to_cost = {}
+    po_to_cost = {}
+    index = 0
+    while index < self.num_trackings:
+      order = index // 2
+      if self.group_of(order) != group or index % UNKNOWN_TRACKING_EVERY == 7:
+        index += 1
+        continue
+      pretax, tax = self.order_cost(order)
+      po = "PO%d" % (order // 3)
+      if order % TUPLE_EVERY == 0 and index % 2 == 1 and index + 1 < self.num_trackings:
+        # The last tracking of this order and the first of the next one were checked in together.
+        next_pretax, next_tax = self.order_cost(order + 1)
+        trackings_to_cost[(portal_tracking(index), portal_tracking(index + 1))] = (
+            (pretax + tax) / 2 + (next_pretax + next_tax) / 2)
+        tracking_to_po[portal_tracking(index)] = po
+        tracking_to_po[portal_tracking(index + 1)] = po
+        index += 2
+        continue
+      trackings_to_cost[(portal_tracking(index),)] = (pretax + tax) / 2
+      tracking_to_po[portal_tracking(index)] = po
+      po_to_cost[po] = po_to_cost.get(po, 0.0) + (pretax + tax) / 2
+      index += 1
+    return tracking_to_po, trackings_to_cost, po_to_cost
+
+  def melul_receipts(self, group) -> List[dict]:
+    """The group's receipts as a Melul JSON endpoint lists them (the default field names)."""
+    tracking_to_po, trackings_to_cost, _ = self.portal_maps(group)
+    return [{
+        "po": tracking_to_po[trackings[0]],
+        "cost": "$%.2f" % cost,
+        "trackings": ",".join(trackings),
+        "verified": True
+    } for trackings, cost in trackings_to_cost.items()]
+
+  def order_infos(self) -> Dict[str, OrderInfo]:
+    """What a fully warmed order cache holds for this dataset."""
+    result = {}
+    for order in range(self.num_orders):
+      uid = self.email_uid(order)
+      pretax, tax = self.order_cost(order)
+      result[order_id(order)] = OrderInfo(str(uid), pretax + tax) if uid is not None else OrderInfo(
+          None, 0.0)
+    return result
+
+
+def item_lines(uid, count) -> List[str]:
+  return [f"Synthetic widget {uid}-{i}, qty 1, ${5 + i % 40}.99" for i in range(count)]
+
+
+def email_corpus(num_emails) -> List[Tuple[str, list, Dict[str, float]]]:
+  """
+  A mix of business-account order emails (some split over two orders),
+  personal-account ones (one in PERSONAL_EVERY) and shipping notices (one in
+  NOTICE_EVERY), padded to a realistic size. Each entry is the order ID the
+  email was found by, its FETCH data and the costs parsing should find.
+  """
+  dataset = SyntheticDataset(num_emails * 4)
+  result = []
+  uid = 0
+  while len(result) < num_emails:
+    if dataset.email_uid(uid) == uid:
+      index = len(result)
+      expected = {
+          order_id(order): round(sum(dataset.order_cost(order)), 2)
+          for order in dataset.email_orders(uid)
+      }
+      if index % NOTICE_EVERY == NOTICE_EVERY - 1:
+        raw, expected = dataset.render_notice_email(uid, CORPUS_FILLER_LINES), {}
+      elif index % PERSONAL_EVERY == 1:
+        raw = dataset.render_personal_email(uid, CORPUS_FILLER_LINES)
+      else:
+        raw = dataset.render_email(uid, CORPUS_FILLER_LINES)
+      data = [(b"%d (UID %d RFC822 {%d}" % (uid, uid, len(raw)), raw), b")"]
+      result.append((order_id(uid), data, expected))
+    uid += 1
+  return result
+
+
+class SyntheticMailbox:
+  """
+  An IMAP stand-in answering the order searches and RFC822 fetches of order
+  lookups, either as a plain IMAP server (BODY searches) or, with `gmail`, as
+  Gmail (X-GM-RAW searches and X-GM-MSGID fetches). Searches are kept in
+  `searches` so the criteria sent can be checked. Each command sleeps for
+  `latency` seconds, standing in for the round trip to a real server.
+  """
+
+  def __init__(self, dataset: SyntheticDataset, gmail: bool = False, latency: float = 0.0) -> None:
+    self.dataset = dataset
+    self.gmail = gmail
+    self.latency = latency
+    self.capabilities = ("IMAP4REV1", "X-GM-EXT-1") if gmail else ("IMAP4REV1",)
+    self.searches = []
+
+  def select(self, mailbox) -> tuple:
+    return ("OK", [str(self.dataset.num_orders).encode()])
+
+  def uid(self, command, *args) -> tuple:
+    if self.latency:
+      time.sleep(self.latency)
+    if command.upper() == "SEARCH":
+      args = [str(arg) for arg in args if arg]
+      self.searches.append(tuple(args))
+      if self.gmail and (len(args) != 2 or args[0] != "X-GM-RAW"):
+        return ("OK", [b""])
+      if not self.gmail and "BODY " not in " ".join(args):
+        return ("OK", [b""])
+      uids = self.dataset.search_uids(" ".join(args))
+      return ("OK", [" ".join(str(uid) for uid in uids).encode()])
+    if command.upper() == "FETCH":
+      data = []
+      for uid in args[0].split(","):
+        uid = int(uid)
+        body = self.dataset.render_email(uid)
+        msgid = b"X-GM-MSGID %d " % gmail_message_id(uid) if "X-GM-MSGID" in args[1] else b""
+        data.append((b"%d (%sUID %d RFC822 {%d}" % (uid, msgid, uid, len(body)), body))
+        data.append(b")")
+      return ("OK", data)
+    raise ValueError("Unsupported synthetic IMAP command " + command)
+
+
+def gmail_message_id(uid) -> int:
+  """The X-GM-MSGID of an email (the Gmail API's message ID is the same number in hex)."""
+  return 10**15 + uid
+
+
+class _GmailApiHandler(http.server.BaseHTTPRequestHandler):
+  """Message searches and batched raw gets, in the shapes the Gmail API returns them."""
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+
+  def do_GET(self) -> None:
+    server = self.server
+    if not self._authorized():
+      return
+    time.sleep(server.latency)
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+    server.requests += 1
+    # Newest first, as the API lists them.
+    uids = reversed(server.dataset.search_uids(query.get("q", [""])[0]))
+    messages = [{"id": "%x" % gmail_message_id(uid)} for uid in uids]
+    self._respond(200, "application/json", json.dumps({"messages": messages}).encode("utf-8"))
+
+  def do_POST(self) -> None:
+    server = self.server
+    if not self._authorized():
+      return
+    time.sleep(server.latency)
+    server.requests += 1
+    body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+    boundary = "batch_response"
+    parts = []
+    for message_id in re.findall(r"GET /gmail/v1/users/me/messages/([0-9a-f]+)\?format=raw", body):
+      raw = server.dataset.render_email(int(message_id, 16) - gmail_message_id(0))
+      message = json.dumps({
+          "id": message_id,
+          "raw": base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+      })
+      parts.append(f"--{boundary}\r\nContent-Type: application/http\r\n\r\n"
+                   f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{message}\r\n")
+    parts.append(f"--{boundary}--\r\n")
+    self._respond(200, f"multipart/mixed; boundary={boundary}", "".join(parts).encode("utf-8"))
+
+  def _authorized(self) -> bool:
+    if self.headers.get("Authorization") == "Bearer " + self.server.token:
+      return True
+    self._respond(401, "application/json", b'{"error": "bad token"}')
+    return False
+
+  def _respond(self, status, content_type, data) -> None:
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+
+@contextlib.contextmanager
+def gmail_api_server(dataset: SyntheticDataset, token: str, latency: float = 0.0):
+  """
+  Serves the dataset's emails on localhost as the Gmail API endpoints
+  gmail_api uses, requiring the bearer `token` and sleeping `latency` seconds
+  per request. Yields the server; its base URL is `server.url`.
+  """
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _GmailApiHandler)
+  server.dataset = dataset
+  server.token = token
+  server.latency = latency
+  server.requests = 0
+  server.url = "http://127.0.0.1:%d" % server.server_address[1]
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  try:
+    yield server
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+class _PortalApiHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self) -> None:
+    server = self.server
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+    if server.session_cookie and server.session_cookie not in self.headers.get("Cookie", ""):
+      return self._respond(401, {"error": "not logged in"})
+    if server.token and self.headers.get("Authorization") != "Bearer " + server.token:
+      return self._respond(401, {"error": "bad token"})
+    page = int(query.get("page", ["1"])[0])
+    limit = int(query.get("limit", ["50"])[0])
+    items = server.items[(page - 1) * limit:page * limit]
+    server.requests += 1
+    self._respond(200, {"items": items, "total": len(server.items)})
+
+  def _respond(self, status, body) -> None:
+    data = json.dumps(body).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args) -> None:
+    pass
+
+
+class SyntheticBrowser:
+  """A logged-in WebDriver as far as portal_api is concerned: its cookies and local storage."""
+
+  def __init__(self, cookies, local_storage=None) -> None:
+    self.cookies = cookies
+    self.local_storage = local_storage or {}
+
+  def get_cookies(self) -> List[dict]:
+    return [{"name": name, "value": value} for name, value in self.cookies.items()]
+
+  def execute_script(self, script, *args) -> Any:
+    if "localStorage" in script:
+      return self.local_storage.get(args[0])
+    return "synthetic-browser"
+
+
+@contextlib.contextmanager
+def portal_api_server(items, session_cookie=None, token=None):
+  """
+  Serves `items` on localhost as a paged JSON endpoint (?page=&limit=, 1-based)
+  in the shape portal_api expects, optionally requiring a "name=value" session
+  cookie or a bearer token. Yields the server; its URL is `server.url`.
+  """
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _PortalApiHandler)
+  server.items = items
+  server.session_cookie = session_cookie
+  server.token = token
+  server.requests = 0
+  server.url = "http://127.0.0.1:%d/receipts" % server.server_address[1]
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  try:
+    yield server
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+class SyntheticTrackingOutput:
+
+  def __init__(self, dataset) -> None:
+    self.dataset = dataset
+
+  def get_existing_trackings(self) -> list:
+    return self.dataset.trackings()
+
+
+class SyntheticCancelledItemsRetriever:
+
+  def get_cancelled_items(self) -> dict:
+    return {}
+
+
+@contextlib.contextmanager
+def synthetic_backends(dataset: SyntheticDataset, gmail: bool = False, mail_latency: float = 0.0):
+  """
+  Runs reconcile against the dataset: synthetic mail (answering as Gmail if
+  `gmail`, taking `mail_latency` seconds per command), trackings and portals,
+  in-memory Sheets/Drive.
+  """
+  import lib.email_auth as email_auth
+  from lib.cancelled_items_retriever import CancelledItemsRetriever
+  from lib.driver_creator import DriverCreator
+  from lib.group_site_manager import GroupSiteManager
+  from lib.objects_to_drive import ObjectsToDrive
+  from lib.objects_to_sheet import ObjectsToSheet
+  from lib.sheet_upload import sheets_service
+  from lib.tracking_output import TrackingOutput
+
+  class SyntheticGroupSiteManager(GroupSiteManager):
+
+    def get_new_tracking_pos_costs_maps(self, group):
+      return dataset.portal_maps(group)
+
+  sheets = replay.FakeObjectsToSheet()
+  sheets_api = replay.FakeSheetsService(sheets)
+  drive = replay.FakeObjectsToDrive()
+  replacements = {
+      email_auth.email_authentication: lambda: SyntheticMailbox(dataset, gmail, mail_latency),
+      ObjectsToSheet: lambda: sheets,
+      sheets_service: lambda token_file: sheets_api,
+      ObjectsToDrive: lambda: drive,
+      DriverCreator: replay.FakeDriverCreator,
+      GroupSiteManager: SyntheticGroupSiteManager,
+      TrackingOutput: lambda config: SyntheticTrackingOutput(dataset),
+      CancelledItemsRetriever: lambda config: SyntheticCancelledItemsRetriever(),
+  }
+  with replay.swapped(replacements):
+    yield sheets
@@ -0,0 +1,110 @@
+"""
+Canonical keys for tracking numbers, so numbers from the tracking output, the
+group portals and the reconciliation sheet join on the same string.
+
+Sources write the same number in different shapes: lower case, padded, with
+dashes or spaces ("1z 999-aa1"), or, for USPS labels, with the "420" + ZIP
+routing prefix of the barcode still in front of the 22-digit number. The
+canonical key is upper case with whitespace and dashes removed, and routed USPS
+barcodes cut down to their tracking number.
+
+Keys are interned and memoized by raw value, since the same numbers come in
+from every source. When a source's raw value differs from its key, the raw
+value is remembered, so joins can tell (and count) the matches that only
+canonicalization made.
+"""
+
+import re
+import sys
+from lib import instrumentation
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+TRACKING_OUTPUT = "tracking_output"
+SHEET = "sheet"
+
+SEPARATORS_REGEX = re.compile(r"[\s-]+")
+# "420", a 5 or 9 digit ZIP, then the 22-digit USPS tracking number.
+USPS_ROUTED_REGEX = re.compile(r"420(?:\d{5}|\d{9})(\d{22})")
+
+# raw value -> canonical key
+_keys: Dict[str, str] = {}
+# source -> canonical key -> the source's raw value, for values that weren't canonical
+_raw_values: Dict[str, Dict[str, str]] = {}
+# source -> the keys that joined another source's numbers only once canonicalized
+_recovered: Dict[str, Set[str]] = {}
+
+
+def _canonicalize(raw: str) -> str:
+  key = SEPARATORS_REGEX.sub("", raw).upper()
+  routed = USPS_ROUTED_REGEX.fullmatch(key)
+  return routed.group(1) if routed else key
+
+
+def canonical_tracking(tracking, source: Optional[str] = None) -> str:
+  raw = tracking if isinstance(tracking, str) else str(tracking)
+  key = _keys.get(raw)
+  if key is None:
+    key = sys.intern(_canonicalize(raw))
+    _keys[raw] = key
+  if source is not None and key != raw:
+    _raw_values.setdefault(source, {})[key] = raw
+  return key
+
+
+def canonical_trackings(trackings: Iterable, source: Optional[str] = None) -> Tuple[str, ...]:
+  """The keys of the (non-blank) trackings, in order."""
+  result = []
+  for tracking in trackings:
+    key = canonical_tracking(tracking, source)
+    if key:
+      result.append(key)
+  return tuple(result)
+
+
+def canonical_cost_maps(source, tracking_to_po, trackings_cost, po_cost) -> tuple:
+  """
+  A portal's (tracking->PO, trackings->cost, PO->cost) maps keyed by canonical
+  trackings. Entries whose trackings only differ in shape are combined: their
+  costs are summed, and for conflicting POs the first is kept and the conflict
+  counted. Entries without a (non-blank) tracking are dropped.
+  """
+  canonical_tracking_to_po = {}
+  for tracking, po in tracking_to_po.items():
+    key = canonical_tracking(tracking, source)
+    if not key:
+      continue
+    existing = canonical_tracking_to_po.setdefault(key, po)
+    if existing != po:
+      print(f"Warning: {source} lists tracking {key} under both PO {existing} and PO {po}")
+      instrumentation.count("tracking_keys.po_collisions")
+  canonical_trackings_cost = {}
+  for trackings, cost in trackings_cost.items():
+    key = canonical_trackings(trackings, source)
+    if not key:
+      continue
+    if key in canonical_trackings_cost:
+      instrumentation.count("tracking_keys.cost_collisions")
+      cost += canonical_trackings_cost[key]
+    canonical_trackings_cost[key] = cost
+  return canonical_tracking_to_po, canonical_trackings_cost, po_cost
+
+
+def note_join(key: str, source: str, other_source: str) -> None:
+  """Records that `key` joined the two sources' numbers, counting it if their raw values differ."""
+  raw = _raw_values.get(source, {}).get(key, key)
+  other_raw = _raw_values.get(other_source, {}).get(key, key)
+  if raw != other_raw:
+    recovered = _recovered.setdefault(source, set())
+    if key not in recovered:
+      recovered.add(key)
+      instrumentation.count("tracking_keys.recovered")
+
+
+def recovered_matches() -> Dict[str, int]:
+  """How many keys of each source only matched once canonicalized."""
+  return {source: len(keys) for source, keys in _recovered.items()}
+
+
+def reset() -> None:
+  _raw_values.clear()
+  _recovered.clear()
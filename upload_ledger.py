@@ -0,0 +1,70 @@
+"""
+A per-group record of the tracking numbers already submitted to each portal.
+
+Numbers are "submitted" once an upload of them went through and "confirmed"
+once they show up in the portal's own data (the tracking maps loaded during
+reconcile). Uploads only send numbers the ledger hasn't seen; submitted numbers
+that never get confirmed are sent again after RESUBMIT_AFTER_SECONDS. Numbers
+are keyed canonically (see tracking_keys), like the portals' maps.
+"""
+
+import time
+from lib.store import get_store, UPLOAD_LEDGER_NAMESPACE
+from lib.tracking_keys import canonical_tracking
+from typing import Iterable, List
+
+SUBMITTED = "submitted"
+CONFIRMED = "confirmed"
+
+RESUBMIT_AFTER_SECONDS = 7 * 24 * 60 * 60
+
+
+class UploadLedger:
+
+  def __init__(self, group) -> None:
+    self.group = group
+    # tracking number -> (status, time of last status change)
+    self.entries = get_store().table(f"{UPLOAD_LEDGER_NAMESPACE}/{group}")
+
+  def new_numbers(self, numbers: Iterable[str]) -> List[str]:
+    """The numbers (deduplicated, in order) that still need uploading."""
+    now = time.time()
+    result = []
+    seen = set()
+    for number in numbers:
+      key = canonical_tracking(number)
+      if key in seen:
+        continue
+      seen.add(key)
+      entry = self.entries.get(key)
+      if entry is None:
+        result.append(number)
+      else:
+        status, updated = entry
+        if status == SUBMITTED and now - updated >= RESUBMIT_AFTER_SECONDS:
+          result.append(number)
+    return result
+
+  def record_submitted(self, numbers: Iterable[str]) -> None:
+    now = time.time()
+    self.entries.update((canonical_tracking(number), (SUBMITTED, now)) for number in numbers)
+
+  def record_confirmed(self, trackings: Iterable[str]) -> int:
+    """Marks the trackings the portal knows about as confirmed, returning how many were new."""
+    now = time.time()
+    existing = self.entries.load_all()
+    confirmed = {
+        key: (CONFIRMED, now)
+        for key in set(canonical_tracking(tracking) for tracking in trackings)
+        if existing.get(key, (None,))[0] != CONFIRMED
+    }
+    self.entries.update(confirmed)
+    return len(confirmed)
+
+
+def confirm_from_maps(group, tracking_to_po, trackings_to_cost) -> int:
+  """Confirms every tracking in a group's portal maps (see get_new_tracking_pos_costs_maps)."""
+  trackings = set(tracking_to_po)
+  for trackings_tuple in trackings_to_cost:
+    trackings.update(trackings_tuple)
+  return UploadLedger(group).record_confirmed(trackings)